@@ -26,6 +26,12 @@ module kb_anvio {
         kmer_size: size of kmers
         ncbi_cog_diamond_mode: search mode for diamond
         trna_run: run trna tooling
+        run_hmms, run_scg_taxonomy, run_ncbi_cogs, run_pfams, run_kegg_kofams, run_interacdome:
+            "yes" to run that contigs.db annotation source; default "no"
+        sample_workers: number of reads samples mapped and profiled concurrently; default chosen from available cores and memory
+        archive_format: format of the result archive, zip or tar.zst; default zip
+        archive_compression_level: 0-9 for zip, 1-19 for tar.zst; default 6 for zip, 3 for tar.zst
+        output_packaging: minimal, anvio-interactive or full, the result files archived; default full
         ref: https://github.com/merenlab/anvio
 
     */
@@ -40,6 +46,16 @@ module kb_anvio {
         int kmer_size;
         string ncbi_cog_diamond_mode;
         string trna_run;
+        string run_hmms;
+        string run_scg_taxonomy;
+        string run_ncbi_cogs;
+        string run_pfams;
+        string run_kegg_kofams;
+        string run_interacdome;
+        int sample_workers;
+        string archive_format;
+        int archive_compression_level;
+        string output_packaging;
 
     } AnvioInputParams;
 
@@ -0,0 +1,157 @@
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+
+from kb_anvio.Utils.Log import log
+
+
+class AnnotationSource(object):
+    """
+    AnnotationSource: one contigs.db annotation step and the AnvioInputParams switch enabling it
+
+    exportable sources only add gene functions, so their search can run on a private copy of
+    contigs.db and the result is carried over with anvi-export-functions/anvi-import-functions.
+    the others write their own tables or self table values and have to run on the real
+    contigs.db.
+    """
+
+    def __init__(self, name, param, run, exportable, needs=()):
+        self.name = name
+        self.param = param
+        self.run = run
+        self.exportable = exportable
+        self.needs = tuple(needs)
+
+
+def _run_hmms(util, task_params, contigs_db, threads):
+    util.run_anvi_run_hmms(contigs_db, threads)
+
+
+def _run_scg_taxonomy(util, task_params, contigs_db, threads):
+    util.run_anvi_run_scg_taxonomy(contigs_db, threads)
+
+
+def _run_trnas(util, task_params, contigs_db, threads):
+    util.run_anvi_scan_trnas(contigs_db, threads)
+    util.run_anvi_run_trna_taxonomy(contigs_db, threads)
+
+
+def _run_interacdome(util, task_params, contigs_db, threads):
+    util.run_anvi_run_interacdome(contigs_db, threads)
+
+
+def _run_ncbi_cogs(util, task_params, contigs_db, threads):
+    util.run_anvi_run_ncbi_cog(task_params, contigs_db, threads)
+
+
+def _run_pfams(util, task_params, contigs_db, threads):
+    util.run_anvi_run_pfams(contigs_db, threads)
+
+
+def _run_kegg_kofams(util, task_params, contigs_db, threads):
+    util.run_anvi_run_kegg_kofams(contigs_db, threads)
+
+
+ANNOTATION_SOURCES = [
+    AnnotationSource('hmms', 'run_hmms', _run_hmms, exportable=False),
+    AnnotationSource('scg_taxonomy', 'run_scg_taxonomy', _run_scg_taxonomy, exportable=False,
+                     needs=['hmms']),
+    AnnotationSource('trnas', 'trna_run', _run_trnas, exportable=False),
+    AnnotationSource('interacdome', 'run_interacdome', _run_interacdome, exportable=False),
+    AnnotationSource('ncbi_cogs', 'run_ncbi_cogs', _run_ncbi_cogs, exportable=True),
+    AnnotationSource('pfams', 'run_pfams', _run_pfams, exportable=True),
+    # anvi-run-kegg-kofams also records the KEGG modules db hash in the self table, which
+    # anvi-estimate-metabolism checks and anvi-import-functions does not carry over
+    AnnotationSource('kegg_kofams', 'run_kegg_kofams', _run_kegg_kofams, exportable=False),
+]
+
+
+class AnnotationScheduler(object):
+    """
+    AnnotationScheduler: run the selected contigs.db annotation sources concurrently
+
+    every exportable source searches against its own snapshot of contigs.db in parallel,
+    while the sources that write their own tables run one after another on contigs.db itself.
+    once all searches are done the exported functions are imported into contigs.db one at
+    a time, so only a single process ever writes to the SQLite database.
+    """
+    ANNOTATION_DIRECTORY = 'annotation'
+
+    def __init__(self, anvio_util, contigs_db):
+        self.anvio_util = anvio_util
+        self.contigs_db = os.path.abspath(contigs_db)
+        self.work_dir = os.path.join(os.path.dirname(self.contigs_db), self.ANNOTATION_DIRECTORY)
+
+    def selected_sources(self, task_params):
+        """
+        selected_sources: sources switched on in task_params, plus the sources they need
+        """
+        selected = set(source.name for source in ANNOTATION_SOURCES
+                       if task_params.get(source.param) == 'yes')
+        for source in ANNOTATION_SOURCES:
+            if source.name in selected:
+                for needed in source.needs:
+                    if needed not in selected:
+                        log('{} annotation needs {}, enabling it'.format(source.name, needed))
+                        selected.add(needed)
+        return [source for source in ANNOTATION_SOURCES if source.name in selected]
+
+    def _search_on_copy(self, source, task_params, threads):
+        """
+        _search_on_copy: run an exportable source on its snapshot and export its functions
+        """
+        source_dir = os.path.join(self.work_dir, source.name)
+        contigs_db_copy = os.path.join(source_dir, 'contigs.db')
+        functions_file = os.path.join(source_dir, 'functions.txt')
+
+        source.run(self.anvio_util, task_params, contigs_db_copy, threads)
+        self.anvio_util.run_anvi_export_functions(contigs_db_copy, functions_file)
+        return functions_file
+
+    def _run_in_place(self, sources, task_params, threads):
+        for source in sources:
+            log('running {} annotation on {}'.format(source.name, self.contigs_db))
+            source.run(self.anvio_util, task_params, self.contigs_db, threads)
+
+    def run(self, task_params):
+        sources = self.selected_sources(task_params)
+        if not sources:
+            log('No contigs.db annotation selected')
+            return
+
+        exportable = [source for source in sources if source.exportable]
+        in_place = [source for source in sources if not source.exportable]
+        log('Scheduling annotation: parallel searches {}, in place {}'.format(
+            [source.name for source in exportable], [source.name for source in in_place]))
+
+        # snapshot contigs.db before anything writes to it
+        for source in exportable:
+            source_dir = os.path.join(self.work_dir, source.name)
+            if os.path.isdir(source_dir):
+                shutil.rmtree(source_dir)
+            os.makedirs(source_dir)
+            shutil.copy2(self.contigs_db, os.path.join(source_dir, 'contigs.db'))
+
+        workers = len(exportable) + (1 if in_place else 0)
+        plan = self.anvio_util.plan.split(workers)
+        threads = plan.threads('annotation')
+        stage = self.anvio_util.stage_name or 'annotate'
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            # every lane keeps the stage's share of the plan and is reported as its own stage
+            searches = [(source, executor.submit(self.anvio_util.run_in_stage,
+                                                 '{}:{}'.format(stage, source.name), plan,
+                                                 self._search_on_copy, source, task_params,
+                                                 threads))
+                        for source in exportable]
+            if in_place:
+                in_place_lane = executor.submit(self.anvio_util.run_in_stage,
+                                                '{}:in_place'.format(stage), plan,
+                                                self._run_in_place, in_place, task_params, threads)
+                in_place_lane.result()
+            functions_files = [(source, search.result()) for source, search in searches]
+
+        for source, functions_file in functions_files:
+            log('importing {} functions into {}'.format(source.name, self.contigs_db))
+            self.anvio_util.run_anvi_import_functions(self.contigs_db, functions_file)
+            shutil.rmtree(os.path.dirname(functions_file))
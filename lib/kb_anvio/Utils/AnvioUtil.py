@@ -1,20 +1,39 @@
 import errno
+import hashlib
 import json
 import os
-import subprocess
-import sys
-import time
+import re
 import uuid
-import zipfile
 import copy
 import glob
 import shutil
+import sqlite3
+import stat
+import threading
+from contextlib import closing
+from concurrent.futures import FIRST_EXCEPTION, ThreadPoolExecutor, wait
 
 from installed_clients.AssemblyUtilClient import AssemblyUtil
 from installed_clients.DataFileUtilClient import DataFileUtil
 from installed_clients.KBaseReportClient import KBaseReport
 from installed_clients.MetagenomeUtilsClient import MetagenomeUtils
 from installed_clients.ReadsUtilsClient import ReadsUtils
+from installed_clients.WorkspaceClient import Workspace
+from kb_anvio.Utils.AnnotationScheduler import AnnotationScheduler
+from kb_anvio.Utils.ArchiveWriter import ArchiveWriter
+from kb_anvio.Utils.ArtifactCache import ArtifactCache, link_or_copy
+from kb_anvio.Utils.CheckpointLedger import CheckpointLedger, fingerprint
+from kb_anvio.Utils.CommandMetrics import CommandMetrics
+from kb_anvio.Utils.CommandRunner import Command, CommandRunner, Pipeline
+from kb_anvio.Utils.FastaReformatter import FastaReformatter
+from kb_anvio.Utils.FastqDeinterleaver import FastqDeinterleaver
+from kb_anvio.Utils.HttpSession import with_session
+from kb_anvio.Utils.Log import log
+from kb_anvio.Utils.MapperRegistry import get_mapper
+from kb_anvio.Utils.OutputCatalog import catalog, check_profile, select_members
+from kb_anvio.Utils.ReferenceData import REFERENCE_ROOT, ReferenceData, anvio_version
+from kb_anvio.Utils.ResourcePlanner import ResourcePlan
+from kb_anvio.Utils.StageGraph import StageGraph
 # from installed_clients.KBParallelClient import KBParallel
 
 from random import seed
@@ -23,27 +42,134 @@ from random import randint
 seed(1)
 
 
-def log(message, prefix_newline=False):
-    """Logging function, provides a hook to suppress or redirect log messages."""
-    print(('\n' if prefix_newline else '') + '{0:.2f}'.format(time.time()) + ': ' + str(message))
-
-
 class AnvioUtil:
     # ANVIO_BASE_PATH = '/kb/deployment/bin/ANVIO'
     ANVIO_RESULT_DIRECTORY = 'anvio_output_dir'
+    COMMAND_LOG_DIRECTORY = 'logs'
     BINNER_BIN_RESULT_DIR = 'final_bins'
-    MAPPING_THREADS = 4
-    BBMAP_MEM = '30g'
-
-    def __init__(self, config):
+    READS_MANIFEST_FILE = 'staged_reads_manifest.json'
+    READ_MAPPING_INDEX_DIR = 'read_mapping_index'
+    REFORMAT_REPORT_SUFFIX = '_report.txt'
+    REFORMAT_STATS_SUFFIX = '_stats.json'
+    # part of the sample_bam and sample_profile cache keys, bump when the layout of their
+    # entries changes
+    SAMPLE_CACHE_LAYOUT = 2
+    PROFILE_CACHE_LAYOUT = 2
+
+    def __init__(self, config, reference_data=None, session=None):
         self.callback_url = config['SDK_CALLBACK_URL']
         self.scratch = config['scratch']
         self.shock_url = config['shock-url']
         self.ws_url = config['workspace-url']
-        self.dfu = DataFileUtil(self.callback_url)
-        self.ru = ReadsUtils(self.callback_url)
-        self.au = AssemblyUtil(self.callback_url)
-        self.mgu = MetagenomeUtils(self.callback_url)
+        self.token = config.get('KB_AUTH_TOKEN')
+        # pooled HTTP session the service clients send their calls through, if given
+        self.session = session
+        self.dfu = with_session(DataFileUtil(self.callback_url), session)
+        self.ru = with_session(ReadsUtils(self.callback_url), session)
+        self.au = with_session(AssemblyUtil(self.callback_url), session)
+        self.mgu = with_session(MetagenomeUtils(self.callback_url), session)
+        self.reads_manifest = None
+        # sample workers stage reads whose cached bams were evicted concurrently
+        self._reads_manifest_lock = threading.Lock()
+        # resource plan and name of the pipeline stage running in each thread
+        self._stage_context = threading.local()
+        self.metrics = CommandMetrics()
+        # commands running longer than command-timeout-seconds are terminated, if it is set
+        self.runner = CommandRunner(
+            self.metrics, timeout=float(config.get('command-timeout-seconds') or 0) or None)
+        # 'direct' writes the result archive straight into staging, 'copy' writes it to
+        # scratch and exports it afterwards
+        self.staging_export_mode = config.get('staging-export-mode') or 'direct'
+        if self.staging_export_mode not in ('direct', 'copy'):
+            raise ValueError('Unknown staging-export-mode: {}, expected direct or copy'.format(
+                self.staging_export_mode))
+        self.plan = ResourcePlan.from_host()
+        self.ledger = None
+        # artifacts shared between jobs, None when artifact-cache-dir is not configured
+        self.cache = ArtifactCache.from_config(config)
+        # keys the cached artifacts anvi'o built, older anvi'o databases do not open
+        self.anvio_version = anvio_version()
+        # annotation reference data, validated when the server starts
+        self.reference_data = reference_data or ReferenceData(
+            config.get('reference-data-dir') or REFERENCE_ROOT,
+            fallback_root=os.path.join(self.scratch, 'anviodb'))
+
+    @property
+    def plan(self):
+        """
+        plan: resource plan of the pipeline stage running in this thread, or of the whole run
+        """
+        return getattr(self._stage_context, 'plan', None) or self._plan
+
+    @plan.setter
+    def plan(self, plan):
+        self._plan = plan
+
+    def _checkpoint(self, stage, stage_fingerprint, func, outputs):
+        """
+        _checkpoint: run func as a checkpointed stage
+
+        the stage is skipped and its recorded result returned when the checkpoint ledger
+        holds a valid entry for the same input fingerprint. Otherwise func runs and the files
+        returned by outputs(result) are recorded. Without a ledger func always runs.
+        """
+        if self.ledger is None:
+            return func()
+        if self.ledger.is_complete(stage, stage_fingerprint):
+            log('Skipping stage {}, its checkpoint is still valid'.format(stage))
+            return self.ledger.result(stage)
+        self.ledger.invalidate(stage)
+        result = func()
+        self.ledger.record(stage, stage_fingerprint, outputs(result), result)
+        return result
+
+    def _fingerprint_of(self, stage):
+        return self.ledger.fingerprint_of(stage) if self.ledger is not None else None
+
+    def _remove_path(self, path):
+        """
+        _remove_path: remove a stale file or directory left behind by an interrupted stage
+        """
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        elif os.path.exists(path):
+            os.remove(path)
+
+    def _cached_artifact(self, kind, key, dest_dir, build, mutable=(), targets=None):
+        """
+        _cached_artifact: restore an artifact from the artifact cache, or build it and add it
+
+        build creates the artifact and returns a dict of file name to path of the files to
+        cache. dest_dir, mutable and targets are passed on to ArtifactCache.restore.
+        """
+        if self.cache is None:
+            build()
+            return
+        if self.cache.restore(kind, key, dest_dir, mutable=mutable, targets=targets) is not None:
+            log('Restored {} from the artifact cache'.format(kind))
+            return
+        files = build()
+        self.cache.store(kind, key, files, mutable=mutable)
+
+    @property
+    def stage_name(self):
+        """
+        stage_name: name of the pipeline stage running in this thread, for command metrics
+        """
+        return getattr(self._stage_context, 'stage', None)
+
+    def run_in_stage(self, stage, plan, func, *args):
+        """
+        run_in_stage: call func with plan as the resource plan and stage as the stage name of
+                      the current thread
+        """
+        self._stage_context.stage = stage
+        self._stage_context.plan = plan
+        try:
+            return func(*args)
+        finally:
+            self._stage_context.stage = None
+            self._stage_context.plan = None
 
     def _validate_run_anvio_params(self, task_params):
         """
@@ -57,6 +183,13 @@ class AnvioUtil:
             if p not in task_params:
                 raise ValueError('"{}" parameter is required, but missing'.format(p))
 
+        # raises on a read_mapping_tool no mapper backend is registered for
+        get_mapper(task_params['read_mapping_tool'])
+        # raises on an unknown archive format or a compression level out of its range
+        ArchiveWriter(task_params.get('archive_format'),
+                      task_params.get('archive_compression_level'))
+        check_profile(task_params.get('output_packaging'))
+
     def _mkdir_p(self, path):
         """
         _mkdir_p: make directory for given path
@@ -71,26 +204,123 @@ class AnvioUtil:
             else:
                 raise
 
-    def _run_command(self, command):
+    def _run_command(self, command, timeout=None):
         """
-        _run_command: run command and print result
+        _run_command: run a Command, Pipeline or argv list from scratch, streaming its output
+                      to the log and to the log file of the current stage
+
+        return: the last lines of the command output
         """
-        os.chdir(self.scratch)
         log('Start executing command:\n{}'.format(command))
         log('Command is running from:\n{}'.format(self.scratch))
-        pipe = subprocess.Popen(command, stdout=subprocess.PIPE, shell=True)
-        output, stderr = pipe.communicate()
-        exitCode = pipe.returncode
+        return self.runner.run(command, self.scratch, stage=self.stage_name, timeout=timeout)
+
+    def _file_checksum(self, file_path, block_size=1 << 20):
+        """
+        _file_checksum: md5 hex digest of a file, read in fixed size blocks
+        """
+        md5 = hashlib.md5()
+        with open(file_path, 'rb') as f:
+            for block in iter(lambda: f.read(block_size), b''):
+                md5.update(block)
+        return md5.hexdigest()
+
+    def _reads_manifest_path(self):
+        return os.path.join(self.scratch, self.ANVIO_RESULT_DIRECTORY, self.READS_MANIFEST_FILE)
+
+    def _load_reads_manifest(self):
+        """
+        _load_reads_manifest: return the staged-reads manifest held by this run, falling back
+                              to the copy written in the result directory by an earlier run
+        """
+        if self.reads_manifest is not None:
+            return self.reads_manifest
+        manifest_path = self._reads_manifest_path()
+        if os.path.isfile(manifest_path):
+            with open(manifest_path) as f:
+                self.reads_manifest = json.load(f)
+        else:
+            self.reads_manifest = {'libraries': {}}
+        return self.reads_manifest
 
-        if (exitCode == 0):
-            log('Executed command:\n{}\n'.format(command) +
-                'Exit Code: {}\n'.format(exitCode))
+    def _write_reads_manifest(self):
+        """
+        _write_reads_manifest: replace the manifest file, called with the manifest lock held
+        """
+        manifest_path = self._reads_manifest_path()
+        self._mkdir_p(os.path.dirname(manifest_path))
+        tmp_path = '{}.{}.tmp'.format(manifest_path, uuid.uuid4())
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump(self.reads_manifest, f, indent=1)
+            os.replace(tmp_path, manifest_path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def _is_staged(self, library):
+        """
+        _is_staged: check that every file recorded for a library is still on scratch, with
+                    the recorded size and md5 checksum
+        """
+        for staged_file in library['files']:
+            if not os.path.isfile(staged_file['path']):
+                return False
+            if os.path.getsize(staged_file['path']) != staged_file['size']:
+                return False
+            if self._file_checksum(staged_file['path']) != staged_file['md5']:
+                log('Staged reads file {} changed since it was downloaded'.format(
+                    staged_file['path']))
+                return False
+        return True
+
+    def stage_reads(self, reads_list):
+        """
+        stage_reads: download the fastq files of every reads object to scratch once and
+                     record them in the staged-reads manifest
+
+                     each manifest entry holds the read type and the path, size and md5
+                     checksum of every staged file. Libraries already present in the manifest
+                     are reused instead of being downloaded again.
+
+        return: list of manifest entries, in reads_list order
+        """
+        with self._reads_manifest_lock:
+            libraries = self._load_reads_manifest()['libraries']
+            missing = [read_obj for read_obj in reads_list
+                       if read_obj not in libraries or not self._is_staged(libraries[read_obj])]
+
+        if missing:
+            log('Downloading reads object list: {}'.format(missing))
+            # getting from workspace and writing to scratch. The 'reads' dictionary now has file paths to scratch.
+            reads = self.ru.download_reads({'read_libraries': missing,
+                                            'interleaved': None})['files']
+
+            # "reads" is the hash of hashes where key is "12804/1/1" or in this case, read_obj
+            # and "files" is the secondary key. The tertiary keys are "fwd" and "rev", as well
+            # as others.
+            staged = dict()
+            for read_obj in missing:
+                files = reads[read_obj]['files']
+                staged_files = list()
+                for direction in ['fwd', 'rev']:
+                    if files.get(direction) is None:
+                        continue
+                    staged_files.append({'direction': direction,
+                                         'path': files[direction],
+                                         'size': os.path.getsize(files[direction]),
+                                         'md5': self._file_checksum(files[direction])})
+                staged[read_obj] = {'reads_ref': read_obj,
+                                    'read_type': files['type'],
+                                    'files': staged_files}
+            with self._reads_manifest_lock:
+                libraries.update(staged)
+                self._write_reads_manifest()
         else:
-            error_msg = 'Error running command:\n{}\n'.format(command)
-            error_msg += 'Exit Code: {}\nOutput:\n{}\nStderr:\n{}'.format(exitCode, output, stderr)
-            raise ValueError(error_msg)
-            sys.exit(1)
-        return (output, stderr)
+            log('All reads objects already staged: {}'.format(reads_list))
+
+        with self._reads_manifest_lock:
+            return [libraries[read_obj] for read_obj in reads_list]
 
     # this function has been customized to return read_type variable (interleaved vs single-end library)
     def stage_reads_list_file(self, reads_list):
@@ -104,46 +334,105 @@ class AnvioUtil:
         result_file_path = []
         read_type = []
 
-        # getting from workspace and writing to scratch. The 'reads' dictionary now has file paths to scratch.
-        reads = self.ru.download_reads({'read_libraries': reads_list, 'interleaved': None})['files']
-
-        # reads_list is the list of file paths on workspace? (i.e. 12804/1/1).
-        # "reads" is the hash of hashes where key is "12804/1/1" or in this case, read_obj and
-        # "files" is the secondary key. The tertiary keys are "fwd" and "rev", as well as others.
-        for read_obj in reads_list:
-            files = reads[read_obj]['files']    # 'files' is dictionary where 'fwd' is key of file path on scratch.
-            result_file_path.append(files['fwd'])
-            read_type.append(files['type'])
-            if 'rev' in files and files['rev'] is not None:
-                result_file_path.append(files['rev'])
+        for library in self.stage_reads(reads_list):
+            for staged_file in library['files']:
+                result_file_path.append(staged_file['path'])
+            read_type.append(library['read_type'])
 
         return result_file_path, read_type
 
+    def _resolve_reads_versions(self, reads_list):
+        """
+        _resolve_reads_versions: versioned reference (wsid/objid/version) and object name of
+                                 every reads object, so a cached sample never outlives the
+                                 reads it was mapped from
+
+        return: dict of reads reference to (versioned reference, object name)
+        """
+        ws = with_session(Workspace(self.ws_url, token=self.token), self.session)
+        infos = ws.get_object_info3(
+            {'objects': [{'ref': reads_ref} for reads_ref in reads_list]})['infos']
+        return {reads_ref: ('{}/{}/{}'.format(info[6], info[0], info[4]), info[1])
+                for reads_ref, info in zip(reads_list, infos)}
+
+    def _sample_cache_key(self, task_params, library):
+        """
+        _sample_cache_key: artifact cache key of the bams of one sample, None without a cache
+        """
+        if (self.cache is None or not task_params.get('assembly_hash') or
+                not library.get('reads_upa')):
+            return None
+        mapper = get_mapper(task_params['read_mapping_tool'])[0]
+        return ArtifactCache.key(task_params.get('assembly_hash'),
+                                 task_params['min_contig_length'], FastaReformatter.VERSION,
+                                 library['reads_upa'], task_params['read_mapping_tool'],
+                                 mapper.version(), self.anvio_version, self.SAMPLE_CACHE_LAYOUT)
+
+    def _contigs_db_hash(self, contigs_db):
+        """
+        _contigs_db_hash: the contigs_db_hash anvi'o stamps into contigs.db and every profile
+        """
+        with closing(sqlite3.connect(contigs_db)) as db:
+            return db.execute("select value from self where key = 'contigs_db_hash'").fetchone()[0]
+
+    def stage_uncached_reads(self, task_params, reads_list):
+        """
+        stage_uncached_reads: stage the reads objects whose bams are not in the artifact cache
+
+        cached samples get a manifest entry without files; map_sample restores their bams
+        and only downloads the reads if the entry was evicted in the meantime.
+
+        return: list of manifest entries, in reads_list order
+        """
+        if self.cache is None or not task_params.get('assembly_hash'):
+            return self.stage_reads(reads_list)
+
+        versions = self._resolve_reads_versions(reads_list)
+        libraries = dict()
+        for reads_ref in reads_list:
+            reads_upa, reads_name = versions[reads_ref]
+            library = {'reads_ref': reads_ref, 'reads_upa': reads_upa, 'reads_name': reads_name,
+                       'read_type': None, 'files': []}
+            if self.cache.contains('sample_bam', self._sample_cache_key(task_params, library)):
+                log('Bams of {} are cached, not downloading its reads'.format(reads_ref))
+                libraries[reads_ref] = library
+
+        missing = [reads_ref for reads_ref in reads_list if reads_ref not in libraries]
+        for library in self.stage_reads(missing) if missing else []:
+            reads_upa, reads_name = versions[library['reads_ref']]
+            libraries[library['reads_ref']] = dict(library, reads_upa=reads_upa,
+                                                   reads_name=reads_name)
+        return [libraries[reads_ref] for reads_ref in reads_list]
+
     def _get_contig_file(self, assembly_ref):
         """
         _get_contig_file: get contig file from GenomeAssembly object
         """
         contig_file = self.au.get_assembly_as_fasta({'ref': assembly_ref}).get('path')
 
-        sys.stdout.flush()
-        contig_file = self.dfu.unpack_file({'file_path': contig_file})['file_path']
-
         return contig_file
 
-    def run_anvi_script_reformat_fasta(self, task_params):
-        min_contig_length = task_params['min_contig_length']
-        contig_file_path = task_params['contig_file_path']
+    def reformat_fasta(self, task_params):
+        """
+        reformat_fasta: drop contigs shorter than min_contig_length and simplify contig names
+                        the way anvi-script-reformat-fasta --simplify-names does, writing the
+                        name report and assembly statistics next to the reformatted fasta
 
+        return: dict of file name to path of the reformatted fasta, report and statistics
+        """
+        contig_file_path = task_params['contig_file_path']
         clean_contig_file_path = task_params['contig_file_path'] + "_anvio-reformatted"
-        command = 'anvi-script-reformat-fasta '
-        command += '{} '.format(contig_file_path)
-        command += '-o {} '.format(clean_contig_file_path)
-        command += '-l {} '.format(min_contig_length)
-        command += '--simplify-names'
-
-        log('running anvi_script_reformat_fasta: {}'.format(command))
-        self._run_command(command)
-        return clean_contig_file_path
+        files = {'contigs.fa': clean_contig_file_path,
+                 'report.txt': clean_contig_file_path + self.REFORMAT_REPORT_SUFFIX,
+                 'stats.json': clean_contig_file_path + self.REFORMAT_STATS_SUFFIX}
+
+        with self.metrics.measure(self.stage_name, 'reformat {}'.format(contig_file_path)):
+            stats = FastaReformatter(task_params['min_contig_length']).reformat(
+                contig_file_path, files['contigs.fa'], files['report.txt'], files['stats.json'])
+        if not stats['contigs_kept']:
+            raise ValueError('No contigs of at least {} bp in the assembly'.format(
+                task_params['min_contig_length']))
+        return files
 
     def run_anvi_gen_contigs_database(self, task_params):
         min_contig_length = task_params['min_contig_length']
@@ -151,192 +440,130 @@ class AnvioUtil:
         contig_split_size = task_params['contig_split_size']
         kmer_size = task_params['kmer_size']
         clean_contig_file_path = task_params['contig_file_path'] + "_anvio-reformatted"
-        command = 'anvi-gen-contigs-database '
-        command += '-f {} '.format(contig_file_path)
-        command += '-o contigs.db '
-        command += '--split-length {} '.format(contig_split_size)
-        command += '--kmer-size {} '.format(kmer_size)
-        command += '-T 10 '
-        command += '--prodigal-translation-table 11 '
-        command += '-n "{} contig database"'.format(contig_file_path.split("/")[-1])
+        threads = self.plan.threads('contigs_db')
+        command = Command(['anvi-gen-contigs-database',
+                           '-f', contig_file_path,
+                           '-o', 'contigs.db',
+                           '--split-length', contig_split_size,
+                           '--kmer-size', kmer_size,
+                           '-T', threads,
+                           '--prodigal-translation-table', 11,
+                           '-n', '{} contig database'.format(contig_file_path.split("/")[-1])],
+                          threads=threads)
 
         log('running anvi_gen_contigs_database: {}'.format(command))
         self._run_command(command)
 
-    def deinterlace_raw_reads(self, fastq):
-        fastq_forward = fastq.split('.fastq')[0] + "_forward.fastq"
-        fastq_reverse = fastq.split('.fastq')[0] + "_reverse.fastq"
-        command = 'deinterleave_fastq.sh < {} {} {}'.format(fastq, fastq_forward, fastq_reverse)
-        try:
-            self._run_command(command)
-        except Exception:
-            raise Exception("Cannot deinterlace fastq file!")
-        return (fastq_forward, fastq_reverse)
+    def deinterlace_raw_reads(self, fastq, streaming=True):
+        """
+        deinterlace_raw_reads: stream an interleaved fastq file into forward and reverse
+                               named pipes, or split it into regular files without streaming;
+                               use the returned FastqDeinterleaver as a context manager around
+                               the mapper reading its forward/reverse paths
+        """
+        return FastqDeinterleaver(fastq, self.scratch, streaming=streaming)
+
+    def _read_mapping_index(self, read_mapping_tool):
+        """
+        _read_mapping_index: path of the index of a read mapping tool; the index file name
+                             does not depend on the assembly name, so cached indexes restore
+                             to the same paths
+        """
+        mapper = get_mapper(read_mapping_tool)[0]
+        return os.path.join(self.scratch, self.READ_MAPPING_INDEX_DIR, mapper.index_name)
+
+    def build_read_mapping_index(self, task_params, assembly_clean):
+        """
+        build_read_mapping_index: build the index of the selected read mapping tool once
+                                  from the reformatted assembly, so every sample reuses it
+
+        return: index path to pass to the mapper (bowtie2/hisat2/bwa prefix, minimap2 .mmi
+                file or bbmap index directory)
+        """
+        mapper = get_mapper(task_params['read_mapping_tool'])[0]
+        index = self._read_mapping_index(task_params['read_mapping_tool'])
+        self._mkdir_p(os.path.dirname(index))
 
-    def run_read_mapping_interleaved_pairs_mode(self, task_params, assembly_clean, fastq, sam):
-        read_mapping_tool = task_params['read_mapping_tool']
-        log("running {} mapping in interleaved mode.".format(read_mapping_tool))
         random_seed_int = randint(0, 999999999)
-        log("randomly selected seed (integer) used for read mapping is: {}".format(random_seed_int))
-        if task_params['read_mapping_tool'] == 'bbmap_fast':
-            log("Warning: bbmap does not support setting random seeds, so results are not reproducible.")
-            command = 'bbmap.sh -Xmx{} '.format(self.BBMAP_MEM)
-            command += 'threads={} '.format(self.MAPPING_THREADS)
-            command += 'ref={} '.format(assembly_clean)
-            command += 'in={} '.format(fastq)
-            command += 'out={} '.format(sam)
-            command += 'fast interleaved=true mappedonly nodisk overwrite'
-        elif task_params['read_mapping_tool'] == 'bbmap_default':
-            log("Warning: bbmap does not support setting random seeds, so results are not reproducible.")
-            command = 'bbmap.sh -Xmx{} '.format(self.BBMAP_MEM)
-            command += 'threads={} '.format(self.MAPPING_THREADS)
-            command += 'ref={} '.format(assembly_clean)
-            command += 'in={} '.format(fastq)
-            command += 'out={} '.format(sam)
-            command += 'interleaved=true mappedonly nodisk overwrite'
-        elif task_params['read_mapping_tool'] == 'bbmap_very_sensitive':
-            log("Warning: bbmap does not support setting random seeds, so results are not reproducible.")
-            command = 'bbmap.sh -Xmx{} '.format(self.BBMAP_MEM)
-            command += 'threads={} '.format(self.MAPPING_THREADS)
-            command += 'ref={} '.format(assembly_clean)
-            command += 'in={} '.format(fastq)
-            command += 'out={} '.format(sam)
-            command += 'vslow=true '
-            command += 'interleaved=true mappedonly nodisk overwrite'
-        elif task_params['read_mapping_tool'] == 'bowtie2_default':
-            (fastq_forward, fastq_reverse) = self.deinterlace_raw_reads(fastq)
-            bt2index = os.path.basename(assembly_clean) + '.bt2'
-            command = 'bowtie2-build -f {} '.format(assembly_clean)
-            command += '--threads {} '.format(self.MAPPING_THREADS)
-            command += '--seed {} '.format(random_seed_int)
-            command += '{} && '.format(bt2index)
-            command += 'bowtie2 -x {} '.format(bt2index)
-            command += '-1 {} '.format(fastq_forward)
-            command += '-2 {} '.format(fastq_reverse)
-            command += '--threads {} '.format(self.MAPPING_THREADS)
-            command += '-S {}'.format(sam)
-        elif task_params['read_mapping_tool'] == 'bowtie2_very_sensitive':
-            (fastq_forward, fastq_reverse) = self.deinterlace_raw_reads(fastq)
-            bt2index = os.path.basename(assembly_clean) + '.bt2'
-            command = 'bowtie2-build -f {} '.format(assembly_clean)
-            command += '--threads {} '.format(self.MAPPING_THREADS)
-            command += '--seed {} '.format(random_seed_int)
-            command += '{} && '.format(bt2index)
-            command += 'bowtie2 --very-sensitive -x {} '.format(bt2index)
-            command += '-1 {} '.format(fastq_forward)
-            command += '-2 {} '.format(fastq_reverse)
-            command += '--threads {} '.format(self.MAPPING_THREADS)
-            command += '-S {}'.format(sam)
-        elif task_params['read_mapping_tool'] == 'minimap2':
-            (fastq_forward, fastq_reverse) = self.deinterlace_raw_reads(fastq)
-            command = 'minimap2 -ax sr -t {} '.format(self.MAPPING_THREADS)
-            command += '--seed {} '.format(random_seed_int)
-            command += '{} '.format(assembly_clean)
-            command += '{} '.format(fastq_forward)
-            command += '{} > '.format(fastq_reverse)
-            command += '{}'.format(sam)
-        elif task_params['read_mapping_tool'] == 'hisat2':
-            (fastq_forward, fastq_reverse) = self.deinterlace_raw_reads(fastq)
-            ht2index = os.path.basename(assembly_clean) + '.ht2'
-            command = 'hisat2-build {} '.format(assembly_clean)
-            command += '{} && '.format(ht2index)
-            command += 'hisat2 -x {} '.format(ht2index)
-            command += '-1 {} '.format(fastq_forward)
-            command += '-2 {} '.format(fastq_reverse)
-            command += '-S {} '.format(sam)
-            command += '--seed {} '.format(random_seed_int)
-            command += '--threads {}'.format(self.MAPPING_THREADS)
-        log('running alignment command: {}'.format(command))
-        out, err = self._run_command(command)
-
-    def run_read_mapping_unpaired_mode(self, task_params, assembly_clean, fastq, sam):
+        if mapper.index_supports_seed:
+            log("randomly selected seed (integer) used for index building is: {}".format(
+                random_seed_int))
+        command = Command(mapper.index_command(assembly_clean, index, self.plan, random_seed_int),
+                          threads=self.plan.threads('index'))
+
+        log('running read mapping index build: {}'.format(command))
+        self._run_command(command)
+        return index
+
+    def _index_files(self, index):
+        """
+        _index_files: files making up a read mapping index built by build_read_mapping_index
+        """
+        if os.path.isdir(index):
+            return sorted(os.path.join(dirname, file)
+                          for dirname, subdirs, files in os.walk(index) for file in files)
+        return sorted(glob.glob(index + '*'))
+
+    def run_read_mapping(self, task_params, index, fastq, paired, sorted_bam):
+        """
+        run_read_mapping: map a fastq file, interleaved pairs when paired, and stream the
+                          alignments into sorted_bam
+
+                          backends that cannot read interleaved pairs get the mates through
+                          a streaming deinterleaver
+        """
         read_mapping_tool = task_params['read_mapping_tool']
-        log("running {} mapping in single-end (unpaired) mode.".format(read_mapping_tool))
+        mapper, preset = get_mapper(read_mapping_tool)
+        log("running {} mapping in {} mode.".format(
+            read_mapping_tool, 'interleaved' if paired else 'single-end (unpaired)'))
+
         random_seed_int = randint(0, 999999999)
-        log("randomly selected seed (integer) used for read mapping is: {}".format(random_seed_int))
-        if task_params['read_mapping_tool'] == 'bbmap_fast':
-            log("Warning: bbmap does not support setting random seeds, so results are not reproducible.")
-            command = 'bbmap.sh -Xmx{} '.format(self.BBMAP_MEM)
-            command += 'threads={} '.format(self.MAPPING_THREADS)
-            command += 'ref={} '.format(assembly_clean)
-            command += 'in={} '.format(fastq)
-            command += 'out={} '.format(sam)
-            command += 'fast interleaved=false mappedonly nodisk overwrite'
-        elif task_params['read_mapping_tool'] == 'bbmap_default':
-            log("Warning: bbmap does not support setting random seeds, so results are not reproducible.")
-            command = 'bbmap.sh -Xmx{} '.format(self.BBMAP_MEM)
-            command += 'threads={} '.format(self.MAPPING_THREADS)
-            command += 'ref={} '.format(assembly_clean)
-            command += 'in={} '.format(fastq)
-            command += 'out={} '.format(sam)
-            command += 'interleaved=false mappedonly nodisk overwrite'
-        elif task_params['read_mapping_tool'] == 'bbmap_very_sensitive':
-            log("Warning: bbmap does not support setting random seeds, so results are not reproducible.")
-            command = 'bbmap.sh -Xmx{} '.format(self.BBMAP_MEM)
-            command += 'threads={} '.format(self.MAPPING_THREADS)
-            command += 'ref={} '.format(assembly_clean)
-            command += 'in={} '.format(fastq)
-            command += 'out={} '.format(sam)
-            command += 'vslow=true '
-            command += 'interleaved=false mappedonly nodisk overwrite'
-        elif task_params['read_mapping_tool'] == 'bowtie2_default':
-            bt2index = os.path.basename(assembly_clean) + '.bt2'
-            command = 'bowtie2-build -f {} '.format(assembly_clean)
-            command += '--threads {} '.format(self.MAPPING_THREADS)
-            command += '--seed {} '.format(random_seed_int)
-            command += '{} && '.format(bt2index)
-            command += 'bowtie2 -x {} '.format(bt2index)
-            command += '-U {} '.format(fastq)
-            command += '--threads {} '.format(self.MAPPING_THREADS)
-            command += '-S {}'.format(sam)
-        elif task_params['read_mapping_tool'] == 'bowtie2_very_sensitive':
-            bt2index = os.path.basename(assembly_clean) + '.bt2'
-            command = 'bowtie2-build -f {} '.format(assembly_clean)
-            command += '--threads {} '.format(self.MAPPING_THREADS)
-            command += '--seed {} '.format(random_seed_int)
-            command += '{} && '.format(bt2index)
-            command += 'bowtie2 --very-sensitive -x {} '.format(bt2index)
-            command += '-U {} '.format(fastq)
-            command += '--threads {} '.format(self.MAPPING_THREADS)
-            command += '-S {}'.format(sam)
-        elif task_params['read_mapping_tool'] == 'minimap2':
-            command = 'minimap2 -ax sr -t {} '.format(self.MAPPING_THREADS)
-            command += '--seed {} '.format(random_seed_int)
-            command += '{} '.format(assembly_clean)
-            command += '{} > '.format(fastq)
-            command += '{}'.format(sam)
-        elif task_params['read_mapping_tool'] == 'hisat2':
-            ht2index = os.path.basename(assembly_clean) + '.ht2'
-            command = 'hisat2-build {} '.format(assembly_clean)
-            command += '{} && '.format(ht2index)
-            command += 'hisat2 -x {} '.format(ht2index)
-            command += '-U {} '.format(fastq)
-            command += '-S {} '.format(sam)
-            command += '--seed {} '.format(random_seed_int)
-            command += '--threads {}'.format(self.MAPPING_THREADS)
-        log('running alignment command: {}'.format(command))
-        out, err = self._run_command(command)
-
-    def convert_sam_to_sorted_and_indexed_bam(self, sam):
-        # create bam files from sam files
-        sorted_bam = os.path.abspath(sam).split('.sam')[0] + "_sorted.bam"
-
-        command = 'samtools view -F 0x04 -uS {} | '.format(sam)
-        command += 'samtools sort - -o {}'.format(sorted_bam)
-
-        log('running samtools command to generate sorted bam: {}'.format(command))
-        self._run_command(command)
+        if mapper.supports_seed:
+            log("randomly selected seed (integer) used for read mapping is: {}".format(
+                random_seed_int))
+        else:
+            log("Warning: {} does not support setting random seeds.".format(mapper.name))
+
+        deinterleaver = None
+        reads = [fastq]
+        if paired and mapper.paired_input == 'split':
+            log("{} needs split mates, deinterleaving {}".format(read_mapping_tool, fastq))
+            # named pipes only suit mappers reading both mates in lockstep
+            deinterleaver = self.deinterlace_raw_reads(fastq, mapper.split_mates_in_lockstep)
+            reads = [deinterleaver.forward, deinterleaver.reverse]
+
+        command = Pipeline(Command(mapper.map_command(index, reads, paired, self.plan, preset,
+                                                      random_seed_int),
+                                   threads=self.plan.threads('mapping')),
+                           *self._sort_alignment_stream_commands(sorted_bam))
+        log('running streaming alignment command: {}'.format(command))
+        if deinterleaver is None:
+            self._run_command(command)
+        else:
+            # the mapper reads the mates while they are being split
+            with deinterleaver:
+                self._run_command(command)
 
+    def _sort_alignment_stream_commands(self, sorted_bam):
+        """
+        _sort_alignment_stream_commands: samtools pipeline stages that drop unmapped reads from
+                                         the SAM stream on stdin and sort it straight into
+                                         sorted_bam
+        """
+        threads = self.plan.threads('sort')
+        return [Command(['samtools', 'view', '-F', '0x04', '-uS', '-']),
+                Command(['samtools', 'sort', '-@', threads, '-m', self.plan.sort_mem,
+                         '-o', sorted_bam, '-'], threads=threads)]
+
+    def index_sorted_bam(self, sorted_bam):
         # verify we got bams
         if not os.path.exists(sorted_bam):
-            log('Failed to find bam file\n{}'.format(sorted_bam))
-            sys.exit(1)
+            raise ValueError('samtools sort did not write the bam file {}'.format(sorted_bam))
         elif(os.stat(sorted_bam).st_size == 0):
-            log('Bam file is empty\n{}'.format(sorted_bam))
-            sys.exit(1)
+            raise ValueError('samtools sort wrote an empty bam file {}'.format(sorted_bam))
 
         # index the bam file
-        command = 'samtools index {}'.format(sorted_bam)
+        command = Command(['samtools', 'index', sorted_bam])
 
         log('running samtools command to index sorted bam: {}'.format(command))
         self._run_command(command)
@@ -344,194 +571,397 @@ class AnvioUtil:
         return sorted_bam
 
     def run_anvi_init_bam(self, sorted_bam):
+        threads = self.plan.threads('init_bam')
         sorted_raw_bam = sorted_bam + "-RAW.bam"
-        command = 'anvi-init-bam '
-        command += '{} '.format(sorted_bam)
-        command += '-o {} '.format(sorted_raw_bam)
-        command += '-T 10 '
+        command = Command(['anvi-init-bam', sorted_bam,
+                           '-o', sorted_raw_bam,
+                           '-T', threads], threads=threads)
 
         log('running anvi_init_bam: {}'.format(command))
         self._run_command(command)
         return sorted_raw_bam
 
     def run_anvi_profile(self, raw_sorted_bam):
-        command = 'anvi-profile '
-        command += '-i {} '.format(raw_sorted_bam)
-        command += '-c contigs.db '
-        command += '-T 10 '
+        threads = self.plan.threads('profile')
+        profile_dir = raw_sorted_bam.split('.bam')[0] + '_RAW'
+        # anvi-profile refuses to write into an existing output directory
+        self._remove_path(profile_dir)
+        command = Command(['anvi-profile',
+                           '-i', raw_sorted_bam,
+                           '-c', 'contigs.db',
+                           '-o', profile_dir,
+                           '-T', threads], threads=threads)
 
         log('running anvi-profile: {}'.format(command))
         self._run_command(command)
+        return profile_dir
 
-    def generate_alignment_bams_and_prep_for_anvio(self, task_params, assembly_clean):
+    def _sample_names(self, reads_manifest):
+        """
+        _sample_names: name of the bams and profile of every library, from the reads object
+                       name when it is known and the staged fastq file name otherwise; names
+                       taken already get a numeric suffix, so samples never share files
+
+        return: list of names, in reads_manifest order
         """
-            This function runs the selected read mapper and creates the
-            sorted and indexed bam files from sam files using samtools.
+        names = list()
+        for library in reads_manifest:
+            name = library.get('reads_name') or os.path.basename(
+                library['files'][0]['path']).split('.fastq')[0]
+            name = re.sub(r'[^A-Za-z0-9_.-]', '_', name)
+            unique_name, number = name, 1
+            while unique_name in names:
+                number += 1
+                unique_name = '{}_{}'.format(name, number)
+            names.append(unique_name)
+        return names
+
+    def map_sample(self, task_params, index, library, sample_name):
         """
+        map_sample: map one reads library straight into a sorted bam, index it and
+                    anvi-init-bam it
 
-        reads_list = task_params['reads_list']
+        with an artifact cache, bams of a reads object version already mapped against the
+        same assembly are restored instead, under the names of this sample.
 
-        (read_scratch_path, read_type) = self.stage_reads_list_file(reads_list)
+        return: (sorted_bam, raw_sorted_bam)
+        """
+        cache_key = self._sample_cache_key(task_params, library)
+        # mapper output is streamed into samtools sort, no sam file is written
+        sorted_bam = os.path.join(self.scratch, sample_name + '_sorted.bam')
+        raw_sorted_bam = sorted_bam + '-RAW.bam'
+        # cache entries name the files by their role, they are restored to this sample's paths
+        cached_files = {'sorted.bam': sorted_bam, 'sorted.bam.bai': sorted_bam + '.bai',
+                        'raw.bam': raw_sorted_bam, 'raw.bam.bai': raw_sorted_bam + '.bai'}
+
+        def run():
+            if cache_key is not None:
+                if self.cache.restore('sample_bam', cache_key, self.scratch,
+                                      targets=cached_files) is not None:
+                    log('Restored bams of {} from the artifact cache'.format(
+                        library['reads_ref']))
+                    return sorted_bam, raw_sorted_bam
+
+            staged = library
+            if not staged['files']:
+                # the cached bams were evicted since staging, download the reads after all
+                staged = dict(self.stage_reads([library['reads_ref']])[0],
+                              reads_upa=library['reads_upa'])
+            fastq = staged['files'][0]['path']
+            fastq_type = staged['read_type']
+
+            # interleaved libraries are mapped as pairs, everything else as single-end reads
+            self.run_read_mapping(task_params, index, fastq, fastq_type == 'interleaved',
+                                  sorted_bam)
+
+            self.index_sorted_bam(sorted_bam)
+
+            self.run_anvi_init_bam(sorted_bam)
+
+            if cache_key is not None:
+                self.cache.store('sample_bam', cache_key, cached_files)
+
+            return sorted_bam, raw_sorted_bam
+
+        stage_fingerprint = fingerprint([staged_file['md5'] for staged_file in library['files']],
+                                        library.get('reads_upa'), task_params['read_mapping_tool'],
+                                        sample_name, *self._index_files(index))
+        return tuple(self._checkpoint(
+            'map_sample:' + library['reads_ref'], stage_fingerprint, run,
+            lambda bams: [bams[0], bams[0] + '.bai', bams[1], bams[1] + '.bai']))
+
+    def profile_sample(self, raw_sorted_bam, cache_key=None):
+        """
+        profile_sample: anvi-profile one sample
 
-        sorted_bam_file_list = []
+        cache_key is the sample's bam cache key; combined with the contigs_db_hash of
+        contigs.db it identifies a cached profile that is restored instead.
 
-        # list of reads files, can be 1 or more. assuming reads are either type unpaired or interleaved
-        # will not handle unpaired forward and reverse reads input as seperate (non-interleaved) files
+        return: profile directory
+        """
+        contigs_db = os.path.join(self.scratch, 'contigs.db')
+
+        def run():
+            if cache_key is None:
+                return self.run_anvi_profile(raw_sorted_bam)
+
+            profile_key = ArtifactCache.key(cache_key, self._contigs_db_hash(contigs_db),
+                                            self.anvio_version, self.PROFILE_CACHE_LAYOUT)
+            profile_dir = raw_sorted_bam.split('.bam')[0] + '_RAW'
+
+            def build():
+                self.run_anvi_profile(raw_sorted_bam)
+                return {os.path.relpath(path, profile_dir): path
+                        for path in self._index_files(profile_dir)}
+
+            self._remove_path(profile_dir)
+            # entries hold paths relative to the profile directory, which is named after the
+            # sample and may differ when the same reads are profiled under another name.
+            # profile databases may be written to by later anvi'o commands, never hardlink them
+            self._cached_artifact('sample_profile', profile_key, profile_dir, build,
+                                  mutable=['PROFILE.db', 'AUXILIARY-DATA.db'])
+            return profile_dir
+
+        stage_fingerprint = fingerprint(raw_sorted_bam, contigs_db)
+        return self._checkpoint(
+            'profile_sample:' + os.path.basename(raw_sorted_bam), stage_fingerprint, run,
+            lambda profile_dir: [os.path.join(profile_dir, 'PROFILE.db')])
+
+    def _run_sample_pool(self, func, args_list):
+        """
+        _run_sample_pool: call func for every args tuple on a pool of plan.sample_workers
+                          workers, each running with the sample share of the current plan
+
+        the first failing sample fails the run: samples still queued are cancelled and the
+        commands of the running ones are terminated instead of being waited for.
+        """
+        plan = self.plan
+        sample_workers = max(1, min(plan.sample_workers, len(args_list)))
+        log('Processing {} samples with {} workers of {} threads each'.format(
+            len(args_list), sample_workers, plan.threads('mapping')))
+
+        with ThreadPoolExecutor(max_workers=sample_workers) as executor:
+            futures = [executor.submit(self.run_in_stage, self.stage_name, plan, func, *args)
+                       for args in args_list]
+            done, not_done = wait(futures, return_when=FIRST_EXCEPTION)
+            failed = [future for future in futures if future in done and future.exception()]
+            if failed:
+                log('Sample failed, cancelling {} samples still queued or running: {}'.format(
+                    len(not_done), failed[0].exception()))
+                for future in not_done:
+                    future.cancel()
+                self.runner.cancel()
+                # the samples cut short fail as well, report the one that failed first
+                raise failed[0].exception()
+            return [future.result() for future in futures]
+
+    def map_samples(self, task_params, index, reads_manifest):
+        """
+        map_samples: map every staged reads library against the index
+
+        return: list of (sorted_bam, raw_sorted_bam), in reads_manifest order
+        """
+        return self._run_sample_pool(self.map_sample,
+                                     [(task_params, index, library, sample_name)
+                                      for library, sample_name in zip(
+                                          reads_manifest, self._sample_names(reads_manifest))])
 
-        for i in range(len(read_scratch_path)):
-            fastq = read_scratch_path[i]
-            fastq_type = read_type[i]
+    def profile_samples(self, raw_sorted_bams, cache_keys=None):
+        """
+        profile_samples: anvi-profile every sample, then anvi-merge when there are several
+        """
+        cache_keys = cache_keys or [None] * len(raw_sorted_bams)
+        profile_dirs = self._run_sample_pool(self.profile_sample,
+                                             list(zip(raw_sorted_bams, cache_keys)))
 
-            sam = os.path.basename(fastq).split('.fastq')[0] + ".sam"
-            # sam = os.path.join(self.ANVIO_RESULT_DIRECTORY, sam)
+        if len(profile_dirs) > 1:
+            merged_profile = os.path.join(self.scratch, 'SAMPLES-MERGED', 'PROFILE.db')
+            stage_fingerprint = fingerprint(
+                *[os.path.join(profile_dir, 'PROFILE.db') for profile_dir in profile_dirs])
+            self._checkpoint('merge', stage_fingerprint,
+                             lambda: self.run_anvi_merge(profile_dirs),
+                             lambda result: [merged_profile])
 
-            if fastq_type == 'interleaved':  # make sure working - needs tests
-                log("Running interleaved read mapping mode")
-                self.run_read_mapping_interleaved_pairs_mode(task_params, assembly_clean, fastq, sam)
-            else:  # running read mapping in single-end mode
-                log("Running unpaired read mapping mode")
-                self.run_read_mapping_unpaired_mode(task_params, assembly_clean, fastq, sam)
+        return profile_dirs
 
-            sorted_bam = self.convert_sam_to_sorted_and_indexed_bam(sam)
+    def generate_alignment_bams_and_prep_for_anvio(self, task_params, assembly_clean):
+        """
+            This function runs the selected read mapper and streams its output
+            into sorted and indexed bam files using samtools.
 
-            sorted_bam_file_list.append(sorted_bam)
+            samples are processed by a pool of plan.sample_workers workers, each using its
+            share of the resource plan; anvi-merge runs once every sample is profiled.
+        """
 
-            raw_sorted_bam = self.run_anvi_init_bam(sorted_bam)
+        # reuse the libraries staged by run_anvio; only stage here when called on its own
+        reads_manifest = task_params.get('reads_manifest')
+        if reads_manifest is None:
+            reads_manifest = self.stage_reads(task_params['reads_list'])
 
-            self.run_anvi_profile(raw_sorted_bam)
+        # index the assembly once for all samples; run_anvio builds it before mapping starts
+        index = task_params.get('read_mapping_index')
+        if index is None:
+            index = self.build_read_mapping_index(task_params, assembly_clean)
 
-        if len(task_params['reads_list']) > 1:
-            self.run_anvi_merge()
+        # list of reads files, can be 1 or more. assuming reads are either type unpaired or interleaved
+        # will not handle unpaired forward and reverse reads input as seperate (non-interleaved) files
+
+        bams = self.map_samples(task_params, index, reads_manifest)
+
+        self.profile_samples([raw_sorted_bam for _, raw_sorted_bam in bams],
+                             [self._sample_cache_key(task_params, library)
+                              for library in reads_manifest])
 
-        return sorted_bam_file_list
+        return [sorted_bam for sorted_bam, _ in bams]
 
-    def run_anvi_merge(self):
-        command = 'anvi-merge '
-        command += '*/PROFILE.db '
-        command += '-o SAMPLES-MERGED '
-        command += '-c contigs.db '
-        command += '--enforce-hierarchical-clustering'
+    def run_anvi_merge(self, profile_dirs):
+        self._remove_path(os.path.join(self.scratch, 'SAMPLES-MERGED'))
+        threads = self.plan.threads('merge')
+        command = Command(['anvi-merge'] +
+                          [os.path.join(profile_dir, 'PROFILE.db')
+                           for profile_dir in profile_dirs] +
+                          ['-o', 'SAMPLES-MERGED',
+                           '-c', 'contigs.db',
+                           '--enforce-hierarchical-clustering'], threads=threads)
 
         log('running run_anvi_merge: {}'.format(command))
         self._run_command(command)
 
-    def run_anvi_run_hmms(self):
-        command = 'anvi-run-hmms '
-        command += '-c contigs.db '
-        command += '--num-threads {} '.format(self.MAPPING_THREADS)
-        command += '--quiet '.format(self.MAPPING_THREADS)
+    def run_anvi_run_hmms(self, contigs_db='contigs.db', threads=None):
+        threads = threads or self.plan.threads('annotation')
+        command = Command(['anvi-run-hmms',
+                           '-c', contigs_db,
+                           '--num-threads', threads,
+                           '--quiet'], threads=threads)
         log('running anvi_run_hmms: {}'.format(command))
         self._run_command(command)
 
-    def run_anvi_run_ncbi_cog(self, task_params):
-        command = 'anvi-run-ncbi-cogs '
-        command += '-c contigs.db '
-        command += '--num-threads {} '.format(self.MAPPING_THREADS)
-        if task_params['ncbi_cog_diamond_mode'] == 'sensitive':
-            command += '--sensitive '
-        command += '--cog-data-dir /data/anviodb/COG'
+    def run_anvi_run_ncbi_cog(self, task_params, contigs_db='contigs.db', threads=None):
+        threads = threads or self.plan.threads('annotation')
+        argv = ['anvi-run-ncbi-cogs',
+                '-c', contigs_db,
+                '--num-threads', threads]
+        if task_params.get('ncbi_cog_diamond_mode') == 'sensitive':
+            argv += ['--sensitive']
+        argv += ['--cog-data-dir', self.reference_data.source_dir('ncbi_cogs')]
+        command = Command(argv, threads=threads)
         log('running anvi_run_ncbi_cog: {}'.format(command))
         self._run_command(command)
 
-    def run_anvi_run_pfams(self):
-        command = 'anvi-run-pfams '
-        command += '-c contigs.db '
-        command += '--num-threads {} '.format(self.MAPPING_THREADS)
-        command += '--pfam-data-dir /data/anviodb/Pfam'
+    def run_anvi_run_pfams(self, contigs_db='contigs.db', threads=None):
+        threads = threads or self.plan.threads('annotation')
+        command = Command(['anvi-run-pfams',
+                           '-c', contigs_db,
+                           '--num-threads', threads,
+                           '--pfam-data-dir', self.reference_data.source_dir('pfams')],
+                          threads=threads)
         log('running anvi_run_pfams: {}'.format(command))
         self._run_command(command)
 
-    def run_anvi_run_kegg_kofams(self):
-        command = 'anvi-run-kegg-kofams '
-        command += '-c contigs.db '
-        command += '--num-threads {} '.format(self.MAPPING_THREADS)
-        command += '--kegg-data-dir /data/anviodb/KEGG'
+    def run_anvi_run_kegg_kofams(self, contigs_db='contigs.db', threads=None):
+        threads = threads or self.plan.threads('annotation')
+        command = Command(['anvi-run-kegg-kofams',
+                           '-c', contigs_db,
+                           '--num-threads', threads,
+                           '--kegg-data-dir', self.reference_data.source_dir('kegg_kofams')],
+                          threads=threads)
         log('running anvi_run_kegg_kofams: {}'.format(command))
         self._run_command(command)
 
-    def run_anvi_run_interacdome(self):
-        command = 'anvi-run-interacdome '
-        command += '-c contigs.db '
-        command += '--num-threads {} '.format(self.MAPPING_THREADS)
-        command += '--interacdome-dataset representable '
-        command += '-m 0.200000 '
-        command += '-f 0.5 '
-        command += '--interacdome-data-dir /data/anviodb/Interacdome'
+    def run_anvi_run_interacdome(self, contigs_db='contigs.db', threads=None):
+        threads = threads or self.plan.threads('annotation')
+        command = Command(['anvi-run-interacdome',
+                           '-c', contigs_db,
+                           '--num-threads', threads,
+                           '--interacdome-dataset', 'representable',
+                           '-m', '0.200000',
+                           '-f', '0.5',
+                           '--interacdome-data-dir',
+                           self.reference_data.source_dir('interacdome')], threads=threads)
         log('running anvi-run-interacdome: {}'.format(command))
         self._run_command(command)
 
-    def run_anvi_run_scg_taxonomy(self):
-        command = 'anvi-setup-scg-taxonomy -T 1 --reset && '
-        command += 'anvi-run-scg-taxonomy '
-        command += '-c contigs.db '
-        command += '--num-threads {} '.format(self.MAPPING_THREADS)
-        command += '-P 1 '
-        command += '--max-num-target-sequences 20 '
-        command += '--min-percent-identity 90.0 '
+    def run_anvi_run_scg_taxonomy(self, contigs_db='contigs.db', threads=None):
+        threads = threads or self.plan.threads('annotation')
+        data_dir = self.reference_data.ensure('scg_taxonomy', threads, self._run_command)
+        command = Command(['anvi-run-scg-taxonomy',
+                           '-c', contigs_db,
+                           '--num-threads', threads,
+                           '--scgs-taxonomy-data-dir', data_dir,
+                           '-P', 1,
+                           '--max-num-target-sequences', 20,
+                           '--min-percent-identity', '90.0'], threads=threads)
         log('running anvi-run-scg-taxonomy: {}'.format(command))
         self._run_command(command)
 
-    def run_anvi_scan_trnas(self):
-        command = 'anvi-setup-trna-taxonomy -T 1 --reset && '
-        command += 'anvi-scan-trnas '
-        command += '-c contigs.db '
-        command += '--num-threads {} '.format(self.MAPPING_THREADS)
-        command += '--trna-cutoff-score 20'
+    def run_anvi_scan_trnas(self, contigs_db='contigs.db', threads=None):
+        threads = threads or self.plan.threads('annotation')
+        command = Command(['anvi-scan-trnas',
+                           '-c', contigs_db,
+                           '--num-threads', threads,
+                           '--trna-cutoff-score', 20], threads=threads)
         log('running anvi-scan-trnas: {}'.format(command))
         self._run_command(command)
 
-    def run_anvi_run_trna_taxonomy(self):
-        command = 'anvi-run-trna-taxonomy '
-        command += '-c contigs.db '
-        command += '--num-threads {} '.format(self.MAPPING_THREADS)
-        command += '--min-percent-identity 90.0 '
-        command += '--max-num-target-sequences 100 '
-        command += '-P 1'
+    def run_anvi_run_trna_taxonomy(self, contigs_db='contigs.db', threads=None):
+        threads = threads or self.plan.threads('annotation')
+        data_dir = self.reference_data.ensure('trna_taxonomy', threads, self._run_command)
+        command = Command(['anvi-run-trna-taxonomy',
+                           '-c', contigs_db,
+                           '--num-threads', threads,
+                           '--trna-taxonomy-data-dir', data_dir,
+                           '--min-percent-identity', '90.0',
+                           '--max-num-target-sequences', 100,
+                           '-P', 1], threads=threads)
         log('running anvi-run-trna-taxonomy: {}'.format(command))
         self._run_command(command)
 
+    def run_anvi_export_functions(self, contigs_db, functions_file):
+        command = Command(['anvi-export-functions',
+                           '-c', contigs_db,
+                           '-o', functions_file])
+        log('running anvi-export-functions: {}'.format(command))
+        self._run_command(command)
+
+    def run_anvi_import_functions(self, contigs_db, functions_file):
+        command = Command(['anvi-import-functions',
+                           '-c', contigs_db,
+                           '-i', functions_file])
+        log('running anvi-import-functions: {}'.format(command))
+        self._run_command(command)
+
     def generate_dummy_anvio_profile(self):
-        command = 'anvi-profile '
-        command += '-c contigs.db '
-        command += '--blank-profile '
-        command += '-o BLANK-PROFILE/ '
-        command += '-S BLANK'
+        self._remove_path(os.path.join(self.scratch, 'BLANK-PROFILE'))
+        command = Command(['anvi-profile',
+                           '-c', 'contigs.db',
+                           '--blank-profile',
+                           '-o', 'BLANK-PROFILE/',
+                           '-S', 'BLANK'])
         log('running anvi-profile: {}'.format(command))
         self._run_command(command)
 
-    def generate_output_file_list(self, result_directory):
+    def generate_output_file_list(self, result_directory, archive_format=None,
+                                  compression_level=None, packaging=None, output_directory=None):
         """
-        generate_output_file_list: zip result files and generate file_links for report
+        generate_output_file_list: archive the result files selected by the packaging profile
+                                   and generate file_links for report
+
+        the archive is written to output_directory, a new directory on scratch by default,
+        under a temporary name and renamed once complete.
         """
-        log('Start packing result files')
+        packaging = check_profile(packaging)
+        log('Start packing result files with the {} packaging profile'.format(packaging))
         output_files = list()
 
-        output_directory = os.path.join(self.scratch, str(uuid.uuid4()))
+        if output_directory is None:
+            output_directory = os.path.join(self.scratch, str(uuid.uuid4()))
         self._mkdir_p(output_directory)
-        result_file = os.path.join(output_directory, 'anvio_result.zip')
-
-        with zipfile.ZipFile(result_file, 'w', zipfile.ZIP_DEFLATED, allowZip64=True) as zip_file:
-
-            for dirname, subdirs, files in os.walk(result_directory):
-                for file in files:
-                    # if (file.endswith('.sam') or
-                    #     file.endswith('.bam') or
-                    #     file.endswith('.bai') or
-                    #    file.endswith('.summary')):
-                    #         continue
-                    # if (dirname.endswith(self.BINNER_BIN_RESULT_DIR)):
-                    #         continue
-                    zip_file.write(os.path.join(dirname, file), file)
-                if (dirname.endswith(self.BINNER_BIN_RESULT_DIR)):
-                    baseDir = os.path.basename(dirname)
-                    for file in files:
-                        full = os.path.join(dirname, file)
-                        zip_file.write(full, os.path.join(baseDir, file))
+
+        writer = ArchiveWriter(archive_format, compression_level, threads=self.plan.cpus,
+                               run_command=self._run_command, work_dir=self.scratch)
+        result_file = os.path.join(output_directory, 'anvio_result' + writer.extension)
+        tmp_file = os.path.join(output_directory, '.{}.{}.tmp'.format(
+            os.path.basename(result_file), uuid.uuid4()))
+
+        entries = catalog(result_directory,
+                          metadata_files=(self.COMMAND_LOG_DIRECTORY, CommandMetrics.METRICS_FILE,
+                                          CheckpointLedger.LEDGER_FILE, self.READS_MANIFEST_FILE),
+                          bin_dir=self.BINNER_BIN_RESULT_DIR)
+        members = select_members(entries, packaging)
+        log('Archiving {} of {} result files'.format(len(members), len(entries)))
+
+        try:
+            writer.write(tmp_file, members)
+            os.replace(tmp_file, result_file)
+        finally:
+            if os.path.lexists(tmp_file):
+                os.remove(tmp_file)
 
         output_files.append({'path': result_file,
                              'name': os.path.basename(result_file),
                              'label': os.path.basename(result_file),
-                             'description': 'Files generated by ANVIO App'})
+                             'description': 'Files generated by ANVIO App ({} packaging)'.format(
+                                 packaging)})
 
         return output_files
 
@@ -574,16 +1004,43 @@ class AnvioUtil:
     #                         'description': 'HTML summary report for kb_anvio App'})
     #     return html_report
 
+    def _link_to_result_directory(self, path, result_directory):
+        """
+        _link_to_result_directory: hardlink a file or directory into result_directory, copying
+                                   where it cannot be linked, and replace what an earlier
+                                   attempt placed there
+
+        the outputs stay where the checkpoint ledger recorded them, so a job resumed after a
+        failed packaging or export skips every pipeline stage. A source that is gone while its
+        destination exists was moved there by an earlier attempt.
+        """
+        destination = os.path.join(result_directory, os.path.basename(path.rstrip(os.sep)))
+        if not os.path.lexists(path) and os.path.lexists(destination):
+            log('{} was already moved to {}'.format(path, result_directory))
+            return destination
+        self._remove_path(destination)
+        if os.path.isdir(path):
+            shutil.copytree(path, destination, copy_function=link_or_copy)
+        else:
+            link_or_copy(path, destination)
+        return destination
+
     def move_files_to_output_folder(self, task_params):
-        shutil.move(os.path.join(self.scratch, "contigs.db"), os.path.join(self.scratch, "anvio_output_dir"))
-        shutil.move(os.path.join(self.scratch, task_params['contig_file_path']), os.path.join(self.scratch, "anvio_output_dir"))
+        result_directory = os.path.join(self.scratch, "anvio_output_dir")
+        paths = [os.path.join(self.scratch, "contigs.db"),
+                 os.path.join(self.scratch, task_params['contig_file_path'])]
+        for suffix in [self.REFORMAT_REPORT_SUFFIX, self.REFORMAT_STATS_SUFFIX]:
+            paths.append(os.path.join(self.scratch, task_params['contig_file_path'] + suffix))
         if len(task_params['reads_list']) > 1:
-            shutil.move(os.path.join(self.scratch, "SAMPLES-MERGED"), os.path.join(self.scratch, "anvio_output_dir"))
+            paths.append(os.path.join(self.scratch, "SAMPLES-MERGED"))
         elif len(task_params['reads_list']) == 1:
-            shutil.move(glob.glob(os.path.join(self.scratch,'*_RAW'))[0], os.path.join(self.scratch, "anvio_output_dir"))
+            profile_dirs = (glob.glob(os.path.join(self.scratch, '*_RAW')) or
+                            glob.glob(os.path.join(result_directory, '*_RAW')))
+            paths.append(os.path.join(self.scratch, os.path.basename(profile_dirs[0])))
         else:
-            shutil.move(os.path.join(self.scratch, "BLANK-PROFILE"), os.path.join(self.scratch, "anvio_output_dir"))
-
+            paths.append(os.path.join(self.scratch, "BLANK-PROFILE"))
+        for path in paths:
+            self._link_to_result_directory(path, result_directory)
 
     # def generate_overview_info(self, assembly_ref, result_directory):
     #     """
@@ -604,7 +1061,10 @@ class AnvioUtil:
 
     #     return (binned_contig_count, input_contig_count, total_bins_count)
 
-    def export_anvio_files_to_staging(self, ctx, file_to_staging):
+    def _staging_dir(self, ctx):
+        """
+        _staging_dir: the anvio_export directory of the user's staging area, created if needed
+        """
         #self.se.export_to_staging({'input_ref': INPUT_REF, 'workspace_name': WS_NAME, 'destination_dir' : DESTDIR})
         destination_dir = 'anvio_export'
         STAGING_GLOBAL_FILE_PREFIX = '/data/bulk/'
@@ -616,7 +1076,9 @@ class AnvioUtil:
             staging_dir_prefix = os.path.join(STAGING_GLOBAL_FILE_PREFIX, token_user)
         staging_dir = os.path.join(staging_dir_prefix, destination_dir)
         self._mkdir_p(staging_dir)
-        shutil.copy2(file_to_staging, staging_dir)
+        return staging_dir
+
+    def _grant_staging_service_access(self, paths):
         # This is a KBase specific hack to allow the staging service to delete the files and
         # folders written by this module. Currently the staging service runs as user 800 and
         # this module runs as root (bleah) so the staging service throws an error if the user
@@ -624,13 +1086,37 @@ class AnvioUtil:
         # so if we add write privs to the root group that solves the issue.
         # Longer term this app should not run as root and should chown ownership to the staging
         # service when it has a static user name vs. a number that might change.
-        basemode = os.stat(staging_dir).st_mode
-        self._recursive_chmod(staging_dir, basemode | stat.S_IWGRP)
-        
-        if not (set(os.listdir(staging_dir)) >= set(files)):
-            raise ValueError('Unexpected error occurred during copying files')
+        for path in paths:
+            os.chmod(path, os.stat(path).st_mode | stat.S_IWGRP)
+
+    def export_anvio_files_to_staging(self, ctx, file_to_staging):
+        """
+        export_anvio_files_to_staging: place the result archive in the user's staging area
+
+        the archive is hardlinked when staging is on the same filesystem as scratch, reflinked
+        where the filesystem supports it, and otherwise copied in blocks and verified by
+        checksum. It is placed under a temporary name and renamed, so the staging area never
+        shows a partial archive.
+
+        return: path of the staged archive
+        """
+        staging_dir = self._staging_dir(ctx)
+
+        file_name = os.path.basename(file_to_staging)
+        staged_file = os.path.join(staging_dir, file_name)
+        tmp_file = os.path.join(staging_dir, '.{}.{}.tmp'.format(file_name, uuid.uuid4()))
+        try:
+            method = link_or_copy(file_to_staging, tmp_file, verify=True)
+            os.replace(tmp_file, staged_file)
+        except (IOError, OSError) as e:
+            if os.path.lexists(tmp_file):
+                os.remove(tmp_file)
+            raise ValueError('Cannot export {} to {}: {}'.format(file_to_staging, staging_dir, e))
+        log('Exported {} to {} by {}'.format(file_to_staging, staged_file, method))
 
+        self._grant_staging_service_access([staging_dir, staged_file])
 
+        return staged_file
 
     def end_anvio(self, ctx, task_params):
         """
@@ -644,15 +1130,24 @@ class AnvioUtil:
 
         self.move_files_to_output_folder(task_params)
 
-        output_files = self.generate_output_file_list(task_params['result_directory'])
+        # in direct mode the archive is written once, straight into staging
+        staging_dir = self._staging_dir(ctx) if self.staging_export_mode == 'direct' else None
+        output_files = self.generate_output_file_list(task_params['result_directory'],
+                                                      task_params.get('archive_format'),
+                                                      task_params.get('archive_compression_level'),
+                                                      task_params.get('output_packaging'),
+                                                      output_directory=staging_dir)
 
-        
         log('Output_files')
         log(output_files)
 
         zip_file_path = str(output_files[0]['path'])
 
-        self.export_anvio_files_to_staging(ctx, zip_file_path)
+        if staging_dir is None:
+            self.export_anvio_files_to_staging(ctx, zip_file_path)
+        else:
+            log('Wrote {} directly to staging'.format(zip_file_path))
+            self._grant_staging_service_access([staging_dir, zip_file_path])
 
         returnVal = {
             'result_directory': zip_file_path,
@@ -695,6 +1190,167 @@ class AnvioUtil:
 
     #     return report_output
 
+    def _stage(self, plan, func):
+        """
+        _stage: wrap func as a StageGraph stage running with its own resource plan, named
+                after func
+        """
+        return lambda results: self.run_in_stage(func.__name__, plan, func, results)
+
+    def run_pipeline(self, task_params):
+        """
+        run_pipeline: run the anvio stages as a dependency graph
+
+            reads download || assembly download, then contigs.db generation || mapper index build
+            then read mapping || contigs.db annotation
+            then anvi-profile and anvi-merge (or a blank profile without reads)
+
+        stages that overlap split the cpus and memory of the run plan between them.
+        """
+        reads_list = task_params['reads_list']
+        contigs_db = os.path.join(self.scratch, 'contigs.db')
+        plan = self.plan
+        # the index build and read mapping overlap with contigs.db generation and annotation
+        shared_plan = plan.split(2) if reads_list else plan
+
+        def fetch_assembly(results):
+            # get assembly
+            contig_file = self._checkpoint(
+                'fetch_assembly', fingerprint(task_params['assembly_ref']),
+                lambda: self._get_contig_file(task_params['assembly_ref']),
+                lambda contig_file: [contig_file])
+            task_params['contig_file_path'] = contig_file
+            return contig_file
+
+        def reformat_fasta(results):
+            # decompresses, filters, renames and hashes the assembly in a single pass
+            contig_file = results['fetch_assembly']
+            assembly_reformatted = contig_file + '_anvio-reformatted'
+            stats_file = assembly_reformatted + self.REFORMAT_STATS_SUFFIX
+
+            self._checkpoint('reformat_fasta',
+                             fingerprint(contig_file, task_params['min_contig_length'],
+                                         FastaReformatter.VERSION),
+                             lambda: self.reformat_fasta(task_params)['contigs.fa'],
+                             lambda assembly_reformatted: [
+                                 assembly_reformatted, stats_file,
+                                 assembly_reformatted + self.REFORMAT_REPORT_SUFFIX])
+            task_params['contig_file_path'] = assembly_reformatted
+            # artifact cache entries are keyed by the assembly content, not its reference
+            with open(stats_file) as f:
+                task_params['assembly_hash'] = json.load(f)['sha256']
+            return assembly_reformatted
+
+        def gen_contigs_database(results):
+            def build():
+                self.run_anvi_gen_contigs_database(task_params)
+                return {'contigs.db': contigs_db}
+
+            def run():
+                # need to remove contigs.db file for local testing purposes
+                if os.path.exists('/kb/module/work/tmp/contigs.db'):
+                    os.remove('/kb/module/work/tmp/contigs.db')
+                self._remove_path(contigs_db)
+                # annotation writes into contigs.db, so it is never hardlinked to the cache.
+                # assembly_hash is the hash of the input assembly, the reformatter version
+                # stands in for how it was filtered and renamed
+                self._cached_artifact(
+                    'contigs_db',
+                    ArtifactCache.key(task_params.get('assembly_hash'),
+                                      task_params['min_contig_length'], FastaReformatter.VERSION,
+                                      task_params['contig_split_size'], task_params['kmer_size'],
+                                      self.anvio_version),
+                    self.scratch, build, mutable=['contigs.db'])
+
+            self._checkpoint('gen_contigs_database',
+                             fingerprint(results['reformat_fasta'],
+                                         task_params['contig_split_size'],
+                                         task_params['kmer_size']),
+                             run, lambda result: [contigs_db])
+
+        def annotate(results):
+            scheduler = AnnotationScheduler(self, contigs_db)
+            selected = [source.name for source in scheduler.selected_sources(task_params)]
+            self._checkpoint('annotate',
+                             fingerprint(self._fingerprint_of('gen_contigs_database'), selected,
+                                         task_params.get('ncbi_cog_diamond_mode')),
+                             lambda: scheduler.run(task_params), lambda result: [contigs_db])
+            # annotation writes into contigs.db, which is still the valid generated database
+            if self.ledger is not None:
+                self.ledger.refresh_outputs('gen_contigs_database')
+
+        def stage_reads(results):
+            task_params['reads_manifest'] = self.stage_uncached_reads(task_params, reads_list)
+            return task_params['reads_manifest']
+
+        def build_index(results):
+            mapper = get_mapper(task_params['read_mapping_tool'])[0]
+            index_dir = os.path.join(self.scratch, self.READ_MAPPING_INDEX_DIR)
+            index = self._read_mapping_index(task_params['read_mapping_tool'])
+
+            def build():
+                self.build_read_mapping_index(task_params, results['reformat_fasta'])
+                return {os.path.relpath(path, index_dir): path
+                        for path in self._index_files(index)}
+
+            def run():
+                self._cached_artifact(
+                    'read_mapping_index',
+                    ArtifactCache.key(task_params.get('assembly_hash'),
+                                      task_params['min_contig_length'], FastaReformatter.VERSION,
+                                      mapper.name, mapper.version()),
+                    index_dir, build)
+                return index
+
+            self._checkpoint('build_index',
+                             fingerprint(results['reformat_fasta'],
+                                         task_params['read_mapping_tool']),
+                             run, self._index_files)
+            task_params['read_mapping_index'] = index
+            return index
+
+        def map_samples(results):
+            return self.map_samples(task_params, results['build_index'], results['stage_reads'])
+
+        def profile_samples(results):
+            self.profile_samples([raw_sorted_bam for _, raw_sorted_bam in results['map_samples']],
+                                 [self._sample_cache_key(task_params, library)
+                                  for library in results['stage_reads']])
+
+        def blank_profile(results):
+            self._checkpoint('blank_profile', fingerprint(contigs_db),
+                             self.generate_dummy_anvio_profile,
+                             lambda result: [os.path.join(self.scratch, 'BLANK-PROFILE',
+                                                          'PROFILE.db')])
+
+        # the first failing stage terminates the commands of the stages still running
+        graph = StageGraph(plan.cpus, on_failure=lambda error: self.runner.cancel())
+        # downloads only wait on the network, so they claim no threads
+        graph.add_stage('fetch_assembly', self._stage(plan, fetch_assembly), threads=0)
+        graph.add_stage('reformat_fasta', self._stage(plan, reformat_fasta),
+                        needs=['fetch_assembly'])
+        graph.add_stage('gen_contigs_database', self._stage(shared_plan, gen_contigs_database),
+                        needs=['reformat_fasta'], threads=shared_plan.cpus)
+        if reads_list:
+            # cached samples are looked up by assembly hash, so reads wait for the assembly
+            graph.add_stage('stage_reads', self._stage(plan, stage_reads),
+                            needs=['reformat_fasta'] if self.cache is not None else [], threads=0)
+            graph.add_stage('build_index', self._stage(shared_plan, build_index),
+                            needs=['reformat_fasta'], threads=shared_plan.cpus)
+            graph.add_stage('map_samples', self._stage(shared_plan, map_samples),
+                            needs=['stage_reads', 'build_index'], threads=shared_plan.cpus)
+        graph.add_stage('annotate', self._stage(shared_plan, annotate),
+                        needs=['gen_contigs_database'], threads=shared_plan.cpus)
+        # anvi-profile reads contigs.db, so it waits for annotation to finish writing it
+        if reads_list:
+            graph.add_stage('profile_samples', self._stage(plan, profile_samples),
+                            needs=['map_samples', 'annotate'], threads=plan.cpus)
+        else:
+            graph.add_stage('blank_profile', self._stage(plan, blank_profile),
+                            needs=['annotate'], threads=plan.cpus)
+
+        return graph.run()
+
     def run_anvio(self, ctx, task_params):
         """
         run_anvio: anvio app
@@ -716,60 +1372,48 @@ class AnvioUtil:
 
         self._validate_run_anvio_params(task_params)
 
-        # get assembly
-        contig_file = self._get_contig_file(task_params['assembly_ref'])
-        task_params['contig_file_path'] = contig_file
+        self.plan = ResourcePlan.from_host(num_samples=len(task_params['reads_list']),
+                                           sample_workers=task_params.get('sample_workers'),
+                                           read_mapping_tool=task_params['read_mapping_tool'])
+        log('Resource plan:\n{}'.format(self.plan))
+
+        # fail before any work when reference data is missing, and have the indexes of the
+        # selected annotation read from storage while the reads are mapped
+        annotation_sources = [source.name for source in AnnotationScheduler(
+            self, os.path.join(self.scratch, 'contigs.db')).selected_sources(task_params)]
+        self.reference_data.require(annotation_sources)
+        self.reference_data.warm(annotation_sources)
 
         # prep result directory
         result_directory = os.path.join(self.scratch, self.ANVIO_RESULT_DIRECTORY)
         self._mkdir_p(result_directory)
 
+        # stages completed by an earlier attempt on the same scratch are skipped
+        self.ledger = CheckpointLedger(result_directory)
+        self.runner.log_directory = os.path.join(result_directory, self.COMMAND_LOG_DIRECTORY)
+
         cwd = os.getcwd()
         log('changing working dir to {}'.format(result_directory))
         os.chdir(result_directory)
 
-        assembly_reformatted = self.run_anvi_script_reformat_fasta(task_params)
-        task_params['contig_file_path'] = assembly_reformatted
-
-        # need to remove contigs.db file for local testing purposes
-        if os.path.exists('/kb/module/work/tmp/contigs.db'):
-            os.remove('/kb/module/work/tmp/contigs.db')
-
-        self.run_anvi_gen_contigs_database(task_params)
-
-        #self.run_anvi_run_hmms()
-
-        #self.run_anvi_run_ncbi_cog(task_params)
-
-        #self.run_anvi_run_pfams()
-
-        # self.run_anvi_run_kegg_kofams()
-
-        # self.run_anvi_run_interacdome()
-
-        #self.run_anvi_run_scg_taxonomy()
-
-        if task_params['trna_run'] == 'yes':
-            self.run_anvi_scan_trnas()
-            self.run_anvi_run_trna_taxonomy()
-
-        # get reads
-        if task_params['reads_list']:
-            (reads_list_file, read_type) = self.stage_reads_list_file(task_params['reads_list'])
-            task_params['read_type'] = read_type
-            task_params['reads_list_file'] = reads_list_file
-            self.generate_alignment_bams_and_prep_for_anvio(task_params, assembly_reformatted)
-        else:
-            self.generate_dummy_anvio_profile()
+        self.run_pipeline(task_params)
 
         # file handling and management
         os.chdir(cwd)
         log('changing working dir to {}'.format(cwd))
 
+        # written before packaging so the archive holds the pipeline metrics
+        self.metrics.write(result_directory)
+
         log('Saved result files to: {}'.format(result_directory))
         log('Generated files:\n{}'.format('\n'.join(os.listdir(result_directory))))
 
-        returnVal = self.end_anvio(ctx, task_params)
+        with self.metrics.measure('end_anvio', 'package and export results'):
+            returnVal = self.run_in_stage('end_anvio', self.plan, self.end_anvio, ctx, task_params)
+
+        metrics_path = self.metrics.write(result_directory)
+        log('Command metrics per stage (details in {}):\n{}'.format(
+            metrics_path, self.metrics.summary_table()))
 
         return returnVal
 
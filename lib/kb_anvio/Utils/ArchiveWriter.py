@@ -0,0 +1,169 @@
+import os
+import shutil
+import uuid
+import zipfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from kb_anvio.Utils.CommandRunner import Command, Pipeline
+from kb_anvio.Utils.Log import log
+
+ARCHIVE_FORMATS = ('zip', 'tar.zst')
+
+# default and allowed compression levels per format
+DEFAULT_LEVELS = {'zip': 6, 'tar.zst': 3}
+LEVEL_RANGES = {'zip': (0, 9), 'tar.zst': (1, 19)}
+
+# formats that do not shrink any further, stored in zip archives as they are
+STORED_EXTENSIONS = ('.bam', '.bai', '.csi', '.gz', '.bz2', '.xz', '.zst', '.zip')
+
+# members are read in chunks of CHUNK_SIZE by a pool of threads ahead of the writer
+CHUNK_SIZE = 1 << 20
+
+
+def _read_chunk(path, offset, size):
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        return f.read(size)
+
+
+def _set_compress_level(zinfo, level):
+    """
+    _set_compress_level: deflate level of a member written through ZipFile.open; ZipInfo
+                         carries it as compress_level since python 3.13, as _compresslevel
+                         (set by ZipFile.write) from 3.7, python 3.6 always deflates at 6
+    """
+    if hasattr(zinfo, 'compress_level'):
+        zinfo.compress_level = level
+    else:
+        zinfo._compresslevel = level
+
+
+class ArchiveWriter(object):
+    """
+    ArchiveWriter: write result files to a zip or tar.zst archive
+
+    zip archives are written in one pass through the streaming ZipFile.open(zinfo, 'w'):
+    a thread pool reads the members ahead in chunks while the calling thread deflates them
+    into the archive. Formats that are already compressed (BAM, index and gzip files) are
+    stored without recompression.
+
+    tar.zst archives are streamed by tar into multi-threaded zstd through run_command, so
+    the external commands are logged and measured like every other command of the run.
+    """
+
+    def __init__(self, archive_format=None, level=None, threads=1, run_command=None,
+                 work_dir=None):
+        self.archive_format = archive_format or 'zip'
+        if self.archive_format not in ARCHIVE_FORMATS:
+            raise ValueError('Unknown archive format: {}, expected one of {}'.format(
+                self.archive_format, ', '.join(ARCHIVE_FORMATS)))
+        if level is None or level == '':
+            level = DEFAULT_LEVELS[self.archive_format]
+        low, high = LEVEL_RANGES[self.archive_format]
+        if not low <= int(level) <= high:
+            raise ValueError(
+                'Compression level of {} archives must be from {} to {}, got {}'.format(
+                    self.archive_format, low, high, level))
+        self.level = int(level)
+        self.threads = max(1, int(threads))
+        self.run_command = run_command
+        # where tar.zst archives build their symlink tree, next to the archive by default
+        self.work_dir = work_dir
+
+    @property
+    def extension(self):
+        return '.' + self.archive_format
+
+    def write(self, archive_path, members):
+        """
+        write: write the archive from a list of (source path, name in the archive) pairs
+        """
+        log('Writing {} members to {} with {} threads, compression level {}'.format(
+            len(members), archive_path, self.threads, self.level))
+        if self.archive_format == 'zip':
+            self._write_zip(archive_path, members)
+        else:
+            self._write_tar_zst(archive_path, members)
+        return archive_path
+
+    def _stored(self, path):
+        return self.level == 0 or path.lower().endswith(STORED_EXTENSIONS)
+
+    def _chunks(self, members):
+        """
+        _chunks: (member index, path, offset, size) of every chunk in archive order
+        """
+        for index, (path, arcname) in enumerate(members):
+            file_size = os.path.getsize(path)
+            offset = 0
+            while True:
+                size = min(CHUNK_SIZE, file_size - offset)
+                yield index, path, offset, size
+                offset += size
+                if offset >= file_size:
+                    break
+
+    def _zip_info(self, path, arcname):
+        zinfo = zipfile.ZipInfo.from_file(path, arcname)
+        if self._stored(path):
+            zinfo.compress_type = zipfile.ZIP_STORED
+        else:
+            zinfo.compress_type = zipfile.ZIP_DEFLATED
+            _set_compress_level(zinfo, self.level)
+        # with the size known up front, zipfile decides on zip64 headers itself
+        zinfo.file_size = os.path.getsize(path)
+        return zinfo
+
+    def _write_zip(self, archive_path, members):
+        # a bounded window of chunks in flight keeps memory flat however large the members are
+        window = deque()
+        chunks = self._chunks(members)
+        with zipfile.ZipFile(archive_path, 'w', allowZip64=True) as zip_file, \
+                ThreadPoolExecutor(max_workers=self.threads) as executor:
+            member_file = None
+            try:
+                while True:
+                    while len(window) < 2 * self.threads:
+                        chunk = next(chunks, None)
+                        if chunk is None:
+                            break
+                        index, path, offset, size = chunk
+                        window.append((chunk, executor.submit(_read_chunk, path, offset, size)))
+                    if not window:
+                        break
+                    (index, path, offset, size), future = window.popleft()
+                    if offset == 0:
+                        if member_file is not None:
+                            member_file.close()
+                        member_file = zip_file.open(self._zip_info(*members[index]), 'w')
+                    member_file.write(future.result())
+            finally:
+                if member_file is not None:
+                    member_file.close()
+
+    def _write_tar_zst(self, archive_path, members):
+        """
+        _write_tar_zst: tar the members through a tree of symlinks named after their archive
+                        names, so members may be renamed without copying them
+        """
+        if self.run_command is None:
+            raise ValueError('tar.zst archives need a run_command to run tar and zstd')
+        link_dir = os.path.join(self.work_dir or os.path.dirname(archive_path),
+                                'archive_links_' + str(uuid.uuid4()))
+        os.makedirs(link_dir)
+        try:
+            for path, arcname in members:
+                link = os.path.join(link_dir, arcname)
+                os.makedirs(os.path.dirname(link), exist_ok=True)
+                if os.path.lexists(link):
+                    os.remove(link)
+                os.symlink(os.path.abspath(path), link)
+            self.run_command(Pipeline(
+                # tar refuses to create an archive from an empty argument list
+                Command(['tar', '--dereference', '-cf', '-', '-C', link_dir] +
+                        (sorted(os.listdir(link_dir)) or ['--files-from', os.devnull])),
+                Command(['zstd', '-T{}'.format(self.threads), '-{}'.format(self.level), '-q',
+                         '-f', '-o', archive_path], threads=self.threads)))
+        finally:
+            shutil.rmtree(link_dir, ignore_errors=True)
@@ -0,0 +1,243 @@
+import errno
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import time
+import uuid
+
+from kb_anvio.Utils.Log import log
+
+# ioctl request cloning one file's extents into another (btrfs, xfs, ...)
+FICLONE = 0x40049409
+
+GIB = 1 << 30
+
+COPY_BLOCK_SIZE = 8 << 20
+
+
+def content_hash(file_path, block_size=1 << 20):
+    """
+    content_hash: sha256 hex digest of a file's content
+    """
+    sha256 = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+def reflink(src, dst):
+    """
+    reflink: copy-on-write clone of src at dst; raises OSError where unsupported
+    """
+    with open(src, 'rb') as src_file, open(dst, 'wb') as dst_file:
+        try:
+            fcntl.ioctl(dst_file.fileno(), FICLONE, src_file.fileno())
+        except (IOError, OSError):
+            dst_file.close()
+            os.remove(dst)
+            raise
+    shutil.copystat(src, dst)
+
+
+def copy_verified(src, dst, block_size=COPY_BLOCK_SIZE):
+    """
+    copy_verified: copy src to dst in fixed size blocks and check the copy by checksum
+
+    the source is hashed while it is copied and the destination is read back once it is
+    synced to disk; a mismatch removes the destination and raises IOError.
+
+    return: sha256 hex digest of the content
+    """
+    source_hash = hashlib.sha256()
+    with open(src, 'rb') as src_file, open(dst, 'wb') as dst_file:
+        for block in iter(lambda: src_file.read(block_size), b''):
+            source_hash.update(block)
+            dst_file.write(block)
+        dst_file.flush()
+        os.fsync(dst_file.fileno())
+    shutil.copystat(src, dst)
+    if content_hash(dst, block_size) != source_hash.hexdigest():
+        os.remove(dst)
+        raise IOError('Checksum of {} does not match its source {}'.format(dst, src))
+    return source_hash.hexdigest()
+
+
+def link_or_copy(src, dst, mutable=False, verify=False):
+    """
+    link_or_copy: place src at dst as cheaply as possible
+
+    hardlink first, then reflink, then a plain copy. Files that will be modified in place
+    (mutable) are never hardlinked, since that would modify the source as well. With verify
+    the copy is checked against the source checksum (see copy_verified).
+
+    return: 'hardlink', 'reflink' or 'copy'
+    """
+    if not mutable:
+        try:
+            os.link(src, dst)
+            return 'hardlink'
+        except OSError:
+            pass
+    try:
+        reflink(src, dst)
+        return 'reflink'
+    except (IOError, OSError):
+        pass
+    if verify:
+        copy_verified(src, dst)
+    else:
+        shutil.copy2(src, dst)
+    return 'copy'
+
+
+class ArtifactCache(object):
+    """
+    ArtifactCache: content-addressed store of pipeline artifacts shared between jobs
+
+    entries live under <root>/<kind>/<key> where key hashes the assembly content and every
+    parameter the artifact depends on. Entries are written to a temporary directory and
+    renamed into place, so readers never see half-written entries. Restoring uses hardlinks
+    or reflinks instead of copies, and the least recently used entries are evicted once the
+    cache grows past max_bytes.
+    """
+    META_FILE = 'meta.json'
+    FILES_DIR = 'files'
+    LOCK_FILE = '.lock'
+
+    def __init__(self, root, max_bytes):
+        self.root = root
+        self.max_bytes = int(max_bytes)
+        os.makedirs(self.root, exist_ok=True)
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        from_config: cache configured by artifact-cache-dir and artifact-cache-max-gb,
+                     None when unset or when the directory is not writable
+        """
+        root = config.get('artifact-cache-dir')
+        if not root:
+            return None
+        max_bytes = float(config.get('artifact-cache-max-gb') or 100) * GIB
+        try:
+            cache = cls(root, max_bytes)
+        except OSError as e:
+            log('Artifact cache disabled, cannot create {}: {}'.format(root, e))
+            return None
+        if not os.access(root, os.W_OK):
+            log('Artifact cache disabled, {} is not writable'.format(root))
+            return None
+        return cache
+
+    @staticmethod
+    def key(*parts):
+        """
+        key: cache key for an artifact from the assembly hash and its parameters
+        """
+        return hashlib.sha256(json.dumps(parts, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def _entry_dir(self, kind, key):
+        return os.path.join(self.root, kind, key)
+
+    def contains(self, kind, key):
+        """
+        contains: whether an entry is currently cached; it may still be evicted before it
+                  is restored
+        """
+        return os.path.isfile(os.path.join(self._entry_dir(kind, key), self.META_FILE))
+
+    def restore(self, kind, key, dest_dir, mutable=(), targets=None):
+        """
+        restore: place the files of a cached entry under dest_dir
+
+        targets optionally maps file names to a different destination path. Files named in
+        mutable are reflinked or copied, never hardlinked.
+
+        return: dict of file name to restored path, None on a cache miss
+        """
+        entry_dir = self._entry_dir(kind, key)
+        meta_path = os.path.join(entry_dir, self.META_FILE)
+        try:
+            with open(meta_path) as f:
+                meta = json.load(f)
+            restored = dict()
+            for name in meta['files']:
+                src = os.path.join(entry_dir, self.FILES_DIR, name)
+                dst = (targets or {}).get(name) or os.path.join(dest_dir, name)
+                os.makedirs(os.path.dirname(dst), exist_ok=True)
+                if os.path.lexists(dst):
+                    os.remove(dst)
+                method = link_or_copy(src, dst, mutable=name in mutable)
+                log('Restored cached {} {} by {}'.format(kind, name, method))
+                restored[name] = dst
+            # the meta file's mtime marks when the entry was last used
+            os.utime(meta_path, None)
+        except (IOError, OSError, ValueError) as e:
+            if getattr(e, 'errno', None) != errno.ENOENT:
+                log('Ignoring unusable {} cache entry {}: {}'.format(kind, key, e))
+            return None
+        return restored
+
+    def store(self, kind, key, files, mutable=()):
+        """
+        store: add an entry from a dict of file name (relative path) to source path
+
+        files named in mutable will still change in place after this call, so they are
+        reflinked or copied into the cache rather than hardlinked.
+        """
+        entry_dir = self._entry_dir(kind, key)
+        if os.path.isdir(entry_dir):
+            return
+        tmp_dir = os.path.join(self.root, kind, '.tmp-' + str(uuid.uuid4()))
+        try:
+            size = 0
+            for name, src in files.items():
+                dst = os.path.join(tmp_dir, self.FILES_DIR, name)
+                os.makedirs(os.path.dirname(dst), exist_ok=True)
+                link_or_copy(src, dst, mutable=name in mutable)
+                size += os.path.getsize(dst)
+            with open(os.path.join(tmp_dir, self.META_FILE), 'w') as f:
+                json.dump({'kind': kind, 'key': key, 'files': sorted(files), 'size': size,
+                           'created_at': time.time()}, f, indent=1)
+            os.rename(tmp_dir, entry_dir)
+            log('Stored {} in artifact cache as {}'.format(kind, key))
+        except OSError as e:
+            # another job stored the same entry first, or the volume is full
+            log('Could not store {} in artifact cache: {}'.format(kind, e))
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            return
+        self.evict()
+
+    def _entries(self):
+        entries = list()
+        for kind in os.listdir(self.root):
+            kind_dir = os.path.join(self.root, kind)
+            if not os.path.isdir(kind_dir):
+                continue
+            for key in os.listdir(kind_dir):
+                meta_path = os.path.join(kind_dir, key, self.META_FILE)
+                try:
+                    with open(meta_path) as f:
+                        size = json.load(f)['size']
+                    entries.append((os.path.getmtime(meta_path), size, os.path.join(kind_dir, key)))
+                except (IOError, OSError, ValueError, KeyError):
+                    continue
+        return entries
+
+    def evict(self):
+        """
+        evict: remove least recently used entries until the cache fits in max_bytes
+        """
+        with open(os.path.join(self.root, self.LOCK_FILE), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            entries = sorted(self._entries())
+            total = sum(size for _, size, _ in entries)
+            for last_used, size, entry_dir in entries:
+                if total <= self.max_bytes:
+                    break
+                log('Evicting artifact cache entry {}'.format(entry_dir))
+                shutil.rmtree(entry_dir, ignore_errors=True)
+                total -= size
@@ -0,0 +1,102 @@
+import hashlib
+import json
+import os
+import threading
+import time
+
+
+def _file_state(path):
+    """
+    _file_state: size and modification time identifying the current content of a file
+    """
+    stat = os.stat(path)
+    return {'size': stat.st_size, 'mtime': stat.st_mtime}
+
+
+def fingerprint(*inputs):
+    """
+    fingerprint: hash of stage inputs
+
+    strings naming an existing file contribute the file's path, size and modification time,
+    everything else contributes its JSON form.
+    """
+    state = list()
+    for value in inputs:
+        if isinstance(value, str) and os.path.isfile(value):
+            state.append({'file': os.path.abspath(value), 'state': _file_state(value)})
+        else:
+            state.append(value)
+    return hashlib.sha256(json.dumps(state, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+class CheckpointLedger(object):
+    """
+    CheckpointLedger: record of completed pipeline stages kept in the result directory
+
+    every entry holds the fingerprint of the stage inputs, the state of its output files and
+    the stage result. A stage is complete when its fingerprint matches and every output file
+    still has the recorded size and modification time, so a rerun on the same scratch can
+    skip it.
+    """
+    LEDGER_FILE = 'checkpoints.json'
+
+    def __init__(self, result_directory):
+        self.ledger_path = os.path.join(result_directory, self.LEDGER_FILE)
+        self._lock = threading.Lock()
+        self.entries = dict()
+        if os.path.isfile(self.ledger_path):
+            with open(self.ledger_path) as f:
+                self.entries = json.load(f)
+
+    def _save(self):
+        tmp_path = self.ledger_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.entries, f, indent=1, sort_keys=True)
+        os.replace(tmp_path, self.ledger_path)
+
+    def _outputs_unchanged(self, entry):
+        for path, state in entry['outputs'].items():
+            if not os.path.isfile(path) or _file_state(path) != state:
+                return False
+        return True
+
+    def is_complete(self, stage, stage_fingerprint):
+        with self._lock:
+            entry = self.entries.get(stage)
+            return (entry is not None and entry['fingerprint'] == stage_fingerprint and
+                    self._outputs_unchanged(entry))
+
+    def fingerprint_of(self, stage):
+        with self._lock:
+            entry = self.entries.get(stage)
+            return entry['fingerprint'] if entry else None
+
+    def result(self, stage):
+        with self._lock:
+            return self.entries[stage]['result']
+
+    def record(self, stage, stage_fingerprint, outputs, result=None):
+        with self._lock:
+            self.entries[stage] = {'fingerprint': stage_fingerprint,
+                                   'outputs': {os.path.abspath(path): _file_state(path)
+                                               for path in outputs},
+                                   'result': result,
+                                   'completed_at': time.time()}
+            self._save()
+
+    def refresh_outputs(self, stage):
+        """
+        refresh_outputs: accept the current state of a stage's outputs, for outputs that a
+                         later stage legitimately modifies in place
+        """
+        with self._lock:
+            entry = self.entries.get(stage)
+            if entry is None:
+                return
+            entry['outputs'] = {path: _file_state(path) for path in entry['outputs']}
+            self._save()
+
+    def invalidate(self, stage):
+        with self._lock:
+            if self.entries.pop(stage, None) is not None:
+                self._save()
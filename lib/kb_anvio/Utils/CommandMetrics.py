@@ -0,0 +1,132 @@
+import json
+import os
+import resource
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+# ru_inblock and ru_oublock count 512 byte blocks
+BLOCK_SIZE = 512
+
+
+def exit_code(status):
+    """
+    exit_code: Popen style return code from a wait status, negative for a signal
+    """
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+def _usage(rusage):
+    return {'user_seconds': rusage.ru_utime,
+            'sys_seconds': rusage.ru_stime,
+            # ru_maxrss is in kilobytes on linux
+            'max_rss_mb': rusage.ru_maxrss / 1024.0,
+            'read_bytes': rusage.ru_inblock * BLOCK_SIZE,
+            'write_bytes': rusage.ru_oublock * BLOCK_SIZE}
+
+
+class CommandMetrics(object):
+    """
+    CommandMetrics: wall time, cpu time, peak memory and block i/o of every external command
+
+    CommandRunner records one entry per process, pipeline stages included, from the rusage
+    os.wait4 returns. In-process work such as packaging is recorded with measure(). Entries
+    are grouped by pipeline stage for the metrics JSON in the result directory and the
+    summary table logged at the end of run_anvio.
+    """
+    METRICS_FILE = 'command_metrics.json'
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.commands = list()
+
+    def record(self, stage, command, started_at, wall_seconds, rusage, returncode):
+        entry = OrderedDict([('stage', stage or 'unstaged'),
+                             ('command', command),
+                             ('started_at', started_at),
+                             ('wall_seconds', wall_seconds),
+                             ('exit_code', returncode)])
+        entry.update(_usage(rusage))
+        with self._lock:
+            self.commands.append(entry)
+        return entry
+
+    @contextmanager
+    def measure(self, stage, label):
+        """
+        measure: record the work done by this python process inside the with block
+
+        cpu time and i/o are process wide, so work of concurrent threads is included.
+        """
+        started_at = time.time()
+        before = _usage(resource.getrusage(resource.RUSAGE_SELF))
+        returncode = 0
+        try:
+            yield
+        except Exception:
+            returncode = 1
+            raise
+        finally:
+            after = _usage(resource.getrusage(resource.RUSAGE_SELF))
+            entry = OrderedDict([('stage', stage),
+                                 ('command', label),
+                                 ('started_at', started_at),
+                                 ('wall_seconds', time.time() - started_at),
+                                 ('exit_code', returncode)])
+            for key in after:
+                # peak memory is a high-water mark, the other counters are cumulative
+                entry[key] = after[key] if key == 'max_rss_mb' else after[key] - before[key]
+            with self._lock:
+                self.commands.append(entry)
+
+    def stage_totals(self):
+        """
+        stage_totals: metrics summed per stage, in the order stages first ran; max_rss_mb is
+                      the largest peak of any command of the stage
+        """
+        totals = OrderedDict()
+        with self._lock:
+            commands = sorted(self.commands, key=lambda entry: entry['started_at'])
+        for entry in commands:
+            stage = totals.setdefault(entry['stage'], OrderedDict([
+                ('commands', 0), ('wall_seconds', 0.0), ('user_seconds', 0.0),
+                ('sys_seconds', 0.0), ('max_rss_mb', 0.0), ('read_bytes', 0),
+                ('write_bytes', 0), ('first_started_at', entry['started_at']),
+                ('last_finished_at', 0.0)]))
+            stage['commands'] += 1
+            for key in ['wall_seconds', 'user_seconds', 'sys_seconds', 'read_bytes', 'write_bytes']:
+                stage[key] += entry[key]
+            stage['max_rss_mb'] = max(stage['max_rss_mb'], entry['max_rss_mb'])
+            stage['last_finished_at'] = max(stage['last_finished_at'],
+                                            entry['started_at'] + entry['wall_seconds'])
+        return totals
+
+    def write(self, result_directory):
+        """
+        write: save per-stage totals and every command to METRICS_FILE in result_directory
+        """
+        metrics_path = os.path.join(result_directory, self.METRICS_FILE)
+        with self._lock:
+            commands = list(self.commands)
+        with open(metrics_path, 'w') as f:
+            json.dump({'stages': self.stage_totals(), 'commands': commands}, f, indent=1)
+        return metrics_path
+
+    def summary_table(self):
+        """
+        summary_table: one line per stage; elapsed is the span from the first command of a
+                       stage starting to its last finishing, wall sums concurrent commands
+        """
+        lines = ['{:<32}{:>6}{:>11}{:>11}{:>11}{:>11}{:>11}{:>11}'.format(
+            'stage', 'cmds', 'elapsed_s', 'wall_s', 'user_s', 'sys_s', 'rss_mb', 'io_mb')]
+        for name, stage in self.stage_totals().items():
+            lines.append('{:<32}{:>6}{:>11.1f}{:>11.1f}{:>11.1f}{:>11.1f}{:>11.0f}{:>11.0f}'.format(
+                name[:31], stage['commands'],
+                stage['last_finished_at'] - stage['first_started_at'],
+                stage['wall_seconds'], stage['user_seconds'], stage['sys_seconds'],
+                stage['max_rss_mb'],
+                (stage['read_bytes'] + stage['write_bytes']) / float(1 << 20)))
+        return '\n'.join(lines)
@@ -0,0 +1,259 @@
+import os
+import shlex
+import signal
+import subprocess
+import threading
+import time
+from collections import deque
+
+from kb_anvio.Utils.CommandMetrics import exit_code
+from kb_anvio.Utils.Log import log
+
+POLL_INTERVAL = 0.1
+# time a process group gets to exit after SIGTERM before it is killed
+TERMINATE_GRACE_SECONDS = 10
+TAIL_LINES = 200
+
+
+class Command(object):
+    """
+    Command: argv of one process, with extra environment variables and a thread count
+
+    threads caps the implicit thread pools of the numerical libraries a tool may load, so a
+    process stays within the threads the resource plan gave it.
+    """
+    THREAD_ENV = ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS',
+                  'NUMEXPR_NUM_THREADS')
+
+    def __init__(self, argv, env=None, threads=None):
+        self.argv = [str(arg) for arg in argv]
+        self.env = dict(env or {})
+        self.threads = threads
+
+    def environ(self):
+        environ = dict(os.environ)
+        if self.threads:
+            for name in self.THREAD_ENV:
+                environ[name] = str(self.threads)
+        environ.update((name, str(value)) for name, value in self.env.items())
+        return environ
+
+    def __str__(self):
+        return ' '.join(shlex.quote(arg) for arg in self.argv)
+
+
+class Pipeline(object):
+    """
+    Pipeline: commands whose stdout feeds the stdin of the next one through an OS pipe
+    """
+
+    def __init__(self, *commands):
+        self.commands = [command if isinstance(command, Command) else Command(command)
+                         for command in commands]
+
+    def __str__(self):
+        return ' | '.join(str(command) for command in self.commands)
+
+
+class CommandError(ValueError):
+    """
+    CommandError: a command failed, timed out or was cancelled; tail holds its last output lines
+    """
+
+    def __init__(self, message, returncode, tail):
+        super(CommandError, self).__init__(message)
+        self.returncode = returncode
+        self.tail = tail
+
+
+class CommandRunner(object):
+    """
+    CommandRunner: run commands and pipelines with their output streamed as it is produced
+
+    every process is started from its argv, without a shell. Pipeline stages are connected
+    by OS pipes and each one is waited for on its own, so the exit status, wall time and
+    resource usage (from os.wait4) of every stage is checked and recorded; a failing stage in
+    the middle of a pipeline is not masked by a succeeding last stage.
+
+    stderr of every stage and stdout of the last one are read line by line and copied to the
+    job log and to <log_directory>/<stage>.log, while only a bounded tail of recent lines is
+    kept in memory for error messages. Every process runs in its own process group, so a
+    timeout or cancel() also terminates anything the tools started themselves.
+    """
+
+    def __init__(self, metrics, log_directory=None, timeout=None, tail_lines=TAIL_LINES):
+        self.metrics = metrics
+        self.log_directory = log_directory
+        self.timeout = timeout
+        self.tail_lines = tail_lines
+        self._lock = threading.Lock()
+        self._running = set()
+        self._cancelled = threading.Event()
+
+    def _stage_log_path(self, stage):
+        if not self.log_directory:
+            return None
+        os.makedirs(self.log_directory, exist_ok=True)
+        name = (stage or 'unstaged').replace(os.sep, '_').replace(':', '_')
+        return os.path.join(self.log_directory, name + '.log')
+
+    def _pump(self, stream, prefix, stage_log, tail):
+        """
+        _pump: copy one output stream of a process to the log, the stage log and the tail
+        """
+        for raw_line in iter(stream.readline, b''):
+            line = prefix + raw_line.decode('utf-8', 'replace').rstrip('\r\n')
+            tail.append(line)
+            print(line)
+            if stage_log is not None:
+                with self._lock:
+                    stage_log.write(line + '\n')
+                    stage_log.flush()
+        stream.close()
+
+    def _signal(self, process, sig):
+        try:
+            os.killpg(process.pid, sig)
+        except OSError:
+            pass
+
+    def cancel(self):
+        """
+        cancel: terminate every running command and refuse to start new ones
+
+        cancelling is final: every later run() of this runner raises CommandError. Each
+        AnvioUtil, so each job, has a runner of its own.
+        """
+        self._cancelled.set()
+        with self._lock:
+            running = list(self._running)
+        for process in running:
+            log('Cancelling process group {}'.format(process.pid))
+            self._signal(process, signal.SIGTERM)
+
+    def _start(self, pipeline, cwd):
+        """
+        _start: start every stage of pipeline, each reading the stdout of the previous one
+        """
+        processes = list()
+        try:
+            for command in pipeline.commands:
+                stdin = processes[-1].stdout if processes else subprocess.DEVNULL
+                process = subprocess.Popen(command.argv, cwd=cwd, env=command.environ(),
+                                           stdin=stdin, stdout=subprocess.PIPE,
+                                           stderr=subprocess.PIPE, start_new_session=True)
+                if processes:
+                    # only the next stage reads it now, so it gets SIGPIPE if that stage dies
+                    processes[-1].stdout.close()
+                processes.append(process)
+                with self._lock:
+                    self._running.add(process)
+        except OSError as e:
+            for process in processes:
+                self._signal(process, signal.SIGKILL)
+                process.wait()
+                with self._lock:
+                    self._running.discard(process)
+            raise CommandError('Cannot start {}: {}'.format(pipeline, e), None, [])
+        return processes
+
+    def _wait(self, processes, started_at, timeout):
+        """
+        _wait: reap every process of a pipeline, terminating all of them on timeout or cancel
+
+        return: dict of pid to (exit status, rusage, finished_at), and whether it timed out
+        """
+        results = dict()
+        timed_out = False
+        terminated_at = None
+        while len(results) < len(processes):
+            for process in processes:
+                if process.pid in results:
+                    continue
+                pid, status, rusage = os.wait4(process.pid, os.WNOHANG)
+                if pid:
+                    results[pid] = (status, rusage, time.time())
+                    with self._lock:
+                        self._running.discard(process)
+            if len(results) == len(processes):
+                break
+            if terminated_at is None:
+                if self._cancelled.is_set() or (timeout and time.time() - started_at > timeout):
+                    timed_out = not self._cancelled.is_set()
+                    for process in processes:
+                        self._signal(process, signal.SIGTERM)
+                    terminated_at = time.time()
+            elif time.time() - terminated_at > TERMINATE_GRACE_SECONDS:
+                for process in processes:
+                    self._signal(process, signal.SIGKILL)
+            time.sleep(POLL_INTERVAL)
+        return results, timed_out
+
+    def run(self, command, cwd, stage=None, timeout=None):
+        """
+        run: run a Command, Pipeline or argv list from cwd
+
+        return: the tail of the command output, a list of lines
+        raises CommandError when a process fails, times out or is cancelled
+        """
+        pipeline = command if isinstance(command, Pipeline) else Pipeline(command)
+        if self._cancelled.is_set():
+            raise CommandError('Not running command, the run was cancelled:\n{}'.format(pipeline),
+                               None, [])
+        timeout = timeout or self.timeout
+        tail = deque(maxlen=self.tail_lines)
+        stage_log_path = self._stage_log_path(stage)
+        stage_log = open(stage_log_path, 'a') if stage_log_path else None
+
+        started_at = time.time()
+        try:
+            processes = self._start(pipeline, cwd)
+            if stage_log is not None:
+                with self._lock:
+                    stage_log.write('$ {}\n'.format(pipeline))
+
+            streams = [(process.stderr, '[{} {} stderr] '.format(process.pid, cmd.argv[0]))
+                       for process, cmd in zip(processes, pipeline.commands)]
+            streams.append((processes[-1].stdout, '[{} {} stdout] '.format(
+                processes[-1].pid, pipeline.commands[-1].argv[0])))
+            pumps = [threading.Thread(target=self._pump, args=(stream, prefix, stage_log, tail))
+                     for stream, prefix in streams]
+            for pump in pumps:
+                pump.daemon = True
+                pump.start()
+
+            results, timed_out = self._wait(processes, started_at, timeout)
+            for pump in pumps:
+                pump.join()
+        finally:
+            if stage_log is not None:
+                stage_log.close()
+
+        failures = list()
+        for process, cmd in zip(processes, pipeline.commands):
+            status, rusage, finished_at = results[process.pid]
+            process.returncode = exit_code(status)
+            metrics = self.metrics.record(stage, str(cmd), started_at, finished_at - started_at,
+                                          rusage, process.returncode)
+            if process.returncode != 0:
+                failures.append((process.returncode, cmd))
+            else:
+                log('Executed command:\n{}\n'.format(cmd) +
+                    'Wall: {wall_seconds:.1f}s User: {user_seconds:.1f}s Sys: {sys_seconds:.1f}s '
+                    'Max RSS: {max_rss_mb:.0f}MB Read: {read_bytes}B '
+                    'Written: {write_bytes}B'.format(**metrics))
+
+        wall_seconds = time.time() - started_at
+        if timed_out:
+            raise CommandError('Command timed out after {:.0f}s:\n{}\nLast output:\n{}'.format(
+                wall_seconds, pipeline, '\n'.join(tail)), None, list(tail))
+        if failures:
+            # a stage killed by SIGPIPE only died because a later stage failed first
+            returncode, cmd = next((failure for failure in failures
+                                    if failure[0] != -signal.SIGPIPE), failures[0])
+            reason = 'was cancelled' if self._cancelled.is_set() else 'failed'
+            raise CommandError('Command {}:\n{}\nExit Code: {}\nPipeline:\n{}\n'
+                               'Last output:\n{}'.format(reason, cmd, returncode, pipeline,
+                                                          '\n'.join(tail)),
+                               returncode, list(tail))
+        return list(tail)
@@ -0,0 +1,179 @@
+import bz2
+import gzip
+import hashlib
+import json
+from array import array
+from collections import OrderedDict
+
+from kb_anvio.Utils.Log import log
+
+READ_SIZE = 1 << 20
+
+GZIP_MAGIC = b'\x1f\x8b'
+BZIP2_MAGIC = b'BZh'
+
+
+def open_assembly(path):
+    """
+    open_assembly: open a plain, gzip or bzip2 compressed FASTA file for binary reading,
+                   decompressing it on the fly
+    """
+    with open(path, 'rb') as f:
+        magic = f.read(3)
+    if magic.startswith(GZIP_MAGIC):
+        return gzip.open(path, 'rb')
+    if magic == BZIP2_MAGIC:
+        return bz2.open(path, 'rb')
+    return open(path, 'rb')
+
+
+class HashingReader(object):
+    """
+    HashingReader: binary file object wrapper hashing every byte read through readline
+    """
+
+    def __init__(self, handle):
+        self.handle = handle
+        self.sha256 = hashlib.sha256()
+
+    def readline(self, size=-1):
+        line = self.handle.readline(size)
+        self.sha256.update(line)
+        return line
+
+    def hexdigest(self):
+        return self.sha256.hexdigest()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.handle.close()
+        return False
+
+
+def n50(lengths):
+    """
+    n50: length of the contig at which the contigs sorted longest first reach half the total
+    """
+    half = sum(lengths) / 2.0
+    covered = 0
+    for length in sorted(lengths, reverse=True):
+        covered += length
+        if covered >= half:
+            return length
+    return 0
+
+
+class FastaReformatter(object):
+    """
+    FastaReformatter: in-process replacement of anvi-script-reformat-fasta --simplify-names
+
+    contigs shorter than min_length are dropped and the others renamed c_000000000001,
+    c_000000000002, ... in input order, exactly as anvi'o names them; the report maps every
+    new name to the original defline in anvi'o's tab separated report format.
+
+    the input, optionally compressed, is read once in lines of at most READ_SIZE bytes.
+    Sequence lines go straight to the output, which is rewound when a contig turns out to be
+    too short, so memory use does not depend on contig or assembly size. Length, N50 and GC
+    statistics and the sha256 of the decompressed input, which keys the artifact cache, are
+    gathered in the same pass.
+    """
+    # part of the artifact cache key, bump when the output changes
+    VERSION = 1
+
+    def __init__(self, min_length, prefix='c'):
+        self.min_length = int(min_length)
+        self.prefix = prefix
+
+    def reformat(self, fasta, output, report, stats_file=None):
+        """
+        reformat: write the filtered and renamed contigs of fasta to output
+
+        return: the statistics, also written to stats_file as JSON when given
+        """
+        reader = HashingReader(open_assembly(fasta))
+        stats = self.reformat_stream(reader, output, report)
+        stats['sha256'] = reader.hexdigest()
+        if stats_file:
+            with open(stats_file, 'w') as f:
+                json.dump(stats, f, indent=1)
+        log('Reformatted {}: kept {} of {} contigs of at least {} bp, {} bp in total, '
+            'N50 {}, GC {:.2%}'.format(fasta, stats['contigs_kept'], stats['contigs_read'],
+                                       self.min_length, stats['total_length'], stats['n50'],
+                                       stats['gc_content']))
+        return stats
+
+    def reformat_stream(self, handle, output, report):
+        """
+        reformat_stream: reformat the FASTA read from a binary file object, closing it when done
+        """
+        lengths = array('L')
+        counts = {'contigs_read': 0, 'gc': 0, 'at': 0, 'n': 0}
+        state = {'start': None, 'defline': None, 'length': 0, 'gc': 0, 'at': 0}
+
+        with handle, open(output, 'wb') as out, open(report, 'w') as report_file:
+
+            def finish_contig():
+                if state['defline'] is None:
+                    return
+                if state['length'] < self.min_length:
+                    # drop what was written of the contig
+                    out.seek(state['start'])
+                    out.truncate()
+                    return
+                out.write(b'\n')
+                lengths.append(state['length'])
+                counts['gc'] += state['gc']
+                counts['at'] += state['at']
+                counts['n'] += state['length'] - state['gc'] - state['at']
+                report_file.write('{}\t{}\n'.format(self._name(len(lengths)), state['defline']))
+
+            at_line_start = True
+            while True:
+                # sequences on a single line are read in pieces of bounded size
+                line = handle.readline(READ_SIZE)
+                if not line:
+                    break
+                line_start, at_line_start = at_line_start, line.endswith(b'\n')
+                if line_start and line.startswith(b'>'):
+                    while not at_line_start:
+                        rest = handle.readline(READ_SIZE)
+                        line += rest
+                        at_line_start = not rest or rest.endswith(b'\n')
+                    finish_contig()
+                    counts['contigs_read'] += 1
+                    state.update(start=out.tell(), length=0, gc=0, at=0,
+                                 defline=line[1:].rstrip(b'\r\n').decode('utf-8', 'replace'))
+                    # the name the contig gets if it is long enough
+                    out.write('>{}\n'.format(self._name(len(lengths) + 1)).encode())
+                    continue
+                if state['defline'] is None:
+                    if line.strip():
+                        raise ValueError('FASTA file does not start with a defline: {!r}'.format(
+                            line[:80]))
+                    continue
+                sequence = line.rstrip(b'\r\n')
+                out.write(sequence)
+                state['length'] += len(sequence)
+                state['gc'] += (sequence.count(b'G') + sequence.count(b'C') +
+                                sequence.count(b'g') + sequence.count(b'c'))
+                state['at'] += (sequence.count(b'A') + sequence.count(b'T') +
+                                sequence.count(b'a') + sequence.count(b't'))
+            finish_contig()
+
+        total_length = sum(lengths)
+        acgt = counts['gc'] + counts['at']
+        return OrderedDict([('min_contig_length', self.min_length),
+                            ('contigs_read', counts['contigs_read']),
+                            ('contigs_kept', len(lengths)),
+                            ('contigs_removed', counts['contigs_read'] - len(lengths)),
+                            ('total_length', total_length),
+                            ('min_length', min(lengths) if lengths else 0),
+                            ('max_length', max(lengths) if lengths else 0),
+                            ('n50', n50(lengths)),
+                            ('gc_content', counts['gc'] / float(acgt) if acgt else 0.0),
+                            ('ambiguous_bases', counts['n'])])
+
+    def _name(self, number):
+        return '{}_{:012d}'.format(self.prefix, number)
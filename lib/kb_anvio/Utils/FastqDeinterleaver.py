@@ -0,0 +1,236 @@
+import errno
+import fcntl
+import gzip
+import os
+import queue
+import shutil
+import threading
+import time
+import uuid
+
+from kb_anvio.Utils.Log import log
+
+GZIP_MAGIC = b'\x1f\x8b'
+
+# F_SETPIPE_SZ is not exported by the fcntl module before python 3.10
+F_SETPIPE_SZ = getattr(fcntl, 'F_SETPIPE_SZ', 1031)
+PIPE_SIZE = 1 << 20
+
+# records buffered per mate, slack for mappers that read one mate file ahead of the other
+QUEUE_RECORDS = 4096
+POLL_INTERVAL = 0.1
+
+
+def open_fastq(path):
+    """
+    open_fastq: open a plain or gzip compressed fastq file for binary reading
+    """
+    with open(path, 'rb') as f:
+        magic = f.read(2)
+    if magic == GZIP_MAGIC:
+        return gzip.open(path, 'rb')
+    return open(path, 'rb')
+
+
+def read_records(handle):
+    """
+    read_records: yield the 4 lines of every fastq record as one bytes object
+    """
+    record_number = 0
+    while True:
+        header = handle.readline()
+        if not header:
+            return
+        record_number += 1
+        sequence, separator, quality = handle.readline(), handle.readline(), handle.readline()
+        if not header.startswith(b'@') or not separator.startswith(b'+') or not quality:
+            raise ValueError('Malformed fastq record {}: {!r}'.format(record_number, header))
+        yield header + sequence + separator + quality
+
+
+def read_name(record):
+    """
+    read_name: name of the read a record belongs to, without its /1 or /2 mate suffix
+    """
+    name = record[1:record.index(b'\n')].split(None, 1)[0]
+    if name.endswith(b'/1') or name.endswith(b'/2'):
+        name = name[:-2]
+    return name
+
+
+class FastqDeinterleaver(object):
+    """
+    FastqDeinterleaver: split an interleaved fastq file into forward and reverse named pipes
+
+    a reader thread parses the (optionally gzipped) input and checks that every record is
+    followed by its mate; one writer thread per mate feeds its named pipe, so the mapper
+    reading both pipes starts straight away and no split copy of the reads hits scratch.
+
+    the pipes only buffer QUEUE_RECORDS records per mate, so the mapper has to read both
+    files in lockstep, a pair at a time, as bowtie2 and hisat2 do. A mapper reading the
+    whole forward file before it opens the reverse one would wait forever on the full
+    reverse buffer; for such mappers pass streaming=False, which splits the input into two
+    regular files on work_dir before the mapper starts.
+
+    used as a context manager around the mapper:
+
+        with FastqDeinterleaver(fastq, scratch) as (forward, reverse):
+            run mapper on forward and reverse
+
+    leaving the block waits for the split to finish and raises any input error. When the
+    mapper fails instead, the threads are cancelled so they never block on a dead reader.
+    """
+
+    def __init__(self, fastq, work_dir, streaming=True):
+        self.fastq = fastq
+        self.streaming = streaming
+        self.work_dir = os.path.join(work_dir, 'deinterleave_' + str(uuid.uuid4()))
+        basename = os.path.basename(fastq).split('.fastq')[0]
+        self.forward = os.path.join(self.work_dir, basename + '_forward.fastq')
+        self.reverse = os.path.join(self.work_dir, basename + '_reverse.fastq')
+        self._cancelled = threading.Event()
+        self._mapper_done = threading.Event()
+        self._errors = list()
+        self._threads = list()
+
+    def __enter__(self):
+        os.makedirs(self.work_dir)
+        if not self.streaming:
+            try:
+                self._split_to_files()
+            except Exception as e:
+                shutil.rmtree(self.work_dir, ignore_errors=True)
+                raise ValueError('Cannot deinterleave {}: {}'.format(self.fastq, e))
+            return self.forward, self.reverse
+
+        os.mkfifo(self.forward)
+        os.mkfifo(self.reverse)
+
+        queues = [queue.Queue(maxsize=QUEUE_RECORDS), queue.Queue(maxsize=QUEUE_RECORDS)]
+        self._threads = [
+            threading.Thread(target=self._guard, args=(self._split, queues)),
+            threading.Thread(target=self._guard, args=(self._write, self.forward, queues[0])),
+            threading.Thread(target=self._guard, args=(self._write, self.reverse, queues[1]))]
+        for thread in self._threads:
+            thread.daemon = True
+            thread.start()
+        return self.forward, self.reverse
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._mapper_done.set()
+        if exc_type is not None:
+            self.cancel()
+        try:
+            for thread in self._threads:
+                thread.join()
+        finally:
+            shutil.rmtree(self.work_dir, ignore_errors=True)
+        if exc_type is None and self._errors:
+            raise ValueError('Cannot deinterleave {}: {}'.format(self.fastq, self._errors[0]))
+        return False
+
+    def cancel(self):
+        """
+        cancel: stop splitting, for when the mapper reading the pipes has failed
+        """
+        self._cancelled.set()
+
+    def _guard(self, func, *args):
+        try:
+            func(*args)
+        except Exception as e:
+            if not self._cancelled.is_set():
+                log('Deinterleaving {} failed: {}'.format(self.fastq, e))
+                self._errors.append(e)
+            # an input error still lets the writers close their pipes, so the mapper sees EOF
+            # and is not left waiting; a writer error means the mapper went away
+            if func != self._split:
+                self._cancelled.set()
+
+    def _put(self, records, record):
+        while not self._cancelled.is_set():
+            try:
+                records.put(record, timeout=POLL_INTERVAL)
+                return
+            except queue.Full:
+                continue
+
+    def _pairs(self, handle):
+        """
+        _pairs: yield the (forward, reverse) records of every read pair, checking they are mates
+        """
+        pairs = 0
+        records = read_records(handle)
+        for forward in records:
+            reverse = next(records, None)
+            if reverse is None:
+                raise ValueError('odd number of records, last read {} has no mate'.format(
+                    read_name(forward).decode()))
+            if read_name(forward) != read_name(reverse):
+                raise ValueError('reads {} and {} of pair {} are not mates'.format(
+                    read_name(forward).decode(), read_name(reverse).decode(), pairs + 1))
+            pairs += 1
+            yield forward, reverse
+
+    def _split(self, queues):
+        pairs = 0
+        try:
+            with open_fastq(self.fastq) as handle:
+                for forward, reverse in self._pairs(handle):
+                    self._put(queues[0], forward)
+                    self._put(queues[1], reverse)
+                    pairs += 1
+                    if self._cancelled.is_set():
+                        return
+        finally:
+            # end of stream for both writers, also after an input error
+            for records in queues:
+                self._put(records, None)
+        log('Deinterleaved {} read pairs from {}'.format(pairs, self.fastq))
+
+    def _split_to_files(self):
+        pairs = 0
+        with open_fastq(self.fastq) as handle, open(self.forward, 'wb') as forward_file, \
+                open(self.reverse, 'wb') as reverse_file:
+            for forward, reverse in self._pairs(handle):
+                forward_file.write(forward)
+                reverse_file.write(reverse)
+                pairs += 1
+        log('Deinterleaved {} read pairs from {} into files'.format(pairs, self.fastq))
+
+    def _open_pipe(self, path):
+        """
+        _open_pipe: open a named pipe for writing once the mapper has opened it for reading,
+                    without blocking so the mapper may open its inputs in any order
+        """
+        while not self._cancelled.is_set():
+            try:
+                fd = os.open(path, os.O_WRONLY | os.O_NONBLOCK)
+            except OSError as e:
+                if e.errno != errno.ENXIO:
+                    raise
+                if self._mapper_done.is_set():
+                    raise ValueError('the mapper exited without reading {}'.format(path))
+                time.sleep(POLL_INTERVAL)
+                continue
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) & ~os.O_NONBLOCK)
+            try:
+                fcntl.fcntl(fd, F_SETPIPE_SZ, PIPE_SIZE)
+            except OSError:
+                pass
+            return os.fdopen(fd, 'wb')
+        return None
+
+    def _write(self, path, records):
+        pipe = self._open_pipe(path)
+        if pipe is None:
+            return
+        with pipe:
+            while not self._cancelled.is_set():
+                try:
+                    record = records.get(timeout=POLL_INTERVAL)
+                except queue.Empty:
+                    continue
+                if record is None:
+                    return
+                pipe.write(record)
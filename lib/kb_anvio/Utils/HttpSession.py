@@ -0,0 +1,133 @@
+import json
+import random
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from installed_clients.baseclient import BaseClient, ServerError
+
+from kb_anvio.Utils.Log import log
+
+DEFAULT_POOL_SIZE = 32
+DEFAULT_RETRIES = 5
+DEFAULT_RETRY_BACKOFF = 0.5
+RETRY_STATUS = frozenset([502, 503, 504])
+# requests that may be repeated after a read error or a gateway status. Every KBase JSON-RPC
+# call is a POST, and the server may already have run one whose answer was lost: a repeated
+# job submission or download runs twice, so a POST is only retried when it never reached
+# the server, on connect errors
+RETRY_METHODS = frozenset(['GET', 'HEAD'])
+
+
+def new_session(pool_size=DEFAULT_POOL_SIZE, retries=DEFAULT_RETRIES,
+                backoff_factor=DEFAULT_RETRY_BACKOFF):
+    """
+    new_session: requests session keeping pool_size connections per host alive, retrying
+                 connect errors of every request, and read errors and 502/503/504 responses
+                 of RETRY_METHODS, with exponential backoff of
+                 backoff_factor * 2 ** (attempt - 1) seconds
+    """
+    retry_args = dict(total=retries, connect=retries, read=retries, status=retries,
+                      status_forcelist=RETRY_STATUS, backoff_factor=backoff_factor,
+                      raise_on_status=False)
+    try:
+        retry = Retry(allowed_methods=RETRY_METHODS, **retry_args)
+    except TypeError:
+        # urllib3 before 1.26
+        retry = Retry(method_whitelist=RETRY_METHODS, **retry_args)
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def session_from_config(config):
+    """
+    session_from_config: new_session sized by the http-pool-size, http-retries and
+                         http-retry-backoff entries of deploy.cfg, defaults for unset ones
+    """
+    pool_size = int(config.get('http-pool-size') or DEFAULT_POOL_SIZE)
+    retries = int(config.get('http-retries') or DEFAULT_RETRIES)
+    backoff_factor = float(config.get('http-retry-backoff') or DEFAULT_RETRY_BACKOFF)
+    log('Service clients share an HTTP session of {} connections per host, {} retries'.format(
+        pool_size, retries))
+    return new_session(pool_size, retries, backoff_factor)
+
+
+class _SetEncoder(json.JSONEncoder):
+    """_SetEncoder: encodes sets as lists, like the generated clients do"""
+
+    def default(self, obj):
+        if isinstance(obj, (set, frozenset)):
+            return list(obj)
+        return json.JSONEncoder.default(self, obj)
+
+
+class SessionBaseClient(BaseClient):
+    """
+    SessionBaseClient: BaseClient sending its JSON-RPC calls through a requests session
+
+    the generated BaseClient posts every call with requests.post, a new connection each time
+    and no retries. This subclass answers calls the same way, through the session it is
+    given, so the service clients of a job share its connection pool and retry policy.
+    """
+
+    def __init__(self, url, session, **kwargs):
+        super(SessionBaseClient, self).__init__(url, **kwargs)
+        self.session = session
+
+    @classmethod
+    def from_client(cls, base_client, session):
+        """
+        from_client: SessionBaseClient with the url, token and settings of base_client
+        """
+        client = cls.__new__(cls)
+        client.__dict__.update(base_client.__dict__)
+        client.session = session
+        return client
+
+    def _call(self, url, method, params, context=None):
+        arg_hash = {'method': method,
+                    'params': params,
+                    'version': '1.1',
+                    'id': str(random.random())[2:]}
+        if context:
+            if type(context) is not dict:
+                raise ValueError('context is not type dict as required.')
+            arg_hash['context'] = context
+
+        body = json.dumps(arg_hash, cls=_SetEncoder)
+        ret = self.session.post(url, data=body, headers=self._headers, timeout=self.timeout,
+                                verify=not self.trust_all_ssl_certificates)
+        ret.encoding = 'utf-8'
+        if ret.status_code == 500:
+            if ret.headers.get('content-type') == 'application/json':
+                err = ret.json()
+                if 'error' in err:
+                    raise ServerError(**err['error'])
+                raise ServerError('Unknown', 0, ret.text)
+            raise ServerError('Unknown', 0, ret.text)
+        if not ret.ok:
+            ret.raise_for_status()
+        resp = ret.json()
+        if 'result' not in resp:
+            raise ServerError('Unknown', 0, 'An unknown server error occurred')
+        if not resp['result']:
+            return
+        if len(resp['result']) == 1:
+            return resp['result'][0]
+        return resp['result']
+
+
+def with_session(client, session):
+    """
+    with_session: have a generated service client (DataFileUtil, ReadsUtils, ...) send its
+                  calls through session; without a session the client is left as it is
+
+    return: client
+    """
+    if session is not None:
+        client._client = SessionBaseClient.from_client(client._client, session)
+    return client
@@ -0,0 +1,188 @@
+import subprocess
+from collections import OrderedDict
+
+# seconds a version query of a mapper may take
+VERSION_TIMEOUT = 60
+
+
+class Mapper(object):
+    """
+    Mapper: a read mapping backend
+
+    every backend declares the file name of its index, how it takes the pairs of an
+    interleaved fastq file ('interleaved' reads the file as is, 'split' needs separate
+    forward and reverse inputs), whether its mapping and its index build accept a random
+    seed, and builds the argv of its index build and mapping commands. 'split' backends that
+    read the forward and reverse files in lockstep get them through named pipes, the others
+    as regular files (see FastqDeinterleaver). Mapping commands write SAM to stdout, which
+    AnvioUtil streams straight into samtools sort. version_argv prints the tool version, which
+    keys the cached indexes and alignments it produced.
+    """
+    name = None
+    index_name = None
+    version_argv = None
+    paired_input = 'interleaved'
+    split_mates_in_lockstep = True
+    supports_seed = True
+    index_supports_seed = False
+    _version = None
+
+    def version(self):
+        """
+        version: the line of version_argv output naming the version, or its first line;
+                 'unknown' when the tool cannot be run
+        """
+        if self._version is None:
+            try:
+                output = subprocess.run(self.version_argv, stdout=subprocess.PIPE,
+                                        stderr=subprocess.STDOUT, stdin=subprocess.DEVNULL,
+                                        timeout=VERSION_TIMEOUT).stdout
+            except (OSError, subprocess.SubprocessError):
+                output = b''
+            lines = [line.strip() for line in output.decode('utf-8', 'replace').splitlines()
+                     if line.strip()]
+            self._version = next((line for line in lines if 'version' in line.lower()),
+                                 lines[0] if lines else 'unknown')
+        return self._version
+
+    def index_command(self, assembly, index, plan, seed):
+        """
+        index_command: argv building index from the assembly fasta
+        """
+        raise NotImplementedError
+
+    def map_command(self, index, reads, paired, plan, preset, seed):
+        """
+        map_command: argv mapping reads against index, writing SAM to stdout
+
+        reads holds one fastq file, or the forward and reverse files for 'split' backends.
+        preset holds the extra arguments of the read_mapping_tool variant.
+        """
+        raise NotImplementedError
+
+
+class BBMap(Mapper):
+    name = 'bbmap'
+    # bbmap writes its index under <path>/ref; mapping then runs with path= and no ref=
+    index_name = 'bbmap'
+    version_argv = ['bbmap.sh', '--version']
+    supports_seed = False
+
+    def index_command(self, assembly, index, plan, seed):
+        return ['bbmap.sh', '-Xmx{}'.format(plan.bbmap_mem),
+                'threads={}'.format(plan.threads('index')),
+                'ref={}'.format(assembly), 'path={}'.format(index), 'overwrite']
+
+    def map_command(self, index, reads, paired, plan, preset, seed):
+        return (['bbmap.sh', '-Xmx{}'.format(plan.bbmap_mem),
+                 'threads={}'.format(plan.threads('mapping')),
+                 'path={}'.format(index), 'in={}'.format(reads[0]), 'out=stdout.sam'] +
+                preset +
+                ['interleaved={}'.format('true' if paired else 'false'), 'mappedonly', 'overwrite'])
+
+
+class Bowtie2(Mapper):
+    name = 'bowtie2'
+    index_name = 'contigs.bt2'
+    version_argv = ['bowtie2', '--version']
+    index_supports_seed = True
+
+    def index_command(self, assembly, index, plan, seed):
+        return ['bowtie2-build', '-f', assembly, '--threads', str(plan.threads('index')),
+                '--seed', str(seed), index]
+
+    def map_command(self, index, reads, paired, plan, preset, seed):
+        if not paired:
+            inputs = ['-U', reads[0]]
+        elif len(reads) == 1:
+            inputs = ['--interleaved', reads[0]]
+        else:
+            inputs = ['-1', reads[0], '-2', reads[1]]
+        return (['bowtie2'] + preset + ['-x', index] + inputs +
+                ['--threads', str(plan.threads('mapping')), '--seed', str(seed)])
+
+
+class Minimap2(Mapper):
+    name = 'minimap2'
+    index_name = 'contigs.mmi'
+    version_argv = ['minimap2', '--version']
+
+    def index_command(self, assembly, index, plan, seed):
+        return ['minimap2', '-x', 'sr', '-t', str(plan.threads('index')), '-d', index, assembly]
+
+    def map_command(self, index, reads, paired, plan, preset, seed):
+        # -ax sr pairs adjacent reads of the same name in a single file
+        return (['minimap2', '-ax', 'sr', '-t', str(plan.threads('mapping')), '--seed', str(seed)] +
+                preset + [index] + reads)
+
+
+class Hisat2(Mapper):
+    name = 'hisat2'
+    index_name = 'contigs.ht2'
+    version_argv = ['hisat2', '--version']
+    paired_input = 'split'
+    index_supports_seed = True
+
+    def index_command(self, assembly, index, plan, seed):
+        return ['hisat2-build', '-p', str(plan.threads('index')), '--seed', str(seed),
+                assembly, index]
+
+    def map_command(self, index, reads, paired, plan, preset, seed):
+        if paired:
+            inputs = ['-1', reads[0], '-2', reads[1]]
+        else:
+            inputs = ['-U', reads[0]]
+        return (['hisat2'] + preset + ['-x', index] + inputs +
+                ['--seed', str(seed), '--threads', str(plan.threads('mapping'))])
+
+
+class Bwa(Mapper):
+    name = 'bwa'
+    index_name = 'contigs.bwa'
+    # bwa prints its version with the usage it shows when run without arguments
+    version_argv = ['bwa']
+    # bwa mem has no seed; a fixed -K batch size makes its output independent of threads
+    supports_seed = False
+    BATCH_BASES = 10000000
+
+    def index_command(self, assembly, index, plan, seed):
+        return ['bwa', 'index', '-p', index, assembly]
+
+    def map_command(self, index, reads, paired, plan, preset, seed):
+        return (['bwa', 'mem', '-t', str(plan.threads('mapping')), '-K', str(self.BATCH_BASES)] +
+                (['-p'] if paired else []) + preset + [index] + reads)
+
+
+MAPPERS = OrderedDict()
+
+# read_mapping_tool values offered by the app: (backend name, preset arguments)
+READ_MAPPING_TOOLS = OrderedDict()
+
+
+def register_mapper(mapper, presets):
+    """
+    register_mapper: add a backend and the read_mapping_tool values selecting it
+    """
+    MAPPERS[mapper.name] = mapper
+    for read_mapping_tool, preset in presets.items():
+        READ_MAPPING_TOOLS[read_mapping_tool] = (mapper.name, list(preset))
+
+
+def get_mapper(read_mapping_tool):
+    """
+    get_mapper: backend and preset arguments of a read_mapping_tool value
+    """
+    if read_mapping_tool not in READ_MAPPING_TOOLS:
+        raise ValueError('Unknown read mapping tool: {}'.format(read_mapping_tool))
+    name, preset = READ_MAPPING_TOOLS[read_mapping_tool]
+    return MAPPERS[name], list(preset)
+
+
+register_mapper(BBMap(), OrderedDict([('bbmap_fast', ['fast']),
+                                      ('bbmap_default', []),
+                                      ('bbmap_very_sensitive', ['vslow=true'])]))
+register_mapper(Bowtie2(), OrderedDict([('bowtie2_default', []),
+                                        ('bowtie2_very_sensitive', ['--very-sensitive'])]))
+register_mapper(Minimap2(), {'minimap2': []})
+register_mapper(Hisat2(), {'hisat2': []})
+register_mapper(Bwa(), {'bwa': []})
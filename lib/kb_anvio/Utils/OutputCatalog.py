@@ -0,0 +1,92 @@
+import os
+from collections import OrderedDict
+
+# packaging profiles and the artifact kinds each one archives
+PACKAGING_PROFILES = OrderedDict([
+    # what anvi-interactive needs to open the results without coverage details
+    ('minimal', ('contigs_db', 'profile_db')),
+    # everything anvi-interactive and anvi-summarize read, plus the assembly anvi'o used
+    ('anvio-interactive', ('contigs_db', 'profile_db', 'auxiliary_data', 'profile_log',
+                           'assembly', 'bins')),
+    # every file of the result directory
+    ('full', ('contigs_db', 'profile_db', 'auxiliary_data', 'profile_log', 'assembly', 'bins',
+              'alignments', 'run_metadata', 'other')),
+])
+DEFAULT_PROFILE = 'full'
+
+
+def check_profile(profile):
+    """
+    check_profile: the packaging profile to use, raising on an unknown one
+    """
+    profile = profile or DEFAULT_PROFILE
+    if profile not in PACKAGING_PROFILES:
+        raise ValueError('Unknown output packaging profile: {}, expected one of {}'.format(
+            profile, ', '.join(PACKAGING_PROFILES)))
+    return profile
+
+
+def artifact_kind(relpath, metadata_files=(), bin_dir='final_bins'):
+    """
+    artifact_kind: kind of a result file from its path relative to the result directory
+
+    metadata_files holds the names of the run metadata written next to the results
+    (command metrics, checkpoint ledger, reads manifest); the command logs directory is
+    named in it as well.
+    """
+    parts = relpath.split(os.sep)
+    name = parts[-1]
+    if relpath == 'contigs.db':
+        return 'contigs_db'
+    if name == 'PROFILE.db':
+        return 'profile_db'
+    if name == 'AUXILIARY-DATA.db':
+        return 'auxiliary_data'
+    if name == 'RUNLOG.txt':
+        return 'profile_log'
+    if name.endswith(('_anvio-reformatted', '_anvio-reformatted_report.txt',
+                      '_anvio-reformatted_stats.json')):
+        return 'assembly'
+    if bin_dir in parts[:-1]:
+        return 'bins'
+    if name.endswith(('.bam', '.bai')):
+        return 'alignments'
+    if name in metadata_files or parts[0] in metadata_files:
+        return 'run_metadata'
+    return 'other'
+
+
+def catalog(result_directory, metadata_files=(), bin_dir='final_bins'):
+    """
+    catalog: every file under result_directory once, in a stable order
+
+    files reached through more than one path (symlinks, hardlinks) are listed under the first
+    path only, so no content is archived twice.
+
+    return: OrderedDict of path relative to result_directory to (path, artifact kind)
+    """
+    entries = OrderedDict()
+    seen = set()
+    for dirname, subdirs, files in os.walk(result_directory):
+        subdirs.sort()
+        for file in sorted(files):
+            path = os.path.join(dirname, file)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                # dangling symlink
+                continue
+            if (stat.st_dev, stat.st_ino) in seen:
+                continue
+            seen.add((stat.st_dev, stat.st_ino))
+            relpath = os.path.relpath(path, result_directory)
+            entries[relpath] = (path, artifact_kind(relpath, metadata_files, bin_dir))
+    return entries
+
+
+def select_members(entries, profile):
+    """
+    select_members: (path, name in the archive) of the catalog entries a profile archives
+    """
+    kinds = PACKAGING_PROFILES[check_profile(profile)]
+    return [(path, relpath) for relpath, (path, kind) in entries.items() if kind in kinds]
@@ -0,0 +1,366 @@
+import argparse
+import fcntl
+import json
+import os
+import shutil
+import subprocess
+import time
+import threading
+import uuid
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from kb_anvio.Utils.ArtifactCache import content_hash
+from kb_anvio.Utils.CommandRunner import Command
+from kb_anvio.Utils.Log import log
+
+REFERENCE_ROOT = '/data/anviodb'
+
+# written into a database directory once it is complete; holds the anvi'o version the
+# database was built with and the size of every file
+READY_MARKER = '.kb_anvio_ready.json'
+
+ReferenceDatabase = namedtuple('ReferenceDatabase',
+                               ['name', 'directory', 'setup', 'data_dir_flag'])
+
+# reference databases built by this module, by name; the setup program and the run commands
+# of the database both take data_dir_flag
+DATABASES = OrderedDict([
+    ('scg_taxonomy', ReferenceDatabase('scg_taxonomy', 'SCG_TAXONOMY', 'anvi-setup-scg-taxonomy',
+                                       '--scgs-taxonomy-data-dir')),
+    ('trna_taxonomy', ReferenceDatabase('trna_taxonomy', 'TRNA_TAXONOMY',
+                                        'anvi-setup-trna-taxonomy', '--trna-taxonomy-data-dir')),
+])
+
+# directory of the reference data every annotation source reads, by AnnotationScheduler
+# source name, and the suffixes of its search indexes; hmms uses the data shipped with anvi'o
+ANNOTATION_DATA = OrderedDict([
+    ('scg_taxonomy', ('SCG_TAXONOMY', ('.dmnd',))),
+    ('trnas', ('TRNA_TAXONOMY', ('.dmnd',))),
+    ('interacdome', ('Interacdome', ('.h3f', '.h3i', '.h3m', '.h3p'))),
+    ('ncbi_cogs', ('COG', ('.dmnd',))),
+    ('pfams', ('Pfam', ('.h3f', '.h3i', '.h3m', '.h3p'))),
+    ('kegg_kofams', ('KEGG', ('.h3f', '.h3i', '.h3m', '.h3p'))),
+])
+
+# version, size and checksum of every reference file, written under the root by
+# `entrypoint.sh init` once all databases are set up
+MANIFEST_FILE = 'kb_anvio_manifest.json'
+
+WARM_BLOCK_SIZE = 8 << 20
+
+
+def anvio_version():
+    """
+    anvio_version: version of the installed anvi'o package, 'unknown' when it cannot be read
+    """
+    try:
+        import pkg_resources
+        return pkg_resources.get_distribution('anvio').version
+    except Exception:
+        return 'unknown'
+
+
+def _file_sizes(directory):
+    sizes = dict()
+    for dirname, subdirs, files in os.walk(directory):
+        for file in files:
+            path = os.path.join(dirname, file)
+            relpath = os.path.relpath(path, directory)
+            if relpath != READY_MARKER:
+                sizes[relpath] = os.path.getsize(path)
+    return sizes
+
+
+class ReferenceData(object):
+    """
+    ReferenceData: anvi'o reference databases built once into the shared data volume
+
+    `scripts/entrypoint.sh init` builds every database under root, where jobs find them
+    ready. A database counts as ready when its marker names the installed anvi'o version and
+    every file it lists is present with the recorded size. Jobs only build a database when
+    it is missing or stale: into root when it is writable, otherwise into fallback_root on
+    scratch for the job alone. Builds run under a lock shared by every process using root.
+
+    every build goes into a directory of its own, .<directory>.<build id>, and <directory>
+    is a symlink switched to the new build atomically. Jobs get the build directory itself,
+    so a job started before a rebuild keeps reading the build it started with; a build
+    is removed once a newer one replaces its successor.
+    """
+
+    def __init__(self, root=REFERENCE_ROOT, fallback_root=None):
+        self.root = root
+        self.fallback_root = fallback_root
+        self.version = anvio_version()
+        # annotation source name to None when its data is valid, or why it is not
+        self.status = None
+
+    def data_dir(self, name, root=None):
+        return os.path.join(root or self.root, DATABASES[name].directory)
+
+    def is_ready(self, name, root=None):
+        """
+        is_ready: whether a database is complete and was built by the installed anvi'o
+        """
+        data_dir = self.data_dir(name, root)
+        try:
+            with open(os.path.join(data_dir, READY_MARKER)) as f:
+                marker = json.load(f)
+        except (IOError, OSError, ValueError):
+            return False
+        if marker.get('anvio_version') != self.version:
+            log('Reference database {} was built by anvio {}, {} is installed'.format(
+                name, marker.get('anvio_version'), self.version))
+            return False
+        for relpath, size in marker.get('files', {}).items():
+            path = os.path.join(data_dir, relpath)
+            if not os.path.isfile(path) or os.path.getsize(path) != size:
+                log('Reference database {} is incomplete, {} is missing or changed'.format(
+                    name, path))
+                return False
+        return bool(marker.get('files'))
+
+    def setup(self, name, threads, run_command, root=None):
+        """
+        setup: build a database under root unless another process has built it meanwhile
+
+        return: the build directory of the database
+        """
+        root = root or self.root
+        os.makedirs(root, exist_ok=True)
+        database = DATABASES[name]
+        data_dir = self.data_dir(name, root)
+        with open(os.path.join(root, '.{}.lock'.format(database.directory)), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if self.is_ready(name, root):
+                return os.path.realpath(data_dir)
+            build_dir = os.path.join(root, '.{}.{}'.format(database.directory, uuid.uuid4()))
+            try:
+                log('Building reference database {} in {}'.format(name, build_dir))
+                run_command(Command([database.setup, database.data_dir_flag, build_dir,
+                                     '-T', threads, '--reset'], threads=threads))
+                files = _file_sizes(build_dir)
+                if not files:
+                    raise ValueError('{} wrote no files to {}'.format(database.setup, build_dir))
+                with open(os.path.join(build_dir, READY_MARKER), 'w') as f:
+                    json.dump({'name': name, 'anvio_version': self.version, 'files': files,
+                               'created_at': time.time()}, f, indent=1, sort_keys=True)
+                self._switch(database, data_dir, build_dir)
+            except Exception:
+                shutil.rmtree(build_dir, ignore_errors=True)
+                raise
+        return build_dir
+
+    def _switch(self, database, data_dir, build_dir):
+        """
+        _switch: point the data_dir symlink at build_dir, and remove the builds older than
+                 the one it replaces
+        """
+        root = os.path.dirname(data_dir)
+        if os.path.islink(data_dir):
+            replaced = os.path.join(root, os.readlink(data_dir))
+        elif os.path.isdir(data_dir):
+            # a database built before builds were versioned becomes a build of its own
+            replaced = os.path.join(root, '.{}.{}'.format(database.directory, uuid.uuid4()))
+            os.rename(data_dir, replaced)
+        else:
+            replaced = None
+        link = os.path.join(root, '.{}.link-{}'.format(database.directory, uuid.uuid4()))
+        os.symlink(os.path.basename(build_dir), link)
+        os.replace(link, data_dir)
+        log('Reference database {} switched to {}'.format(database.name, build_dir))
+
+        # older builds and leftovers of interrupted ones, jobs only get the current build and
+        # the one it replaced
+        for entry in os.listdir(root):
+            path = os.path.join(root, entry)
+            if (entry.startswith('.{}.'.format(database.directory)) and
+                    os.path.isdir(path) and not os.path.islink(path) and
+                    path not in (build_dir, replaced)):
+                log('Removing old build {} of reference database {}'.format(path, database.name))
+                shutil.rmtree(path, ignore_errors=True)
+
+    def source_dir(self, source):
+        """
+        source_dir: reference data directory of an annotation source
+        """
+        return os.path.join(self.root, ANNOTATION_DATA[source][0])
+
+    def manifest_path(self):
+        return os.path.join(self.root, MANIFEST_FILE)
+
+    def write_manifest(self, threads=1):
+        """
+        write_manifest: record the size and sha256 of every file of every annotation source
+                        whose reference data is present under root
+        """
+        directories = OrderedDict((directory, None) for directory, _ in ANNOTATION_DATA.values()
+                                  if os.path.isdir(os.path.join(self.root, directory)))
+        files = [(directory, relpath, os.path.join(self.root, directory, relpath))
+                 for directory in directories
+                 for relpath in sorted(_file_sizes(os.path.join(self.root, directory)))]
+        with ThreadPoolExecutor(max_workers=max(1, threads)) as executor:
+            checksums = list(executor.map(lambda file: content_hash(file[2]), files))
+
+        databases = OrderedDict((directory, OrderedDict()) for directory in directories)
+        for (directory, relpath, path), checksum in zip(files, checksums):
+            databases[directory][relpath] = {'size': os.path.getsize(path), 'sha256': checksum}
+
+        manifest_path = self.manifest_path()
+        tmp_path = '{}.tmp-{}'.format(manifest_path, uuid.uuid4())
+        with open(tmp_path, 'w') as f:
+            json.dump({'anvio_version': self.version, 'created_at': time.time(),
+                       'databases': databases}, f, indent=1)
+        os.replace(tmp_path, manifest_path)
+        log('Wrote reference manifest {} for {} files in {}'.format(
+            manifest_path, len(files), ', '.join(directories)))
+        return manifest_path
+
+    def validate(self, verify_checksums=False, threads=1):
+        """
+        validate: check the reference data of every annotation source against the manifest,
+                  by size or, with verify_checksums, by checksum as well; without a readable
+                  manifest no source is valid
+
+        return: dict of annotation source name to None when valid, else the reason it is not
+        """
+        try:
+            with open(self.manifest_path()) as f:
+                manifest = json.load(f)
+        except (IOError, OSError, ValueError) as e:
+            # without a manifest nothing tells a complete file from a truncated one; the data
+            # volume has to be set up again by `entrypoint.sh init`
+            problem = 'cannot read the reference manifest {}: {}'.format(self.manifest_path(), e)
+            log('Reference data cannot be validated, {}'.format(problem))
+            self.status = dict((source, problem) for source in ANNOTATION_DATA)
+            return self.status
+
+        self.status = dict()
+        for source, (directory, _) in ANNOTATION_DATA.items():
+            files = manifest['databases'].get(directory)
+            if not files:
+                self.status[source] = '{} is not in the reference manifest'.format(directory)
+                continue
+            problem = None
+            for relpath, entry in files.items():
+                path = os.path.join(self.root, directory, relpath)
+                if not os.path.isfile(path):
+                    problem = '{} is missing'.format(path)
+                elif os.path.getsize(path) != entry['size']:
+                    problem = '{} has size {}, the manifest records {}'.format(
+                        path, os.path.getsize(path), entry['size'])
+                if problem:
+                    break
+            if problem is None and verify_checksums:
+                relpaths = sorted(files)
+                paths = [os.path.join(self.root, directory, relpath) for relpath in relpaths]
+                with ThreadPoolExecutor(max_workers=max(1, threads)) as executor:
+                    checksums = list(executor.map(content_hash, paths))
+                for relpath, path, checksum in zip(relpaths, paths, checksums):
+                    if checksum != files[relpath]['sha256']:
+                        problem = '{} does not match its checksum'.format(path)
+                        break
+            self.status[source] = problem
+
+        if manifest.get('anvio_version') != self.version:
+            log('Reference manifest was written with anvio {}, {} is installed'.format(
+                manifest.get('anvio_version'), self.version))
+        log('Reference data status:\n{}'.format('\n'.join(
+            '{}: {}'.format(source, problem or 'ok')
+            for source, problem in sorted(self.status.items()))))
+        return self.status
+
+    def require(self, sources):
+        """
+        require: raise before any work starts when the reference data of a source is invalid
+
+        the taxonomy databases are exempt, jobs can build those themselves (see ensure).
+        """
+        if self.status is None:
+            self.validate()
+        buildable = set(database.directory for database in DATABASES.values())
+        problems = ['{}: {}'.format(source, self.status[source]) for source in sources
+                    if self.status.get(source) and ANNOTATION_DATA[source][0] not in buildable]
+        if problems:
+            raise ValueError('Reference data of the selected annotation is not usable:\n{}'.format(
+                '\n'.join(problems)))
+
+    def warm(self, sources):
+        """
+        warm: read the search indexes of sources into the page cache in a background thread,
+              so the searches start at full speed instead of waiting on cold storage
+        """
+        paths = list()
+        for source in sources:
+            if source not in ANNOTATION_DATA:
+                continue
+            directory, suffixes = ANNOTATION_DATA[source]
+            for dirname, subdirs, files in os.walk(os.path.join(self.root, directory)):
+                paths += [os.path.join(dirname, file) for file in sorted(files)
+                          if file.endswith(suffixes)]
+        if not paths:
+            return None
+        thread = threading.Thread(target=self._warm_files, args=(paths,))
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def _warm_files(self, paths):
+        started_at = time.time()
+        warmed = 0
+        for path in paths:
+            try:
+                with open(path, 'rb') as f:
+                    os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_WILLNEED)
+                    for block in iter(lambda: f.read(WARM_BLOCK_SIZE), b''):
+                        warmed += len(block)
+            except (IOError, OSError) as e:
+                log('Could not warm {}: {}'.format(path, e))
+        log('Warmed {} reference index files ({:.0f} MB) in {:.1f}s'.format(
+            len(paths), warmed / float(1 << 20), time.time() - started_at))
+
+    def ensure(self, name, threads, run_command):
+        """
+        ensure: directory of a ready database, building it first when needed
+
+        return: the build directory of the database, to pass to anvi'o with the database's
+                data_dir_flag
+        """
+        if self.is_ready(name):
+            return os.path.realpath(self.data_dir(name))
+        root = self.root
+        existing = self.root
+        while not os.path.isdir(existing):
+            existing = os.path.dirname(existing)
+        if not os.access(existing, os.W_OK):
+            if not self.fallback_root:
+                raise ValueError('Reference database {} is not ready in {}, which is not '
+                                 'writable'.format(name, self.root))
+            log('Reference database {} is not ready and {} is read only, building it in {} '
+                'for this job'.format(name, self.root, self.fallback_root))
+            root = self.fallback_root
+        return self.setup(name, threads, run_command, root)
+
+
+def _run_command(command):
+    log('Running {}'.format(command))
+    subprocess.check_call(command.argv, env=command.environ())
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Set up the anvio reference data')
+    parser.add_argument('command', choices=['setup', 'manifest'],
+                        help='setup builds the taxonomy databases, manifest records every '
+                             'annotation database once they are all in place')
+    parser.add_argument('--root', default=REFERENCE_ROOT)
+    parser.add_argument('--threads', type=int, default=4)
+    parser.add_argument('databases', nargs='*', default=list(DATABASES))
+    args = parser.parse_args()
+    reference_data = ReferenceData(args.root)
+    if args.command == 'manifest':
+        reference_data.write_manifest(args.threads)
+    else:
+        for database in args.databases:
+            reference_data.setup(database, args.threads, _run_command)
+            log('Reference database {} ready in {}'.format(
+                database, reference_data.data_dir(database)))
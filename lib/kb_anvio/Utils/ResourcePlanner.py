@@ -0,0 +1,200 @@
+import math
+import os
+
+GIB = 1 << 30
+MIB = 1 << 20
+
+# fallback when neither cgroup nor /proc/meminfo can be read
+DEFAULT_MEMORY = 8 * GIB
+
+# cgroup v1 reports "no limit" as a value close to 2^63
+UNLIMITED_MEMORY = 1 << 60
+
+
+def _read_first_line(path):
+    try:
+        with open(path) as f:
+            return f.readline().strip()
+    except (IOError, OSError):
+        return None
+
+
+def _cgroup_cpu_limit():
+    """
+    _cgroup_cpu_limit: number of cpus allowed by the cgroup cpu quota, None if unlimited
+    """
+    # cgroup v2: "<quota> <period>" or "max <period>"
+    cpu_max = _read_first_line('/sys/fs/cgroup/cpu.max')
+    if cpu_max:
+        quota, period = cpu_max.split()
+        if quota != 'max':
+            return max(1, int(math.ceil(float(quota) / float(period))))
+        return None
+
+    # cgroup v1: quota of -1 means unlimited
+    for cpu_dir in ['/sys/fs/cgroup/cpu', '/sys/fs/cgroup/cpu,cpuacct']:
+        quota = _read_first_line(os.path.join(cpu_dir, 'cpu.cfs_quota_us'))
+        period = _read_first_line(os.path.join(cpu_dir, 'cpu.cfs_period_us'))
+        if quota and period and int(quota) > 0:
+            return max(1, int(math.ceil(float(quota) / float(period))))
+    return None
+
+
+def _cgroup_memory_limit():
+    """
+    _cgroup_memory_limit: memory limit of the cgroup in bytes, None if unlimited
+    """
+    for path in ['/sys/fs/cgroup/memory.max', '/sys/fs/cgroup/memory/memory.limit_in_bytes']:
+        limit = _read_first_line(path)
+        if limit and limit != 'max' and int(limit) < UNLIMITED_MEMORY:
+            return int(limit)
+    return None
+
+
+def _meminfo_available():
+    """
+    _meminfo_available: MemAvailable (or MemTotal on old kernels) from /proc/meminfo in bytes
+    """
+    meminfo = dict()
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                key, value = line.split(':', 1)
+                meminfo[key] = int(value.split()[0]) * 1024
+    except (IOError, OSError, ValueError):
+        return None
+    return meminfo.get('MemAvailable', meminfo.get('MemTotal'))
+
+
+def available_cpus():
+    """
+    available_cpus: cpus this process may use, honouring cpu affinity and cgroup cpu quota
+    """
+    if hasattr(os, 'sched_getaffinity'):
+        cpus = len(os.sched_getaffinity(0))
+    else:
+        cpus = os.cpu_count() or 1
+    quota = _cgroup_cpu_limit()
+    if quota is not None:
+        cpus = min(cpus, quota)
+    return max(1, cpus)
+
+
+def available_memory():
+    """
+    available_memory: memory this process may use in bytes, the lower of the cgroup limit
+                      and the memory currently available on the node
+    """
+    limits = [limit for limit in [_cgroup_memory_limit(), _meminfo_available()] if limit]
+    if not limits:
+        return DEFAULT_MEMORY
+    return min(limits)
+
+
+class ResourcePlan(object):
+    """
+    ResourcePlan: thread counts and memory sizes for every pipeline stage, derived from the
+                  cpus and memory available to the job
+
+    whole-node stages (contigs.db generation, index build, annotation, merge) get every cpu.
+    per-sample stages (mapping, sort, anvi-init-bam, anvi-profile) get the share of one
+    sample worker, so sample_workers samples can run side by side without oversubscribing.
+    """
+    NODE_STAGES = ('contigs_db', 'index', 'annotation', 'merge')
+    SAMPLE_STAGES = ('mapping', 'sort', 'init_bam', 'profile')
+
+    MIN_SAMPLE_THREADS = 2
+    # memory a sample worker needs: bbmap holds the whole index in its heap
+    SAMPLE_MEMORY = 2 * GIB
+    BBMAP_SAMPLE_MEMORY = 8 * GIB
+    # fraction of the memory budget handed to tools, the rest is left for the OS and python
+    USABLE_MEMORY_FRACTION = 0.85
+    BBMAP_HEAP_FRACTION = 0.75
+    SORT_MEMORY_FRACTION = 0.15
+    MIN_SORT_MEMORY_PER_THREAD = 64 * MIB
+    MAX_SORT_MEMORY_PER_THREAD = 768 * MIB
+
+    def __init__(self, cpus, memory, num_samples=1, sample_workers=None, read_mapping_tool=None):
+        self.cpus = max(1, int(cpus))
+        self.memory = int(memory)
+        self.num_samples = max(1, int(num_samples))
+        self.read_mapping_tool = read_mapping_tool or ''
+        self.requested_sample_workers = sample_workers
+
+        if sample_workers:
+            self.sample_workers = int(sample_workers)
+        else:
+            self.sample_workers = self._default_sample_workers()
+        self.sample_workers = max(1, min(self.sample_workers, self.num_samples, self.cpus))
+
+        self.sample_threads = max(1, self.cpus // self.sample_workers)
+        self.sample_memory = int(self.memory * self.USABLE_MEMORY_FRACTION) // self.sample_workers
+
+    @classmethod
+    def from_host(cls, **kwargs):
+        """
+        from_host: plan for the cpus and memory this container can actually use
+        """
+        return cls(available_cpus(), available_memory(), **kwargs)
+
+    def _default_sample_workers(self):
+        if self.read_mapping_tool.startswith('bbmap'):
+            sample_memory = self.BBMAP_SAMPLE_MEMORY
+        else:
+            sample_memory = self.SAMPLE_MEMORY
+        by_cpu = self.cpus // self.MIN_SAMPLE_THREADS
+        by_memory = int(self.memory * self.USABLE_MEMORY_FRACTION) // sample_memory
+        return max(1, min(by_cpu, by_memory))
+
+    def threads(self, stage):
+        """
+        threads: thread count for a pipeline stage
+        """
+        if stage in self.NODE_STAGES:
+            return self.cpus
+        if stage in self.SAMPLE_STAGES:
+            return self.sample_threads
+        raise ValueError('Unknown pipeline stage: {}'.format(stage))
+
+    def split(self, workers):
+        """
+        split: plan for one of workers stages sharing this plan's resources concurrently
+        """
+        workers = max(1, int(workers))
+        return ResourcePlan(max(1, self.cpus // workers), self.memory // workers,
+                            num_samples=self.num_samples,
+                            sample_workers=self.requested_sample_workers,
+                            read_mapping_tool=self.read_mapping_tool)
+
+    @property
+    def bbmap_mem(self):
+        """
+        bbmap_mem: java heap for one bbmap process, as an -Xmx value
+        """
+        return '{}m'.format(max(1024, int(self.sample_memory * self.BBMAP_HEAP_FRACTION) // MIB))
+
+    @property
+    def sort_mem(self):
+        """
+        sort_mem: memory per samtools sort thread, as a -m value
+        """
+        per_thread = int(self.sample_memory * self.SORT_MEMORY_FRACTION) // self.sample_threads
+        per_thread = max(self.MIN_SORT_MEMORY_PER_THREAD,
+                         min(per_thread, self.MAX_SORT_MEMORY_PER_THREAD))
+        return '{}M'.format(per_thread // MIB)
+
+    def as_dict(self):
+        plan = {'cpus': self.cpus,
+                'memory_mb': self.memory // MIB,
+                'num_samples': self.num_samples,
+                'sample_workers': self.sample_workers,
+                'sample_memory_mb': self.sample_memory // MIB,
+                'bbmap_mem': self.bbmap_mem,
+                'sort_mem': self.sort_mem}
+        for stage in self.NODE_STAGES + self.SAMPLE_STAGES:
+            plan['threads_' + stage] = self.threads(stage)
+        return plan
+
+    def __str__(self):
+        return '\n'.join('{:<22}{}'.format(key, value)
+                         for key, value in sorted(self.as_dict().items()))
@@ -0,0 +1,94 @@
+import time
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from kb_anvio.Utils.Log import log
+
+
+class Stage(object):
+    """
+    Stage: one pipeline step, the stages whose outputs it needs and the threads it occupies
+
+    run is called with the dict of results of every finished stage and its return value
+    becomes this stage's result.
+    """
+
+    def __init__(self, name, run, needs=(), threads=1):
+        self.name = name
+        self.run = run
+        self.needs = tuple(needs)
+        self.threads = threads
+
+
+class StageGraph(object):
+    """
+    StageGraph: small DAG executor for the run_anvio pipeline
+
+    a stage starts as soon as every stage it needs has finished and the threads it claims fit
+    in the global thread budget, so independent branches run side by side. A stage is always
+    allowed to start when nothing else is running, so a single stage larger than the budget
+    cannot stall the graph. After a failure no new stage is started and on_failure, if given,
+    is called with the error so running stages can be cut short; running stages are waited
+    for and the first error is raised.
+    """
+
+    def __init__(self, max_threads, on_failure=None):
+        self.max_threads = max(1, int(max_threads))
+        self.on_failure = on_failure
+        self.stages = OrderedDict()
+
+    def add_stage(self, name, run, needs=(), threads=1):
+        """
+        add_stage: register a stage; the stages it needs must have been added already,
+                   which keeps the graph acyclic
+        """
+        if name in self.stages:
+            raise ValueError('Stage "{}" is already defined'.format(name))
+        for needed in needs:
+            if needed not in self.stages:
+                raise ValueError('Stage "{}" needs unknown stage "{}"'.format(name, needed))
+        self.stages[name] = Stage(name, run, needs, threads)
+
+    def _timed_run(self, stage, results):
+        start = time.time()
+        log('Starting stage {} ({} threads)'.format(stage.name, stage.threads))
+        result = stage.run(results)
+        log('Finished stage {} in {:.1f}s'.format(stage.name, time.time() - start))
+        return result
+
+    def run(self):
+        results = dict()
+        pending = list(self.stages.values())
+        running = dict()
+        threads_in_use = 0
+        error = None
+
+        with ThreadPoolExecutor(max_workers=max(1, len(self.stages))) as executor:
+            while running or (pending and error is None):
+                if error is None:
+                    for stage in list(pending):
+                        if not all(needed in results for needed in stage.needs):
+                            continue
+                        if running and threads_in_use + stage.threads > self.max_threads:
+                            continue
+                        future = executor.submit(self._timed_run, stage, results)
+                        running[future] = stage
+                        threads_in_use += stage.threads
+                        pending.remove(stage)
+
+                done, _ = wait(list(running), return_when=FIRST_COMPLETED)
+                for future in done:
+                    stage = running.pop(future)
+                    threads_in_use -= stage.threads
+                    try:
+                        results[stage.name] = future.result()
+                    except Exception as e:
+                        log('Stage {} failed: {}'.format(stage.name, e))
+                        if error is None:
+                            error = e
+                            if self.on_failure is not None:
+                                self.on_failure(e)
+
+        if error is not None:
+            raise error
+        return results
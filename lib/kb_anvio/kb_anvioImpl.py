@@ -4,6 +4,8 @@ import os
 import json
 
 from kb_anvio.Utils.AnvioUtil import AnvioUtil
+from kb_anvio.Utils.HttpSession import session_from_config
+from kb_anvio.Utils.ReferenceData import REFERENCE_ROOT, ReferenceData
 
 #END_HEADER
 
@@ -37,6 +39,15 @@ class kb_anvio:
         self.config = config
         self.config['SDK_CALLBACK_URL'] = os.environ['SDK_CALLBACK_URL']
         self.config['KB_AUTH_TOKEN'] = os.environ['KB_AUTH_TOKEN']
+        # every service client shares one pooled HTTP session
+        self.http_session = session_from_config(config)
+        # reference data is validated once here rather than by every job
+        self.reference_data = ReferenceData(
+            config.get('reference-data-dir') or REFERENCE_ROOT,
+            fallback_root=os.path.join(config['scratch'], 'anviodb'))
+        self.reference_data.validate(
+            verify_checksums=config.get('reference-data-verify-checksums') == 'true',
+            threads=os.cpu_count() or 1)
         #END_CONSTRUCTOR
         pass
 
@@ -53,6 +64,12 @@ class kb_anvio:
                 min_contig_length: minimum contig length; default 2500
                 contig_split_size: artifical contig splitting size for Anvio
                 kmer_size: minimum contig length; default 2500
+                sample_workers: number of reads samples processed concurrently
+                archive_format: zip or tar.zst; default zip
+                archive_compression_level: compression level of the result archive
+                output_packaging: minimal, anvio-interactive or full; default full
+                run_hmms, run_scg_taxonomy, run_ncbi_cogs, run_pfams, run_kegg_kofams,
+                run_interacdome: "yes" to run that annotation source; default "no"
 
         :returns: instance of type "AnvioResult" (result_folder: folder
             path that holds all files generated by run_kb_anvio report_name:
@@ -70,7 +87,8 @@ class kb_anvio:
             if isinstance(value, str):
                 params[key] = value.strip()
 
-        anvio_runner = AnvioUtil(self.config)
+        anvio_runner = AnvioUtil(self.config, reference_data=self.reference_data,
+                                 session=self.http_session)
 
         returnVal = anvio_runner.run_anvio(ctx, params)
         #END run_kb_anvio
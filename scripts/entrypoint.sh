@@ -20,10 +20,9 @@ elif [ "${1}" = "init" ] ; then
   mkdir -p /data/anviodb
   cd /data/anviodb
 
-  # Ideally would download these here but then Anvio can't find the databases later, so right now also running in AnvioUtil because these are relatively small
-  # anvi-setup-scg-taxonomy -T 4 --scgs-taxonomy-data-dir /data/anviodb/scgs # data-dir location ignored
-  # echo "anvi-setup-trna-taxonomy"
-  # anvi-setup-trna-taxonomy -T 4 --trna-taxonomy-data-dir /data/anviodb/tRNA # data-dir location ignored
+  # SCG and tRNA taxonomy, jobs pass these directories to anvi-run-scg-taxonomy and anvi-run-trna-taxonomy
+  echo "Setting up SCG and tRNA taxonomy"
+  PYTHONPATH=/kb/module/lib:$PYTHONPATH python -m kb_anvio.Utils.ReferenceData setup --root /data/anviodb --threads 4
 
   echo "Running anvi-setup-ncbi-cogs"
   anvi-setup-ncbi-cogs -T 4 --just-do-it --cog-data-dir /data/anviodb/COG
@@ -40,11 +39,14 @@ elif [ "${1}" = "init" ] ; then
   # echo "anvi-setup-pdb-database"
   # anvi-setup-pdb-database -T 4 --pdb-database-path /data/anviodb/PDB.db
 
+  echo "Writing the reference data manifest"
+  PYTHONPATH=/kb/module/lib:$PYTHONPATH python -m kb_anvio.Utils.ReferenceData manifest --root /data/anviodb --threads 4
+
   cd /data/anviodb
 
   # dont have interactome and kegg downloaded and functioning yet
   # if [ -s "/data/anviodb/COG/COG20/DB_DIAMOND/COG.dmnd" -a -s "/data/anviodb/Pfam/Pfam-A.hmm.h3f" -a -s "/data/anviodb/Pfam/Pfam-A.hmm.h3i" -a -s "/data/anviodb/Pfam/Pfam-A.hmm.h3m" -a -s "/data/anviodb/Pfam/Pfam-A.hmm.h3p" -a -s "/data/anviodb/KEGG/MODULES.db" -a -s "/data/anviodb/Interacdome/Pfam-A.hmm" ] ; then
-  if [ -s "/data/anviodb/COG/COG20/DB_DIAMOND/COG.dmnd" -a -s "/data/anviodb/Pfam/Pfam-A.hmm.h3f" -a -s "/data/anviodb/Pfam/Pfam-A.hmm.h3i" -a -s "/data/anviodb/Pfam/Pfam-A.hmm.h3m" -a -s "/data/anviodb/Pfam/Pfam-A.hmm.h3p" ] ; then
+  if [ -s "/data/anviodb/COG/COG20/DB_DIAMOND/COG.dmnd" -a -s "/data/anviodb/Pfam/Pfam-A.hmm.h3f" -a -s "/data/anviodb/Pfam/Pfam-A.hmm.h3i" -a -s "/data/anviodb/Pfam/Pfam-A.hmm.h3m" -a -s "/data/anviodb/Pfam/Pfam-A.hmm.h3p" -a -s "/data/anviodb/SCG_TAXONOMY/.kb_anvio_ready.json" -a -s "/data/anviodb/TRNA_TAXONOMY/.kb_anvio_ready.json" -a -s "/data/anviodb/kb_anvio_manifest.json" ] ; then
    echo "DATA DOWNLOADED SUCCESSFULLY"
    touch /data/__READY__
   else
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from kb_anvio.Utils.AnnotationScheduler import AnnotationScheduler
+from kb_anvio.Utils.ResourcePlanner import GIB, ResourcePlan
+
+CONTIGS_DB = 'contigs\n'
+
+
+class FakeAnvioUtil(object):
+    """
+    FakeAnvioUtil: stands in for AnvioUtil, every annotation command appends a line naming
+    itself to the text file standing in for the contigs.db it is given
+    """
+
+    def __init__(self, fail=()):
+        self.plan = ResourcePlan(8, 16 * GIB)
+        self.stage_name = 'annotate'
+        self.fail = fail
+        self.calls = list()
+        self._lock = threading.Lock()
+
+    def run_in_stage(self, stage, plan, func, *args):
+        return func(*args)
+
+    def _annotate(self, name, contigs_db):
+        with self._lock:
+            self.calls.append((name, contigs_db))
+        if name in self.fail:
+            raise ValueError('{} failed'.format(name))
+        with open(contigs_db, 'a') as f:
+            f.write(name + '\n')
+
+    def run_anvi_run_hmms(self, contigs_db, threads):
+        self._annotate('hmms', contigs_db)
+
+    def run_anvi_run_scg_taxonomy(self, contigs_db, threads):
+        self._annotate('scg_taxonomy', contigs_db)
+
+    def run_anvi_run_ncbi_cog(self, task_params, contigs_db, threads):
+        self._annotate('ncbi_cogs', contigs_db)
+
+    def run_anvi_run_pfams(self, contigs_db, threads):
+        self._annotate('pfams', contigs_db)
+
+    def run_anvi_run_kegg_kofams(self, contigs_db, threads):
+        self._annotate('kegg_kofams', contigs_db)
+
+    def run_anvi_export_functions(self, contigs_db, functions_file):
+        with open(contigs_db) as f:
+            functions = f.read()[len(CONTIGS_DB):]
+        with open(functions_file, 'w') as f:
+            f.write(functions)
+
+    def run_anvi_import_functions(self, contigs_db, functions_file):
+        with self._lock:
+            self.calls.append(('import', contigs_db))
+        with open(functions_file) as f, open(contigs_db, 'a') as db:
+            db.write(f.read())
+
+
+class AnnotationSchedulerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.contigs_db = os.path.join(self.tmp, 'contigs.db')
+        with open(self.contigs_db, 'w') as f:
+            f.write(CONTIGS_DB)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def _contigs_db_lines(self):
+        with open(self.contigs_db) as f:
+            return f.read().splitlines()
+
+    def test_selected_sources_include_their_needs(self):
+        scheduler = AnnotationScheduler(FakeAnvioUtil(), self.contigs_db)
+        self.assertEqual([source.name for source in scheduler.selected_sources(
+            {'run_scg_taxonomy': 'yes', 'run_pfams': 'no'})], ['hmms', 'scg_taxonomy'])
+
+    def test_exported_functions_are_merged_into_contigs_db(self):
+        util = FakeAnvioUtil()
+        scheduler = AnnotationScheduler(util, self.contigs_db)
+        scheduler.run({'run_hmms': 'yes', 'run_ncbi_cogs': 'yes', 'run_pfams': 'yes',
+                       'run_kegg_kofams': 'yes'})
+
+        in_place = [name for name, contigs_db in util.calls if contigs_db == self.contigs_db]
+        on_copies = [name for name, contigs_db in util.calls if contigs_db != self.contigs_db]
+        # kofams writes self table values the function import does not carry over
+        self.assertEqual(in_place, ['hmms', 'kegg_kofams', 'import', 'import'])
+        self.assertEqual(sorted(on_copies), ['ncbi_cogs', 'pfams'])
+
+        lines = self._contigs_db_lines()
+        self.assertEqual(lines[0], 'contigs')
+        self.assertEqual(sorted(lines[1:]), ['hmms', 'kegg_kofams', 'ncbi_cogs', 'pfams'])
+        # the snapshots are removed once imported
+        self.assertEqual(os.listdir(scheduler.work_dir), [])
+
+    def test_failed_search_imports_nothing(self):
+        util = FakeAnvioUtil(fail=['pfams'])
+        with self.assertRaisesRegex(ValueError, 'pfams failed'):
+            AnnotationScheduler(util, self.contigs_db).run(
+                {'run_hmms': 'yes', 'run_ncbi_cogs': 'yes', 'run_pfams': 'yes'})
+        self.assertNotIn('import', [name for name, _ in util.calls])
+        self.assertEqual(self._contigs_db_lines(), ['contigs', 'hmms'])
+
+    def test_failed_in_place_source(self):
+        util = FakeAnvioUtil(fail=['hmms'])
+        with self.assertRaisesRegex(ValueError, 'hmms failed'):
+            AnnotationScheduler(util, self.contigs_db).run(
+                {'run_scg_taxonomy': 'yes', 'run_ncbi_cogs': 'yes'})
+        # scg taxonomy needs the hmms and is not run after them failing
+        self.assertNotIn('scg_taxonomy', [name for name, _ in util.calls])
+        self.assertEqual(self._contigs_db_lines(), ['contigs'])
+
+    def test_nothing_selected(self):
+        util = FakeAnvioUtil()
+        AnnotationScheduler(util, self.contigs_db).run({})
+        self.assertEqual(util.calls, [])
@@ -0,0 +1,244 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+import unittest
+from contextlib import closing
+
+from kb_anvio.Utils.AnvioUtil import AnvioUtil
+from kb_anvio.Utils.ArtifactCache import ArtifactCache
+from kb_anvio.Utils.CheckpointLedger import CheckpointLedger
+from kb_anvio.Utils.ResourcePlanner import ResourcePlan
+
+
+class FakeReadsUtils(object):
+    """
+    FakeReadsUtils: downloads every reads object as a new interleaved fastq file in scratch
+    """
+
+    def __init__(self, scratch):
+        self.scratch = scratch
+        self.downloads = list()
+
+    def download_reads(self, params):
+        files = dict()
+        for reads_ref in params['read_libraries']:
+            self.downloads.append(reads_ref)
+            path = os.path.join(self.scratch, '{}_{}.fastq'.format(reads_ref.replace('/', '_'),
+                                                                   len(self.downloads)))
+            with open(path, 'w') as f:
+                f.write('@r1\nACGT\n+\nIIII\n')
+            files[reads_ref] = {'files': {'fwd': path, 'type': 'interleaved'}}
+        return {'files': files}
+
+
+class AnvioUtilTest(unittest.TestCase):
+    """
+    AnvioUtil stages that do not need anvi'o, with the anvi'o commands replaced by fakes
+    """
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.scratch = os.path.join(self.tmp, 'scratch')
+        os.makedirs(self.scratch)
+        self.config = {'SDK_CALLBACK_URL': 'http://localhost:1', 'scratch': self.scratch,
+                       'shock-url': 'http://localhost:1', 'workspace-url': 'http://localhost:1',
+                       'artifact-cache-dir': os.path.join(self.tmp, 'cache')}
+        with closing(sqlite3.connect(os.path.join(self.scratch, 'contigs.db'))) as db:
+            db.execute('create table self (key text, value text)')
+            db.execute("insert into self values ('contigs_db_hash', 'hash1234')")
+            db.commit()
+        self.profiled = list()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def _anvio_util(self):
+        anvio_util = AnvioUtil(self.config)
+        anvio_util.ledger = CheckpointLedger(self.scratch)
+
+        def run_anvi_profile(raw_sorted_bam):
+            profile_dir = raw_sorted_bam.split('.bam')[0] + '_RAW'
+            os.makedirs(profile_dir)
+            for name in ['PROFILE.db', 'AUXILIARY-DATA.db', 'RUNLOG.txt']:
+                with open(os.path.join(profile_dir, name), 'w') as f:
+                    f.write(name)
+            self.profiled.append(raw_sorted_bam)
+            return profile_dir
+
+        anvio_util.run_anvi_profile = run_anvi_profile
+        return anvio_util
+
+    def _raw_bam(self, name):
+        raw_sorted_bam = os.path.join(self.scratch, name + '_sorted.bam-RAW.bam')
+        with open(raw_sorted_bam, 'w') as f:
+            f.write('bam')
+        return raw_sorted_bam
+
+    def test_profile_restored_into_profile_dir_of_renamed_sample(self):
+        cache_key = ArtifactCache.key('assembly', 1000, '1/2/3', 'bowtie2_default')
+        profile_dir = self._anvio_util().profile_sample(self._raw_bam('reads_a'), cache_key)
+        self.assertEqual(len(self.profiled), 1)
+        self.assertTrue(os.path.isfile(os.path.join(profile_dir, 'PROFILE.db')))
+
+        # the bams were evicted and the reads downloaded again under another fastq name,
+        # while the profile of the same reads is still cached
+        shutil.rmtree(profile_dir)
+        renamed_bam = self._raw_bam('reads_b')
+        restored_dir = self._anvio_util().profile_sample(renamed_bam, cache_key)
+
+        self.assertEqual(len(self.profiled), 1)
+        self.assertEqual(restored_dir, renamed_bam.split('.bam')[0] + '_RAW')
+        for name in ['PROFILE.db', 'AUXILIARY-DATA.db', 'RUNLOG.txt']:
+            self.assertTrue(os.path.isfile(os.path.join(restored_dir, name)))
+        self.assertFalse(os.path.exists(profile_dir))
+
+    def test_restored_profile_databases_are_not_hardlinked(self):
+        cache_key = ArtifactCache.key('assembly', 1000, '1/2/3', 'bowtie2_default')
+        self._anvio_util().profile_sample(self._raw_bam('reads_a'), cache_key)
+        restored_dir = self._anvio_util().profile_sample(self._raw_bam('reads_b'), cache_key)
+        self.assertEqual(os.stat(os.path.join(restored_dir, 'PROFILE.db')).st_nlink, 1)
+
+    def test_staged_reads_reused_while_their_checksums_match(self):
+        reads_utils = FakeReadsUtils(self.scratch)
+
+        def anvio_util():
+            anvio_util = AnvioUtil(self.config)
+            anvio_util.ru = reads_utils
+            return anvio_util
+
+        staged = anvio_util().stage_reads(['1/2/3'])[0]
+        # a later run on the same scratch reads the manifest its predecessor wrote
+        self.assertEqual(anvio_util().stage_reads(['1/2/3'])[0], staged)
+        self.assertEqual(reads_utils.downloads, ['1/2/3'])
+
+        # same size, different content
+        with open(staged['files'][0]['path'], 'w') as f:
+            f.write('@r1\nACGA\n+\nIIII\n')
+        restaged = anvio_util().stage_reads(['1/2/3'])[0]
+        self.assertEqual(reads_utils.downloads, ['1/2/3', '1/2/3'])
+        self.assertNotEqual(restaged['files'][0]['path'], staged['files'][0]['path'])
+        self.assertEqual(restaged['files'][0]['md5'], staged['files'][0]['md5'])
+
+    def test_sample_names_are_unique(self):
+        manifest = [{'reads_name': 'reads a.fastq', 'files': []},
+                    {'reads_name': 'reads_a.fastq', 'files': []},
+                    {'files': [{'path': os.path.join(self.scratch, 'reads_b.fastq.gz')}]}]
+        self.assertEqual(AnvioUtil(self.config)._sample_names(manifest),
+                         ['reads_a.fastq', 'reads_a.fastq_2', 'reads_b'])
+
+    def test_cached_bams_restored_to_paths_of_each_sample(self):
+        anvio_util = self._anvio_util()
+        task_params = {'assembly_hash': 'assembly', 'min_contig_length': 1000,
+                       'read_mapping_tool': 'bowtie2_default'}
+        libraries = [{'reads_ref': ref, 'reads_upa': ref, 'read_type': 'interleaved',
+                      'files': []} for ref in ['1/2/3', '1/4/5']]
+        # both entries were cached under the same names, by jobs mapping other samples
+        for library in libraries:
+            cached = os.path.join(self.tmp, 'cached-' + library['reads_ref'].replace('/', '_'))
+            os.makedirs(cached)
+            files = dict()
+            for name in ['sorted.bam', 'sorted.bam.bai', 'raw.bam', 'raw.bam.bai']:
+                files[name] = os.path.join(cached, name)
+                with open(files[name], 'w') as f:
+                    f.write(library['reads_ref'])
+            anvio_util.cache.store('sample_bam',
+                                   anvio_util._sample_cache_key(task_params, library), files)
+
+        bams = [anvio_util.map_sample(task_params, self.tmp, library, name)
+                for library, name in zip(libraries, ['sample_a', 'sample_b'])]
+
+        self.assertEqual(bams[0], (os.path.join(self.scratch, 'sample_a_sorted.bam'),
+                                   os.path.join(self.scratch, 'sample_a_sorted.bam-RAW.bam')))
+        for (sorted_bam, raw_sorted_bam), library in zip(bams, libraries):
+            for path in [sorted_bam, sorted_bam + '.bai', raw_sorted_bam, raw_sorted_bam + '.bai']:
+                with open(path) as f:
+                    self.assertEqual(f.read(), library['reads_ref'])
+
+    def test_missing_or_empty_bam_fails_the_sample(self):
+        sorted_bam = os.path.join(self.scratch, 'reads_sorted.bam')
+        with self.assertRaisesRegex(ValueError, 'did not write the bam file'):
+            AnvioUtil(self.config).index_sorted_bam(sorted_bam)
+        open(sorted_bam, 'w').close()
+        with self.assertRaisesRegex(ValueError, 'wrote an empty bam file'):
+            AnvioUtil(self.config).index_sorted_bam(sorted_bam)
+
+    def test_sample_pool_stops_at_first_failure(self):
+        anvio_util = AnvioUtil(self.config)
+        anvio_util.plan = ResourcePlan(4, 16 << 30, num_samples=4, sample_workers=2)
+
+        def sample(number):
+            if number == 0:
+                time.sleep(0.2)
+                raise ValueError('sample 0 failed')
+            anvio_util._run_command(['sleep', '60'])
+
+        start = time.time()
+        with self.assertRaisesRegex(ValueError, 'sample 0 failed'):
+            anvio_util._run_sample_pool(sample, [(number,) for number in range(4)])
+        self.assertLess(time.time() - start, 30)
+
+    def test_results_replace_earlier_moves(self):
+        anvio_util = AnvioUtil(self.config)
+        result_directory = os.path.join(self.scratch, AnvioUtil.ANVIO_RESULT_DIRECTORY)
+        os.makedirs(result_directory)
+        contig_file = os.path.join(self.scratch, 'assembly.fa_anvio-reformatted')
+        task_params = {'contig_file_path': contig_file, 'reads_list': ['1/2/3']}
+
+        def write_results(content):
+            for path in [contig_file, contig_file + AnvioUtil.REFORMAT_REPORT_SUFFIX,
+                         contig_file + AnvioUtil.REFORMAT_STATS_SUFFIX]:
+                with open(path, 'w') as f:
+                    f.write(content)
+            os.makedirs(os.path.join(self.scratch, 'reads_sorted_RAW'), exist_ok=True)
+            with open(os.path.join(self.scratch, 'reads_sorted_RAW', 'PROFILE.db'), 'w') as f:
+                f.write(content)
+
+        # an interrupted attempt moved part of the results
+        write_results('first')
+        for path in [contig_file, os.path.join(self.scratch, 'contigs.db'),
+                     os.path.join(self.scratch, 'reads_sorted_RAW')]:
+            shutil.move(path, result_directory)
+
+        # the resumed run rebuilt all but contigs.db and moves everything again
+        write_results('second')
+        anvio_util.move_files_to_output_folder(task_params)
+
+        with open(os.path.join(result_directory, os.path.basename(contig_file))) as f:
+            self.assertEqual(f.read(), 'second')
+        with open(os.path.join(result_directory, 'reads_sorted_RAW', 'PROFILE.db')) as f:
+            self.assertEqual(f.read(), 'second')
+        self.assertTrue(os.path.isfile(os.path.join(result_directory, 'contigs.db')))
+        self.assertTrue(os.path.isfile(contig_file))
+        self.assertFalse(os.path.exists(os.path.join(self.scratch, 'contigs.db')))
+
+    def test_results_are_linked_and_checkpoints_stay_valid(self):
+        anvio_util = AnvioUtil(self.config)
+        result_directory = os.path.join(self.scratch, AnvioUtil.ANVIO_RESULT_DIRECTORY)
+        os.makedirs(result_directory)
+        contig_file = os.path.join(self.scratch, 'assembly.fa_anvio-reformatted')
+        for path in [contig_file, contig_file + AnvioUtil.REFORMAT_REPORT_SUFFIX,
+                     contig_file + AnvioUtil.REFORMAT_STATS_SUFFIX]:
+            with open(path, 'w') as f:
+                f.write('contigs')
+        profile_db = os.path.join(self.scratch, 'SAMPLES-MERGED', 'PROFILE.db')
+        os.makedirs(os.path.dirname(profile_db))
+        with open(profile_db, 'w') as f:
+            f.write('merged')
+        contigs_db = os.path.join(self.scratch, 'contigs.db')
+        ledger = CheckpointLedger(result_directory)
+        ledger.record('gen_contigs_database', 'abc', [contigs_db])
+        ledger.record('merge', 'def', [profile_db])
+
+        anvio_util.move_files_to_output_folder(
+            {'contig_file_path': contig_file, 'reads_list': ['1/2/3', '1/4/5']})
+
+        for path in [contigs_db, profile_db]:
+            linked = os.path.join(result_directory, os.path.relpath(path, self.scratch))
+            self.assertTrue(os.path.samefile(path, linked))
+        # a run resumed after the packaging failed skips the stages
+        resumed = CheckpointLedger(result_directory)
+        self.assertTrue(resumed.is_complete('gen_contigs_database', 'abc'))
+        self.assertTrue(resumed.is_complete('merge', 'def'))
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import subprocess
+import tarfile
+import tempfile
+import unittest
+import zipfile
+
+from kb_anvio.Utils.ArchiveWriter import CHUNK_SIZE, ArchiveWriter
+from kb_anvio.Utils.CommandMetrics import CommandMetrics
+from kb_anvio.Utils.CommandRunner import CommandRunner
+
+
+class ArchiveWriterTest(unittest.TestCase):
+    """
+    every archive is read back: testzip() checks the crc of every zip member and the content
+    of every member is compared with its source
+    """
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.members = [
+            (self._write('empty.txt', b''), 'empty.txt'),
+            (self._write('empty.bam', b''), 'empty.bam'),
+            (self._write('small.txt', b'anvio\n' * 100), 'PROFILE/small.txt'),
+            # several chunks, compressible and not
+            (self._write('contigs.fa', b'>c_1\n' + b'ACGTTGCA' * (CHUNK_SIZE // 2) + b'\n'),
+             'contigs.fa'),
+            (self._write('random.db', os.urandom(2 * CHUNK_SIZE + 12345)), 'PROFILE/random.db'),
+            (self._write('sample.bam', os.urandom(CHUNK_SIZE + 1)), 'sample.bam'),
+            # exactly one chunk
+            (self._write('chunk.txt', b'x' * CHUNK_SIZE), 'chunk.txt'),
+        ]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def _write(self, name, content):
+        path = os.path.join(self.tmp, name)
+        with open(path, 'wb') as f:
+            f.write(content)
+        return path
+
+    def _check_zip(self, archive):
+        with zipfile.ZipFile(archive) as zip_file:
+            self.assertIsNone(zip_file.testzip())
+            self.assertEqual(zip_file.namelist(), [arcname for path, arcname in self.members])
+            for path, arcname in self.members:
+                with open(path, 'rb') as f:
+                    self.assertEqual(zip_file.read(arcname), f.read(), arcname)
+            return {info.filename: info for info in zip_file.infolist()}
+
+    def test_zip_round_trip(self):
+        for threads in [1, 4]:
+            archive = os.path.join(self.tmp, 'result_{}.zip'.format(threads))
+            ArchiveWriter('zip', threads=threads).write(archive, self.members)
+            infos = self._check_zip(archive)
+            self.assertEqual(infos['sample.bam'].compress_type, zipfile.ZIP_STORED)
+            self.assertEqual(infos['contigs.fa'].compress_type, zipfile.ZIP_DEFLATED)
+            self.assertLess(infos['contigs.fa'].compress_size, infos['contigs.fa'].file_size // 50)
+
+    def test_zip_level_zero_stores_everything(self):
+        archive = os.path.join(self.tmp, 'result.zip')
+        ArchiveWriter('zip', level=0, threads=2).write(archive, self.members)
+        infos = self._check_zip(archive)
+        self.assertEqual({info.compress_type for info in infos.values()}, {zipfile.ZIP_STORED})
+
+    def test_zip_level(self):
+        members = [member for member in self.members if member[1] == 'contigs.fa']
+        sizes = dict()
+        for level in [1, 9]:
+            archive = os.path.join(self.tmp, 'result_{}.zip'.format(level))
+            ArchiveWriter('zip', level=level, threads=2).write(archive, members)
+            with zipfile.ZipFile(archive) as zip_file:
+                self.assertIsNone(zip_file.testzip())
+                sizes[level] = zip_file.getinfo('contigs.fa').compress_size
+        self.assertLess(sizes[9], sizes[1])
+
+    def test_zip_without_members(self):
+        archive = os.path.join(self.tmp, 'result.zip')
+        ArchiveWriter('zip').write(archive, [])
+        with zipfile.ZipFile(archive) as zip_file:
+            self.assertEqual(zip_file.namelist(), [])
+
+    @unittest.skipIf(shutil.which('zstd') is None or shutil.which('tar') is None,
+                     'zstd is not installed')
+    def test_tar_zst_round_trip(self):
+        runner = CommandRunner(CommandMetrics())
+        archive = os.path.join(self.tmp, 'result.tar.zst')
+        ArchiveWriter('tar.zst', threads=2,
+                      run_command=lambda command: runner.run(command, self.tmp)).write(
+            archive, self.members)
+        tar_path = os.path.join(self.tmp, 'result.tar')
+        subprocess.check_call(['zstd', '-d', '-q', archive, '-o', tar_path])
+        with tarfile.open(tar_path) as tar:
+            for path, arcname in self.members:
+                with open(path, 'rb') as f:
+                    self.assertEqual(tar.extractfile(arcname).read(), f.read(), arcname)
+        self.assertEqual(
+            [name for name in os.listdir(self.tmp) if name.startswith('archive_links_')], [])
+
+    @unittest.skipIf(shutil.which('zstd') is None or shutil.which('tar') is None,
+                     'zstd is not installed')
+    def test_tar_zst_without_members(self):
+        runner = CommandRunner(CommandMetrics())
+        archive = os.path.join(self.tmp, 'result.tar.zst')
+        ArchiveWriter('tar.zst', run_command=lambda command: runner.run(command, self.tmp)).write(
+            archive, [])
+        tar_path = os.path.join(self.tmp, 'result.tar')
+        subprocess.check_call(['zstd', '-d', '-q', archive, '-o', tar_path])
+        with tarfile.open(tar_path) as tar:
+            self.assertEqual(tar.getnames(), [])
+
+    def test_invalid_format_and_level(self):
+        with self.assertRaises(ValueError):
+            ArchiveWriter('rar')
+        with self.assertRaises(ValueError):
+            ArchiveWriter('zip', level=12)
+        self.assertEqual(ArchiveWriter('tar.zst', level='').level, 3)
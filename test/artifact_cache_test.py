@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+from kb_anvio.Utils import ArtifactCache as artifact_cache_module
+from kb_anvio.Utils.ArtifactCache import ArtifactCache, content_hash, copy_verified, link_or_copy
+
+
+class ArtifactCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.cache = ArtifactCache(os.path.join(self.tmp, 'cache'), 1 << 20)
+        self.work = os.path.join(self.tmp, 'work')
+        os.makedirs(self.work)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def _write(self, name, content):
+        path = os.path.join(self.work, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(content)
+        return path
+
+    def test_key_depends_on_every_part(self):
+        key = ArtifactCache.key('hash', 1000, 'bowtie2')
+        self.assertEqual(key, ArtifactCache.key('hash', 1000, 'bowtie2'))
+        self.assertNotEqual(key, ArtifactCache.key('hash', 1000, 'hisat2'))
+        self.assertNotEqual(key, ArtifactCache.key('hash', '1000', 'bowtie2'))
+
+    def test_store_and_restore(self):
+        index = self._write('index/contigs.bt2.1.bt2', b'index')
+        self.cache.store('read_mapping_index', 'key1', {'contigs.bt2.1.bt2': index})
+        self.assertTrue(self.cache.contains('read_mapping_index', 'key1'))
+
+        dest_dir = os.path.join(self.tmp, 'restored')
+        restored = self.cache.restore('read_mapping_index', 'key1', dest_dir)
+        self.assertEqual(restored,
+                         {'contigs.bt2.1.bt2': os.path.join(dest_dir, 'contigs.bt2.1.bt2')})
+        with open(restored['contigs.bt2.1.bt2'], 'rb') as f:
+            self.assertEqual(f.read(), b'index')
+        # immutable files are shared by hardlink
+        self.assertEqual(os.stat(index).st_ino, os.stat(restored['contigs.bt2.1.bt2']).st_ino)
+
+    def test_mutable_files_are_never_hardlinked(self):
+        contigs_db = self._write('contigs.db', b'contigs')
+        self.cache.store('contigs_db', 'key1', {'contigs.db': contigs_db}, mutable=['contigs.db'])
+        restored = self.cache.restore('contigs_db', 'key1', os.path.join(self.tmp, 'restored'),
+                                      mutable=['contigs.db'])
+        self.assertNotEqual(os.stat(contigs_db).st_ino, os.stat(restored['contigs.db']).st_ino)
+
+        # writing to the job's copy leaves the cached entry intact
+        with open(contigs_db, 'ab') as f:
+            f.write(b' annotated')
+        again = self.cache.restore('contigs_db', 'key1', os.path.join(self.tmp, 'again'))
+        with open(again['contigs.db'], 'rb') as f:
+            self.assertEqual(f.read(), b'contigs')
+
+    def test_restore_targets_and_miss(self):
+        bam = self._write('sample_sorted.bam', b'bam')
+        self.cache.store('sample_bam', 'key1', {'sample_sorted.bam': bam})
+        target = os.path.join(self.tmp, 'elsewhere', 'renamed.bam')
+        restored = self.cache.restore('sample_bam', 'key1', self.work,
+                                      targets={'sample_sorted.bam': target})
+        self.assertEqual(restored['sample_sorted.bam'], target)
+        self.assertIsNone(self.cache.restore('sample_bam', 'key2', self.work))
+
+    def test_copy_when_links_are_unsupported(self):
+        src = self._write('contigs.fa', b'>c_1\nACGT\n')
+        dst = os.path.join(self.tmp, 'copy.fa')
+        with mock.patch.object(artifact_cache_module.os, 'link', side_effect=OSError('EXDEV')), \
+                mock.patch.object(artifact_cache_module, 'reflink',
+                                  side_effect=OSError('EOPNOTSUPP')):
+            self.assertEqual(link_or_copy(src, dst, verify=True), 'copy')
+        self.assertEqual(content_hash(src), content_hash(dst))
+        self.assertNotEqual(os.stat(src).st_ino, os.stat(dst).st_ino)
+
+    def test_copy_verified_detects_corruption(self):
+        src = self._write('archive.zip', os.urandom(1 << 16))
+        dst = os.path.join(self.tmp, 'staged.zip')
+        self.assertEqual(copy_verified(src, dst, block_size=4096), content_hash(src))
+
+        with mock.patch.object(artifact_cache_module, 'content_hash', return_value='0' * 64):
+            with self.assertRaises(IOError):
+                copy_verified(src, dst)
+        self.assertFalse(os.path.exists(dst))
+
+    def test_least_recently_used_entries_evicted_first(self):
+        cache = ArtifactCache(os.path.join(self.tmp, 'small_cache'), 250)
+        for number in range(3):
+            cache.store('sample_bam', 'key{}'.format(number),
+                        {'sample.bam': self._write('sample{}.bam'.format(number), b'b' * 100)})
+            meta = os.path.join(cache._entry_dir('sample_bam', 'key{}'.format(number)),
+                                ArtifactCache.META_FILE)
+            os.utime(meta, (time.time() - 100 + number, time.time() - 100 + number))
+            if number == 1:
+                # key0 is used again, so key1 becomes the least recently used entry
+                cache.restore('sample_bam', 'key0', os.path.join(self.tmp, 'restored'))
+
+        self.assertTrue(cache.contains('sample_bam', 'key0'))
+        self.assertFalse(cache.contains('sample_bam', 'key1'))
+        self.assertTrue(cache.contains('sample_bam', 'key2'))
+
+    def test_store_keeps_existing_entry(self):
+        first = self._write('first.db', b'first')
+        second = self._write('second.db', b'second')
+        self.cache.store('contigs_db', 'key1', {'contigs.db': first})
+        self.cache.store('contigs_db', 'key1', {'contigs.db': second})
+        restored = self.cache.restore('contigs_db', 'key1', os.path.join(self.tmp, 'restored'))
+        with open(restored['contigs.db'], 'rb') as f:
+            self.assertEqual(f.read(), b'first')
+        self.assertEqual([name for name in os.listdir(os.path.join(self.cache.root, 'contigs_db'))
+                          if name.startswith('.tmp')], [])
+
+    def test_from_config(self):
+        self.assertIsNone(ArtifactCache.from_config({}))
+        cache = ArtifactCache.from_config({
+            'artifact-cache-dir': os.path.join(self.tmp, 'configured'),
+            'artifact-cache-max-gb': '0.5'})
+        self.assertEqual(cache.max_bytes, 1 << 29)
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import unittest
+
+from kb_anvio.Utils.CheckpointLedger import CheckpointLedger, fingerprint
+
+
+class CheckpointLedgerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.output = self._write('contigs.db', 'contigs')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def _write(self, name, content):
+        path = os.path.join(self.tmp, name)
+        with open(path, 'w') as f:
+            f.write(content)
+        return path
+
+    def test_fingerprint_follows_file_state_and_values(self):
+        assembly = self._write('assembly.fa', '>c_1\nACGT\n')
+        first = fingerprint(assembly, 1000, 'bowtie2_default')
+        self.assertEqual(first, fingerprint(assembly, 1000, 'bowtie2_default'))
+        self.assertNotEqual(first, fingerprint(assembly, 2000, 'bowtie2_default'))
+
+        self._write('assembly.fa', '>c_1\nACGTACGT\n')
+        self.assertNotEqual(first, fingerprint(assembly, 1000, 'bowtie2_default'))
+        # a path that is not a file counts as a plain value
+        self.assertEqual(fingerprint('/no/such/file'), fingerprint('/no/such/file'))
+
+    def test_recorded_stage_is_complete_in_a_new_ledger(self):
+        ledger = CheckpointLedger(self.tmp)
+        ledger.record('gen_contigs_database', 'abc', [self.output], {'contigs_db': self.output})
+
+        resumed = CheckpointLedger(self.tmp)
+        self.assertTrue(resumed.is_complete('gen_contigs_database', 'abc'))
+        self.assertEqual(resumed.result('gen_contigs_database'), {'contigs_db': self.output})
+        self.assertEqual(resumed.fingerprint_of('gen_contigs_database'), 'abc')
+
+    def test_changed_fingerprint_invalidates(self):
+        ledger = CheckpointLedger(self.tmp)
+        ledger.record('gen_contigs_database', 'abc', [self.output])
+        self.assertFalse(ledger.is_complete('gen_contigs_database', 'def'))
+        self.assertFalse(ledger.is_complete('annotate', 'abc'))
+
+    def test_changed_or_missing_output_invalidates(self):
+        ledger = CheckpointLedger(self.tmp)
+        ledger.record('gen_contigs_database', 'abc', [self.output])
+        self._write('contigs.db', 'contigs, annotated')
+        self.assertFalse(ledger.is_complete('gen_contigs_database', 'abc'))
+
+        ledger.refresh_outputs('gen_contigs_database')
+        self.assertTrue(ledger.is_complete('gen_contigs_database', 'abc'))
+
+        os.remove(self.output)
+        self.assertFalse(ledger.is_complete('gen_contigs_database', 'abc'))
+
+    def test_invalidate_removes_entry(self):
+        ledger = CheckpointLedger(self.tmp)
+        ledger.record('gen_contigs_database', 'abc', [self.output])
+        ledger.invalidate('gen_contigs_database')
+        self.assertIsNone(CheckpointLedger(self.tmp).fingerprint_of('gen_contigs_database'))
+        self.assertFalse(os.path.exists(ledger.ledger_path + '.tmp'))
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+from kb_anvio.Utils.CommandMetrics import CommandMetrics
+from kb_anvio.Utils.CommandRunner import CommandRunner
+
+
+class CommandMetricsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.metrics = CommandMetrics()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def test_recorded_command(self):
+        # allocates and writes about 20MB, so the peak memory and the written bytes show
+        code = ('import os, sys\n'
+                'data = bytearray(20 << 20)\n'
+                'with open(sys.argv[1], "wb") as f:\n'
+                '    f.write(data)\n'
+                '    os.fsync(f.fileno())')
+        CommandRunner(self.metrics).run([sys.executable, '-c', code,
+                                         os.path.join(self.tmp, 'out')], self.tmp, stage='map')
+        with self.metrics.measure('package', 'archive results'):
+            sum(range(100000))
+
+        mapping, packaging = self.metrics.commands
+        self.assertEqual(list(mapping), ['stage', 'command', 'started_at', 'wall_seconds',
+                                         'exit_code', 'user_seconds', 'sys_seconds',
+                                         'max_rss_mb', 'read_bytes', 'write_bytes'])
+        self.assertEqual(mapping['stage'], 'map')
+        self.assertIn(sys.executable, mapping['command'])
+        self.assertEqual(mapping['exit_code'], 0)
+        self.assertGreater(mapping['wall_seconds'], 0)
+        self.assertGreater(mapping['user_seconds'] + mapping['sys_seconds'], 0)
+        self.assertGreater(mapping['max_rss_mb'], 20)
+        self.assertEqual((packaging['stage'], packaging['command'], packaging['exit_code']),
+                         ('package', 'archive results', 0))
+
+    def test_failed_measure_is_recorded(self):
+        with self.assertRaises(ValueError):
+            with self.metrics.measure('package', 'archive results'):
+                raise ValueError('disk full')
+        self.assertEqual(self.metrics.commands[0]['exit_code'], 1)
+
+    def test_stage_totals_write_and_summary(self):
+        runner = CommandRunner(self.metrics)
+        for stage in ['map', 'map', 'profile']:
+            runner.run(['true'], self.tmp, stage=stage)
+
+        totals = self.metrics.stage_totals()
+        self.assertEqual(list(totals), ['map', 'profile'])
+        self.assertEqual(totals['map']['commands'], 2)
+        self.assertGreaterEqual(totals['map']['last_finished_at'],
+                                totals['map']['first_started_at'])
+
+        metrics_path = self.metrics.write(self.tmp)
+        self.assertEqual(metrics_path, os.path.join(self.tmp, CommandMetrics.METRICS_FILE))
+        with open(metrics_path) as f:
+            written = json.load(f)
+        self.assertEqual(list(written['stages']), ['map', 'profile'])
+        self.assertEqual([entry['command'] for entry in written['commands']], ['true'] * 3)
+
+        lines = self.metrics.summary_table().splitlines()
+        self.assertEqual(lines[0].split(), ['stage', 'cmds', 'elapsed_s', 'wall_s', 'user_s',
+                                            'sys_s', 'rss_mb', 'io_mb'])
+        self.assertEqual([line.split()[:2] for line in lines[1:]],
+                         [['map', '2'], ['profile', '1']])
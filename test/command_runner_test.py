@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import signal
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+from kb_anvio.Utils.CommandMetrics import CommandMetrics
+from kb_anvio.Utils.CommandRunner import Command, CommandError, CommandRunner, Pipeline
+
+
+def _python(code):
+    return Command([sys.executable, '-c', code])
+
+
+def _alive(pid):
+    """
+    _alive: whether pid is a running process, zombies left to an init that does not reap
+            them count as dead
+    """
+    try:
+        with open('/proc/{}/stat'.format(pid)) as f:
+            return f.read().rsplit(')', 1)[1].split()[0] != 'Z'
+    except IOError:
+        return False
+
+
+class CommandRunnerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.runner = CommandRunner(CommandMetrics(), log_directory=os.path.join(self.tmp, 'logs'))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def test_output_tail_and_stage_log(self):
+        tail = self.runner.run(_python('print("hello"); import sys; sys.stderr.write("warn\\n")'),
+                               self.tmp, stage='map:1/2/3')
+        self.assertEqual(sorted(line.split('] ', 1)[1] for line in tail), ['hello', 'warn'])
+        with open(os.path.join(self.tmp, 'logs', 'map_1_2_3.log')) as f:
+            self.assertIn('hello', f.read())
+
+    def test_failing_upstream_stage_fails_the_pipeline(self):
+        pipeline = Pipeline(_python('print("partial"); import sys; sys.exit(3)'), ['cat'])
+        with self.assertRaises(CommandError) as context:
+            self.runner.run(pipeline, self.tmp)
+        self.assertEqual(context.exception.returncode, 3)
+
+    def test_sigpipe_of_upstream_stage_does_not_mask_the_failure(self):
+        # yes dies of SIGPIPE once the failing reader exits
+        pipeline = Pipeline(['yes'], _python('import sys; sys.stdin.read(1); sys.exit(4)'))
+        with self.assertRaises(CommandError) as context:
+            self.runner.run(pipeline, self.tmp)
+        self.assertEqual(context.exception.returncode, 4)
+        self.assertEqual([entry['exit_code'] for entry in self.runner.metrics.commands],
+                         [-signal.SIGPIPE, 4])
+
+    def test_timeout_terminates_the_process_group(self):
+        pid_file = os.path.join(self.tmp, 'child.pid')
+        # the child the tool starts itself is in the tool's process group
+        command = _python('import subprocess, sys, time\n'
+                          'child = subprocess.Popen(["sleep", "60"])\n'
+                          'open(sys.argv[1], "w").write(str(child.pid))\n'
+                          'time.sleep(60)')
+        command.argv.append(pid_file)
+        start = time.time()
+        with self.assertRaisesRegex(CommandError, 'timed out') as context:
+            self.runner.run(command, self.tmp, timeout=1)
+        self.assertLess(time.time() - start, 30)
+        self.assertIsNone(context.exception.returncode)
+
+        with open(pid_file) as f:
+            child_pid = int(f.read())
+        deadline = time.time() + 10
+        while _alive(child_pid) and time.time() < deadline:
+            time.sleep(0.1)
+        self.assertFalse(_alive(child_pid))
+
+    def test_cancel_terminates_running_commands_and_refuses_new_ones(self):
+        errors = list()
+
+        def run():
+            try:
+                self.runner.run(['sleep', '60'], self.tmp)
+            except CommandError as e:
+                errors.append(e)
+
+        thread = threading.Thread(target=run)
+        thread.start()
+        deadline = time.time() + 10
+        while not self.runner._running and time.time() < deadline:
+            time.sleep(0.05)
+        self.runner.cancel()
+        thread.join(30)
+
+        self.assertFalse(thread.is_alive())
+        self.assertIn('was cancelled', str(errors[0]))
+        self.assertEqual(errors[0].returncode, -signal.SIGTERM)
+        # cancelling is final
+        with self.assertRaisesRegex(CommandError, 'the run was cancelled'):
+            self.runner.run(['true'], self.tmp)
+
+    def test_missing_executable_fails_to_start(self):
+        with self.assertRaisesRegex(CommandError, 'Cannot start') as context:
+            self.runner.run(Pipeline(['yes'], ['no-such-tool']), self.tmp)
+        self.assertIsNone(context.exception.returncode)
+        # the stage already started is not left behind
+        self.assertEqual(self.runner._running, set())
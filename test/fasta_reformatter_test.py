@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+import bz2
+import gzip
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+from unittest import mock
+
+from kb_anvio.Utils import FastaReformatter as reformatter_module
+from kb_anvio.Utils.FastaReformatter import FastaReformatter, n50
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+
+FASTA = (b'>NODE_1_length_12_cov_3.5 first contig\n'
+         b'ACGTAC\n'
+         b'GTACGT\n'
+         b'>NODE_2_length_4\n'
+         b'ACGT\n'
+         b'>NODE_3_length_10\r\n'
+         b'GGCCNNaatt\r\n'
+         b'\n'
+         b'>NODE_4_length_3\n'
+         b'ACG\n')
+
+
+class FastaReformatterTest(unittest.TestCase):
+    """
+    the expected output follows anvi-script-reformat-fasta --simplify-names -l: contigs
+    shorter than the minimum length dropped, the others renamed c_%012d in input order with
+    the sequence on one line, and a tab separated report of new to old names. Where anvi'o
+    is installed, test_matches_anvio_script compares both with the script's own output.
+    """
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def _path(self, name):
+        return os.path.join(self.tmp, name)
+
+    def _reformat(self, content, min_length=5, opener=open, name='assembly.fa', **kwargs):
+        with opener(self._path(name), 'wb') as f:
+            f.write(content)
+        stats = FastaReformatter(min_length, **kwargs).reformat(
+            self._path(name), self._path('out.fa'), self._path('report.txt'),
+            self._path('stats.json'))
+        with open(self._path('out.fa'), 'rb') as f:
+            output = f.read()
+        with open(self._path('report.txt')) as f:
+            report = f.read()
+        return stats, output, report
+
+    def test_filters_and_renames(self):
+        stats, output, report = self._reformat(FASTA)
+        self.assertEqual(output, b'>c_000000000001\nACGTACGTACGT\n'
+                                 b'>c_000000000002\nGGCCNNaatt\n')
+        self.assertEqual(report, 'c_000000000001\tNODE_1_length_12_cov_3.5 first contig\n'
+                                 'c_000000000002\tNODE_3_length_10\n')
+
+    def test_contig_of_min_length_is_kept(self):
+        stats, output, report = self._reformat(FASTA, min_length=4)
+        self.assertEqual(stats['contigs_kept'], 3)
+        self.assertIn(b'>c_000000000002\nACGT\n', output)
+        self.assertIn('c_000000000002\tNODE_2_length_4\n', report)
+
+    def test_prefix(self):
+        stats, output, report = self._reformat(FASTA, prefix='sample')
+        self.assertTrue(output.startswith(b'>sample_000000000001\n'))
+
+    def test_statistics(self):
+        stats, output, report = self._reformat(FASTA)
+        with open(self._path('stats.json')) as f:
+            self.assertEqual(json.load(f), stats)
+        self.assertEqual(stats['min_contig_length'], 5)
+        self.assertEqual(stats['contigs_read'], 4)
+        self.assertEqual(stats['contigs_kept'], 2)
+        self.assertEqual(stats['contigs_removed'], 2)
+        self.assertEqual(stats['total_length'], 22)
+        self.assertEqual(stats['min_length'], 10)
+        self.assertEqual(stats['max_length'], 12)
+        self.assertEqual(stats['n50'], 12)
+        self.assertEqual(stats['ambiguous_bases'], 2)
+        # 6 of 12 and 4 of 8 unambiguous bases are G or C
+        self.assertAlmostEqual(stats['gc_content'], 10 / 20.0)
+        self.assertEqual(stats['sha256'], hashlib.sha256(FASTA).hexdigest())
+
+    def test_compressed_input(self):
+        plain, plain_output, plain_report = self._reformat(FASTA)
+        for opener in [gzip.open, bz2.open]:
+            stats, output, report = self._reformat(FASTA, opener=opener, name='assembly.fa.z')
+            self.assertEqual(output, plain_output)
+            self.assertEqual(report, plain_report)
+            # the hash is of the decompressed content
+            self.assertEqual(stats['sha256'], plain['sha256'])
+
+    def test_lines_longer_than_read_size(self):
+        sequence = b'ACGT' * 50
+        content = b'>' + b'x' * 100 + b'\n' + sequence + b'\n>short\nAC\n'
+        with mock.patch.object(reformatter_module, 'READ_SIZE', 16):
+            stats, output, report = self._reformat(content, min_length=100)
+        self.assertEqual(output, b'>c_000000000001\n' + sequence + b'\n')
+        self.assertEqual(report, 'c_000000000001\t' + 'x' * 100 + '\n')
+        self.assertEqual(stats['sha256'], hashlib.sha256(content).hexdigest())
+
+    def test_last_contig_too_short(self):
+        stats, output, report = self._reformat(b'>a\nACGTACGT\n>b\nAC', min_length=5)
+        self.assertEqual(output, b'>c_000000000001\nACGTACGT\n')
+
+    def test_no_contig_kept(self):
+        stats, output, report = self._reformat(b'>a\nAC\n', min_length=5)
+        self.assertEqual((output, report), (b'', ''))
+        self.assertEqual((stats['contigs_kept'], stats['n50'], stats['gc_content']), (0, 0, 0.0))
+
+    def test_sequence_before_defline(self):
+        with self.assertRaisesRegex(ValueError, 'does not start with a defline'):
+            self._reformat(b'ACGT\n>a\nACGT\n')
+
+    def test_n50(self):
+        self.assertEqual(n50([2, 3, 4, 5, 6]), 5)
+        self.assertEqual(n50([10]), 10)
+        self.assertEqual(n50([]), 0)
+
+    @unittest.skipIf(shutil.which('anvi-script-reformat-fasta') is None, 'anvio is not installed')
+    def test_matches_anvio_script(self):
+        for assembly in ['small_arctic_assembly_mini.fa', 'small_arctic_assembly.fa']:
+            fasta = os.path.join(DATA_DIR, assembly)
+            anvio_fasta = self._path('anvio_' + assembly)
+            anvio_report = self._path('anvio_report_' + assembly)
+            subprocess.check_call(['anvi-script-reformat-fasta', fasta, '-o', anvio_fasta,
+                                   '-l', '1000', '--simplify-names', '-r', anvio_report])
+            FastaReformatter(1000).reformat(fasta, self._path('out.fa'), self._path('report.txt'))
+            for ours, theirs in [(self._path('out.fa'), anvio_fasta),
+                                 (self._path('report.txt'), anvio_report)]:
+                with open(ours) as f, open(theirs) as g:
+                    self.assertEqual(f.read(), g.read(), '{} of {}'.format(ours, assembly))
@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+import gzip
+import os
+import shutil
+import stat
+import tempfile
+import unittest
+
+from kb_anvio.Utils.FastqDeinterleaver import FastqDeinterleaver
+
+
+def record(name, sequence=b'ACGT'):
+    return b'@' + name + b'\n' + sequence + b'\n+\n' + b'I' * len(sequence) + b'\n'
+
+
+def interleaved(pairs, suffixes=(b'', b''), sequence=b'ACGT'):
+    forward = [record(b'read' + str(n).encode() + suffixes[0], sequence) for n in range(pairs)]
+    reverse = [record(b'read' + str(n).encode() + suffixes[1], sequence) for n in range(pairs)]
+    return forward, reverse
+
+
+def read_lockstep(forward, reverse):
+    """read one record of each mate in turn, as bowtie2 and hisat2 do"""
+    records = ([], [])
+    with open(forward, 'rb') as f, open(reverse, 'rb') as r:
+        while True:
+            done = True
+            for handle, mate in zip([f, r], records):
+                lines = [handle.readline() for _ in range(4)]
+                if lines[0]:
+                    mate.append(b''.join(lines))
+                    done = False
+            if done:
+                return records
+
+
+class FastqDeinterleaverTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def _fastq(self, records, opener=open, name='reads.fastq'):
+        path = os.path.join(self.tmp, name)
+        with opener(path, 'wb') as f:
+            f.write(b''.join(records))
+        return path
+
+    def _interleave(self, forward, reverse):
+        return [r for pair in zip(forward, reverse) for r in pair]
+
+    def test_streams_mates_through_named_pipes(self):
+        forward, reverse = interleaved(100)
+        deinterleaver = FastqDeinterleaver(self._fastq(self._interleave(forward, reverse)),
+                                           self.tmp)
+        with deinterleaver as (forward_pipe, reverse_pipe):
+            self.assertTrue(stat.S_ISFIFO(os.stat(forward_pipe).st_mode))
+            self.assertEqual(read_lockstep(forward_pipe, reverse_pipe), (forward, reverse))
+        self.assertFalse(os.path.exists(deinterleaver.work_dir))
+
+    def test_gzip_input_and_mate_suffixes(self):
+        forward, reverse = interleaved(10, suffixes=(b'/1', b'/2'))
+        fastq = self._fastq(self._interleave(forward, reverse), opener=gzip.open,
+                            name='reads.fastq.gz')
+        with FastqDeinterleaver(fastq, self.tmp) as (forward_pipe, reverse_pipe):
+            self.assertEqual(read_lockstep(forward_pipe, reverse_pipe), (forward, reverse))
+
+    def test_odd_number_of_records(self):
+        forward, reverse = interleaved(3)
+        fastq = self._fastq(self._interleave(forward, reverse)[:-1])
+        with self.assertRaisesRegex(ValueError, 'odd number of records'):
+            with FastqDeinterleaver(fastq, self.tmp) as (forward_pipe, reverse_pipe):
+                # the pipes still reach EOF, so the mapper is not left waiting
+                read_lockstep(forward_pipe, reverse_pipe)
+
+    def test_mismatched_mates(self):
+        forward, reverse = interleaved(3)
+        reverse[1] = record(b'other')
+        fastq = self._fastq(self._interleave(forward, reverse))
+        with self.assertRaisesRegex(ValueError, 'are not mates'):
+            with FastqDeinterleaver(fastq, self.tmp) as (forward_pipe, reverse_pipe):
+                read_lockstep(forward_pipe, reverse_pipe)
+
+    def test_mapper_closing_pipes_early(self):
+        # well beyond what the pipes and queues buffer, so the writers hit the closed pipes
+        forward, reverse = interleaved(20000, sequence=b'ACGT' * 50)
+        fastq = self._fastq(self._interleave(forward, reverse))
+        with self.assertRaisesRegex(ValueError, 'Cannot deinterleave'):
+            with FastqDeinterleaver(fastq, self.tmp) as (forward_pipe, reverse_pipe):
+                with open(forward_pipe, 'rb') as f, open(reverse_pipe, 'rb') as r:
+                    f.readline()
+                    r.readline()
+
+    def test_mapper_failure_cancels_split(self):
+        forward, reverse = interleaved(10)
+        fastq = self._fastq(self._interleave(forward, reverse))
+        with self.assertRaisesRegex(RuntimeError, 'mapper failed'):
+            with FastqDeinterleaver(fastq, self.tmp):
+                # the pipes are never opened
+                raise RuntimeError('mapper failed')
+
+    def test_split_to_regular_files(self):
+        forward, reverse = interleaved(10)
+        fastq = self._fastq(self._interleave(forward, reverse))
+        deinterleaver = FastqDeinterleaver(fastq, self.tmp, streaming=False)
+        with deinterleaver as (forward_file, reverse_file):
+            self.assertTrue(stat.S_ISREG(os.stat(forward_file).st_mode))
+            # a mapper may read the whole forward file first
+            for path, expected in [(forward_file, forward), (reverse_file, reverse)]:
+                with open(path, 'rb') as f:
+                    self.assertEqual(f.read(), b''.join(expected))
+        self.assertFalse(os.path.exists(deinterleaver.work_dir))
+
+    def test_split_to_regular_files_checks_mates(self):
+        forward, reverse = interleaved(3)
+        fastq = self._fastq(self._interleave(forward, reverse)[:-1])
+        deinterleaver = FastqDeinterleaver(fastq, self.tmp, streaming=False)
+        with self.assertRaisesRegex(ValueError, 'odd number of records'):
+            with deinterleaver:
+                pass
+        self.assertFalse(os.path.exists(deinterleaver.work_dir))
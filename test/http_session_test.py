@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+import json
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import requests
+from urllib3.exceptions import ConnectTimeoutError, MaxRetryError, ReadTimeoutError
+
+from installed_clients import baseclient
+from installed_clients.ReadsUtilsClient import ReadsUtils
+from kb_anvio.Utils import HttpSession
+from kb_anvio.Utils.HttpSession import SessionBaseClient, new_session, with_session
+
+
+class FlakyService(BaseHTTPRequestHandler):
+    """
+    FlakyService: JSON-RPC service answering 503 to the first `failures` requests
+    """
+    failures = 0
+    requests = 0
+
+    def _answer(self):
+        FlakyService.requests += 1
+        if FlakyService.requests <= FlakyService.failures:
+            self.send_response(503)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        body = json.dumps({'version': '1.1', 'result': [{'answer': 42}]}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        self._answer()
+
+    def do_GET(self):
+        self._answer()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class HttpSessionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = HTTPServer(('127.0.0.1', 0), FlakyService)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = 'http://127.0.0.1:{}'.format(self.server.server_port)
+        FlakyService.requests = 0
+        FlakyService.failures = 0
+        self.session = new_session(pool_size=2, retries=3, backoff_factor=0)
+
+    def tearDown(self):
+        self.session.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_json_rpc_call_through_the_session(self):
+        client = SessionBaseClient(self.url, self.session)
+        self.assertEqual(client.call_method('Test.answer', [{'ids': {1}}]), {'answer': 42})
+        self.assertEqual(FlakyService.requests, 1)
+
+    def test_json_rpc_post_not_repeated_on_gateway_status(self):
+        # the server may have run the call already, a repeat could submit a job twice
+        FlakyService.failures = 2
+        with self.assertRaises(requests.HTTPError):
+            SessionBaseClient(self.url, self.session).call_method('Test.answer', [])
+        self.assertEqual(FlakyService.requests, 1)
+
+    def test_get_retried_on_gateway_status(self):
+        FlakyService.failures = 2
+        self.assertEqual(self.session.get(self.url).status_code, 200)
+        self.assertEqual(FlakyService.requests, 3)
+
+    def test_post_only_retried_on_connect_errors(self):
+        retry = self.session.get_adapter(self.url).max_retries
+        self.assertFalse(retry.is_retry('POST', 503))
+        self.assertTrue(retry.is_retry('GET', 503))
+        # a connect error means the request never reached the server
+        retry = retry.increment('POST', self.url, error=ConnectTimeoutError())
+        with self.assertRaises(ReadTimeoutError):
+            retry.increment('POST', self.url, error=ReadTimeoutError(None, self.url, 'timeout'))
+        retry.increment('GET', self.url, error=ReadTimeoutError(None, self.url, 'timeout'))
+
+    def test_connect_errors_exhaust_retries(self):
+        self.server.server_close()
+        with self.assertRaises(requests.ConnectionError) as context:
+            SessionBaseClient(self.url, self.session).call_method('Test.answer', [])
+        self.assertIsInstance(context.exception.args[0], MaxRetryError)
+
+    def test_with_session(self):
+        client = ReadsUtils(self.url, token='token')
+        self.assertIs(with_session(client, None)._client.__class__, baseclient.BaseClient)
+
+        with_session(client, self.session)
+        self.assertIsInstance(client._client, SessionBaseClient)
+        self.assertIs(client._client.session, self.session)
+        self.assertEqual(client._client.url, self.url)
+        self.assertEqual(client._client._headers['AUTHORIZATION'], 'token')
+        # the generated module keeps posting with plain requests
+        self.assertIs(baseclient._requests, requests)
+
+    def test_session_from_config(self):
+        session = HttpSession.session_from_config({'http-pool-size': '4', 'http-retries': '',
+                                                   'http-retry-backoff': '0.25'})
+        retry = session.get_adapter('https://kbase.us').max_retries
+        self.assertEqual(retry.total, HttpSession.DEFAULT_RETRIES)
+        self.assertEqual(retry.backoff_factor, 0.25)
+        session.close()
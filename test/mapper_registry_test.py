@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+import sys
+import unittest
+
+from kb_anvio.Utils.MapperRegistry import READ_MAPPING_TOOLS, Mapper, get_mapper
+
+
+class MapperVersionTest(unittest.TestCase):
+
+    def _mapper(self, version_argv):
+        mapper = Mapper()
+        mapper.version_argv = version_argv
+        return mapper
+
+    def test_version_line(self):
+        mapper = self._mapper([sys.executable, '-c',
+                               'print("/usr/bin/bowtie2-align-s version 2.4.5")\n'
+                               'print("64-bit")'])
+        self.assertEqual(mapper.version(), '/usr/bin/bowtie2-align-s version 2.4.5')
+
+    def test_first_line_and_stderr(self):
+        mapper = self._mapper([sys.executable, '-c',
+                               'import sys; sys.stderr.write("2.24-r1122\\n"); sys.exit(1)'])
+        self.assertEqual(mapper.version(), '2.24-r1122')
+
+    def test_missing_tool(self):
+        self.assertEqual(self._mapper(['no-such-mapper', '--version']).version(), 'unknown')
+
+
+class FakePlan(object):
+    bbmap_mem = '12g'
+
+    def threads(self, stage):
+        return {'index': 6, 'mapping': 4}[stage]
+
+
+class MapperCommandTest(unittest.TestCase):
+    """
+    exact argv of every read_mapping_tool, with paths holding spaces passed as single arguments
+    """
+    assembly = '/data/my assembly.fa'
+    index = '/scratch/read index/contigs'
+    reads = ['/scratch/reads a.fastq']
+    split_reads = ['/scratch/reads a.fwd.fastq', '/scratch/reads a.rev.fastq']
+
+    def _commands(self, read_mapping_tool, reads, paired):
+        mapper, preset = get_mapper(read_mapping_tool)
+        return (mapper.index_command(self.assembly, self.index, FakePlan(), 7),
+                mapper.map_command(self.index, reads, paired, FakePlan(), preset, 7))
+
+    def test_every_tool_is_covered(self):
+        self.assertEqual(list(READ_MAPPING_TOOLS), [
+            'bbmap_fast', 'bbmap_default', 'bbmap_very_sensitive', 'bowtie2_default',
+            'bowtie2_very_sensitive', 'minimap2', 'hisat2', 'bwa'])
+
+    def test_bbmap(self):
+        index_argv = ['bbmap.sh', '-Xmx12g', 'threads=6', 'ref=/data/my assembly.fa',
+                      'path=/scratch/read index/contigs', 'overwrite']
+        for read_mapping_tool, preset in [('bbmap_fast', ['fast']), ('bbmap_default', []),
+                                          ('bbmap_very_sensitive', ['vslow=true'])]:
+            self.assertEqual(self._commands(read_mapping_tool, self.reads, True), (
+                index_argv,
+                ['bbmap.sh', '-Xmx12g', 'threads=4', 'path=/scratch/read index/contigs',
+                 'in=/scratch/reads a.fastq', 'out=stdout.sam'] + preset +
+                ['interleaved=true', 'mappedonly', 'overwrite']))
+        self.assertIn('interleaved=false', self._commands('bbmap_default', self.reads, False)[1])
+
+    def test_bowtie2(self):
+        index_argv, map_argv = self._commands('bowtie2_very_sensitive', self.reads, True)
+        self.assertEqual(index_argv, ['bowtie2-build', '-f', self.assembly, '--threads', '6',
+                                      '--seed', '7', self.index])
+        self.assertEqual(map_argv, ['bowtie2', '--very-sensitive', '-x', self.index,
+                                    '--interleaved', self.reads[0], '--threads', '4',
+                                    '--seed', '7'])
+        self.assertEqual(self._commands('bowtie2_default', self.reads, False)[1],
+                         ['bowtie2', '-x', self.index, '-U', self.reads[0], '--threads', '4',
+                          '--seed', '7'])
+        self.assertEqual(self._commands('bowtie2_default', self.split_reads, True)[1],
+                         ['bowtie2', '-x', self.index, '-1', self.split_reads[0],
+                          '-2', self.split_reads[1], '--threads', '4', '--seed', '7'])
+
+    def test_minimap2(self):
+        self.assertEqual(self._commands('minimap2', self.reads, True), (
+            ['minimap2', '-x', 'sr', '-t', '6', '-d', self.index, self.assembly],
+            ['minimap2', '-ax', 'sr', '-t', '4', '--seed', '7', self.index, self.reads[0]]))
+
+    def test_hisat2(self):
+        self.assertEqual(self._commands('hisat2', self.split_reads, True), (
+            ['hisat2-build', '-p', '6', '--seed', '7', self.assembly, self.index],
+            ['hisat2', '-x', self.index, '-1', self.split_reads[0], '-2', self.split_reads[1],
+             '--seed', '7', '--threads', '4']))
+        self.assertEqual(self._commands('hisat2', self.reads, False)[1],
+                         ['hisat2', '-x', self.index, '-U', self.reads[0], '--seed', '7',
+                          '--threads', '4'])
+
+    def test_bwa(self):
+        self.assertEqual(self._commands('bwa', self.reads, True), (
+            ['bwa', 'index', '-p', self.index, self.assembly],
+            ['bwa', 'mem', '-t', '4', '-K', '10000000', '-p', self.index, self.reads[0]]))
+        self.assertNotIn('-p', self._commands('bwa', self.reads, False)[1])
+
+    def test_unknown_tool(self):
+        with self.assertRaisesRegex(ValueError, 'Unknown read mapping tool'):
+            get_mapper('bowtie3')
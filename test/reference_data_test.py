@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from kb_anvio.Utils.ReferenceData import ANNOTATION_DATA, READY_MARKER, ReferenceData
+
+
+class ReferenceDataTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.root = os.path.join(self.tmp, 'anviodb')
+        self.commands = list()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def _write(self, directory, name='SCG.dmnd', content='database'):
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, name), 'w') as f:
+            f.write(content)
+
+    def _setup_into_data_dir(self, command):
+        self.commands.append(command.argv)
+        self._write(command.argv[command.argv.index('--scgs-taxonomy-data-dir') + 1])
+
+    def test_setup_into_data_dir(self):
+        reference_data = ReferenceData(self.root)
+        data_dir = reference_data.setup('scg_taxonomy', 2, self._setup_into_data_dir)
+        self.assertEqual(os.path.realpath(data_dir),
+                         os.path.realpath(os.path.join(self.root, 'SCG_TAXONOMY')))
+        self.assertTrue(os.path.isfile(os.path.join(data_dir, READY_MARKER)))
+        self.assertTrue(reference_data.is_ready('scg_taxonomy'))
+
+        # a ready database is not built again
+        reference_data.ensure('scg_taxonomy', 2, self._setup_into_data_dir)
+        self.assertEqual(len(self.commands), 1)
+
+    def test_setup_writing_nothing_fails(self):
+        reference_data = ReferenceData(self.root)
+        with self.assertRaisesRegex(ValueError, 'wrote no files'):
+            reference_data.setup('scg_taxonomy', 2, lambda command: None)
+        self.assertFalse(os.path.lexists(os.path.join(self.root, 'SCG_TAXONOMY')))
+        self.assertEqual([name for name in os.listdir(self.root) if not name.endswith('.lock')],
+                         [])
+
+    def test_rebuild_switches_the_symlink_and_keeps_the_replaced_build(self):
+        reference_data = ReferenceData(self.root)
+        data_dir = reference_data.data_dir('scg_taxonomy')
+        first = reference_data.ensure('scg_taxonomy', 2, self._setup_into_data_dir)
+        self.assertTrue(os.path.islink(data_dir))
+        self.assertEqual(os.path.realpath(data_dir), os.path.realpath(first))
+
+        # a newer anvi'o rebuilds the database while a job still reads the first build
+        reference_data.version = 'newer'
+        second = reference_data.ensure('scg_taxonomy', 2, self._setup_into_data_dir)
+        self.assertNotEqual(second, first)
+        self.assertEqual(os.path.realpath(data_dir), os.path.realpath(second))
+        self.assertTrue(os.path.isfile(os.path.join(first, 'SCG.dmnd')))
+
+        reference_data.version = 'newest'
+        third = reference_data.ensure('scg_taxonomy', 2, self._setup_into_data_dir)
+        self.assertFalse(os.path.exists(first))
+        self.assertTrue(os.path.isdir(second))
+        self.assertEqual(os.path.realpath(data_dir), os.path.realpath(third))
+        self.assertEqual(len(self.commands), 3)
+
+    def test_unversioned_database_directory_is_replaced(self):
+        data_dir = os.path.join(self.root, 'SCG_TAXONOMY')
+        self._write(data_dir, content='unversioned')
+        reference_data = ReferenceData(self.root)
+        build_dir = reference_data.setup('scg_taxonomy', 2, self._setup_into_data_dir)
+        self.assertTrue(os.path.islink(data_dir))
+        self.assertTrue(reference_data.is_ready('scg_taxonomy'))
+        # the old directory is kept for the jobs that may still read it
+        kept = [name for name in os.listdir(self.root) if name.startswith('.SCG_TAXONOMY.') and
+                os.path.isdir(os.path.join(self.root, name)) and
+                os.path.join(self.root, name) != build_dir]
+        self.assertEqual(len(kept), 1)
+        with open(os.path.join(self.root, kept[0], 'SCG.dmnd')) as f:
+            self.assertEqual(f.read(), 'unversioned')
+
+    def test_changed_file_is_not_ready(self):
+        reference_data = ReferenceData(self.root)
+        data_dir = reference_data.setup('scg_taxonomy', 2, self._setup_into_data_dir)
+        self._write(data_dir, content='truncated')
+        self.assertFalse(reference_data.is_ready('scg_taxonomy'))
+
+    def _annotation_data(self):
+        self._write(os.path.join(self.root, 'Pfam'), 'Pfam-A.hmm.h3f', 'pfam')
+        self._write(os.path.join(self.root, 'Pfam'), 'Pfam-A.hmm.dat', 'pfam metadata')
+        self._write(os.path.join(self.root, 'COG', 'COG20', 'DB_DIAMOND'), 'COG.dmnd', 'cogs')
+
+    def test_manifest_round_trip(self):
+        self._annotation_data()
+        reference_data = ReferenceData(self.root)
+        reference_data.write_manifest(threads=2)
+        status = reference_data.validate(verify_checksums=True, threads=2)
+        self.assertIsNone(status['pfams'])
+        self.assertIsNone(status['ncbi_cogs'])
+        self.assertIn('not in the reference manifest', status['kegg_kofams'])
+        reference_data.require(['pfams', 'ncbi_cogs'])
+
+    def test_manifest_mismatch(self):
+        self._annotation_data()
+        reference_data = ReferenceData(self.root)
+        reference_data.write_manifest()
+        self._write(os.path.join(self.root, 'Pfam'), 'Pfam-A.hmm.h3f', 'truncated')
+        # same size, different content
+        self._write(os.path.join(self.root, 'COG', 'COG20', 'DB_DIAMOND'), 'COG.dmnd', 'COGS')
+
+        status = reference_data.validate()
+        self.assertIn('the manifest records 4', status['pfams'])
+        self.assertIsNone(status['ncbi_cogs'])
+        status = reference_data.validate(verify_checksums=True)
+        self.assertIn('does not match its checksum', status['ncbi_cogs'])
+        with self.assertRaisesRegex(ValueError, 'pfams: .*Pfam-A.hmm.h3f has size 9'):
+            reference_data.require(['pfams'])
+
+        os.remove(os.path.join(self.root, 'Pfam', 'Pfam-A.hmm.dat'))
+        self.assertIn('Pfam-A.hmm.dat is missing', reference_data.validate()['pfams'])
+
+    def test_missing_manifest_invalidates_every_source(self):
+        self._annotation_data()
+        reference_data = ReferenceData(self.root)
+        status = reference_data.validate()
+        self.assertEqual(sorted(status), sorted(ANNOTATION_DATA))
+        for problem in status.values():
+            self.assertTrue(problem.startswith('cannot read the reference manifest {}'.format(
+                reference_data.manifest_path())), problem)
+        with self.assertRaisesRegex(ValueError, 'cannot read the reference manifest'):
+            reference_data.require(['pfams'])
+        # jobs build the taxonomy databases themselves
+        reference_data.require(['scg_taxonomy', 'trnas'])
+
+    def test_warm(self):
+        self._annotation_data()
+        reference_data = ReferenceData(self.root)
+        with mock.patch.object(reference_data, '_warm_files') as warm_files:
+            thread = reference_data.warm(['pfams', 'ncbi_cogs', 'hmms'])
+            thread.join(10)
+        # only search indexes are warmed, hmms has no data under root
+        warm_files.assert_called_once_with(
+            [os.path.join(self.root, 'Pfam', 'Pfam-A.hmm.h3f'),
+             os.path.join(self.root, 'COG', 'COG20', 'DB_DIAMOND', 'COG.dmnd')])
+        self.assertIsNone(reference_data.warm(['kegg_kofams']))
+
+        # unreadable files are logged and skipped
+        reference_data._warm_files([os.path.join(self.root, 'Pfam', 'Pfam-A.hmm.h3f'),
+                                    os.path.join(self.root, 'no_such_file')])
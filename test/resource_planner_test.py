@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+import unittest
+
+from kb_anvio.Utils.ResourcePlanner import GIB, MIB, ResourcePlan
+
+
+class ResourcePlanTest(unittest.TestCase):
+
+    def test_node_stages_get_every_cpu(self):
+        plan = ResourcePlan(16, 64 * GIB, num_samples=4, sample_workers=4)
+        for stage in ResourcePlan.NODE_STAGES:
+            self.assertEqual(plan.threads(stage), 16)
+
+    def test_sample_stages_split_cpus_and_memory(self):
+        plan = ResourcePlan(16, 64 * GIB, num_samples=4, sample_workers=4)
+        for stage in ResourcePlan.SAMPLE_STAGES:
+            self.assertEqual(plan.threads(stage), 4)
+        self.assertEqual(plan.sample_memory,
+                         int(64 * GIB * ResourcePlan.USABLE_MEMORY_FRACTION) // 4)
+        self.assertLessEqual(plan.sample_workers * plan.sample_threads, plan.cpus)
+
+    def test_default_sample_workers_bounded_by_cpus_memory_and_samples(self):
+        # two threads per sample worker
+        self.assertEqual(ResourcePlan(8, 64 * GIB, num_samples=10).sample_workers, 4)
+        # 2 GiB per worker, of 85% of the memory
+        self.assertEqual(ResourcePlan(32, 5 * GIB, num_samples=10).sample_workers, 2)
+        # bbmap needs 8 GiB per worker
+        self.assertEqual(ResourcePlan(32, 20 * GIB, num_samples=10,
+                                      read_mapping_tool='bbmap_default').sample_workers, 2)
+        self.assertEqual(ResourcePlan(32, 64 * GIB, num_samples=3).sample_workers, 3)
+
+    def test_requested_sample_workers_capped(self):
+        plan = ResourcePlan(4, 64 * GIB, num_samples=10, sample_workers=12)
+        self.assertEqual(plan.sample_workers, 4)
+        self.assertEqual(plan.sample_threads, 1)
+        self.assertEqual(ResourcePlan(4, GIB, num_samples=2, sample_workers=0).sample_workers, 1)
+
+    def test_split_shares_resources(self):
+        plan = ResourcePlan(16, 64 * GIB, num_samples=4, sample_workers=2)
+        half = plan.split(2)
+        self.assertEqual(half.cpus, 8)
+        self.assertEqual(half.memory, 32 * GIB)
+        self.assertEqual(half.sample_workers, 2)
+        self.assertEqual(half.threads('mapping'), 4)
+        self.assertEqual(ResourcePlan(1, GIB).split(4).cpus, 1)
+
+    def test_memory_sizes(self):
+        plan = ResourcePlan(8, 16 * GIB, num_samples=1, sample_workers=1)
+        sort_mem = int(plan.sort_mem[:-1]) * MIB
+        self.assertTrue(ResourcePlan.MIN_SORT_MEMORY_PER_THREAD <= sort_mem <=
+                        ResourcePlan.MAX_SORT_MEMORY_PER_THREAD)
+        self.assertEqual(ResourcePlan(1, GIB).bbmap_mem, '1024m')
+        self.assertEqual(plan.bbmap_mem, '{}m'.format(
+            int(plan.sample_memory * ResourcePlan.BBMAP_HEAP_FRACTION) // MIB))
+
+    def test_unknown_stage(self):
+        with self.assertRaises(ValueError):
+            ResourcePlan(4, GIB).threads('assemble')
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+import threading
+import time
+import unittest
+
+from kb_anvio.Utils.StageGraph import StageGraph
+
+
+class StageGraphTest(unittest.TestCase):
+
+    def setUp(self):
+        self.lock = threading.Lock()
+        self.events = list()
+        self.running = 0
+        self.max_running = 0
+
+    def _stage(self, name, result=None, seconds=0.0, error=None):
+        def run(results):
+            with self.lock:
+                self.events.append(('start', name, sorted(results)))
+                self.running += 1
+                self.max_running = max(self.max_running, self.running)
+            time.sleep(seconds)
+            with self.lock:
+                self.running -= 1
+                self.events.append(('end', name))
+            if error is not None:
+                raise error
+            return result
+        return run
+
+    def _started(self):
+        return [event[1] for event in self.events if event[0] == 'start']
+
+    def test_stages_run_after_the_stages_they_need(self):
+        graph = StageGraph(4)
+        graph.add_stage('fetch', self._stage('fetch', 'assembly.fa'))
+        graph.add_stage('reformat', self._stage('reformat', 'clean.fa'), needs=['fetch'])
+        graph.add_stage('contigs_db', self._stage('contigs_db', 'contigs.db'), needs=['reformat'])
+        graph.add_stage('index', self._stage('index', 'index'), needs=['reformat'])
+        graph.add_stage('profile', self._stage('profile'), needs=['contigs_db', 'index'])
+
+        results = graph.run()
+
+        self.assertEqual(results['contigs_db'], 'contigs.db')
+        self.assertEqual(sorted(results), ['contigs_db', 'fetch', 'index', 'profile', 'reformat'])
+        for event in self.events:
+            if event[0] == 'start':
+                needs = graph.stages[event[1]].needs
+                self.assertTrue(set(needs) <= set(event[2]),
+                                '{} started before {}'.format(event[1], needs))
+
+    def test_independent_stages_overlap(self):
+        graph = StageGraph(4)
+        graph.add_stage('contigs_db', self._stage('contigs_db', seconds=0.3), threads=2)
+        graph.add_stage('index', self._stage('index', seconds=0.3), threads=2)
+        graph.run()
+        self.assertEqual(self.max_running, 2)
+
+    def test_thread_budget_serialises_stages(self):
+        graph = StageGraph(4)
+        graph.add_stage('contigs_db', self._stage('contigs_db', seconds=0.1), threads=3)
+        graph.add_stage('index', self._stage('index', seconds=0.1), threads=3)
+        graph.run()
+        self.assertEqual(self.max_running, 1)
+
+    def test_stage_larger_than_budget_still_runs(self):
+        graph = StageGraph(2)
+        graph.add_stage('merge', self._stage('merge', 'merged'), threads=16)
+        self.assertEqual(graph.run()['merge'], 'merged')
+
+    def test_failure_stops_new_stages_and_raises_first_error(self):
+        failures = list()
+        graph = StageGraph(4, on_failure=failures.append)
+        graph.add_stage('fetch', self._stage('fetch'))
+        graph.add_stage('slow', self._stage('slow', seconds=0.3), needs=['fetch'])
+        graph.add_stage('broken', self._stage('broken', error=ValueError('broken')),
+                        needs=['fetch'])
+        graph.add_stage('after_broken', self._stage('after_broken'), needs=['broken'])
+        graph.add_stage('after_slow', self._stage('after_slow'), needs=['slow'])
+
+        with self.assertRaisesRegex(ValueError, 'broken'):
+            graph.run()
+
+        self.assertEqual([str(error) for error in failures], ['broken'])
+        self.assertNotIn('after_broken', self._started())
+        self.assertNotIn('after_slow', self._started())
+        # the stage running when the failure happened was waited for
+        self.assertIn(('end', 'slow'), self.events)
+
+    def test_unknown_and_duplicate_stages_are_rejected(self):
+        graph = StageGraph(1)
+        graph.add_stage('fetch', self._stage('fetch'))
+        with self.assertRaisesRegex(ValueError, 'unknown stage'):
+            graph.add_stage('reformat', self._stage('reformat'), needs=['download'])
+        with self.assertRaisesRegex(ValueError, 'already defined'):
+            graph.add_stage('fetch', self._stage('fetch'))